@@ -0,0 +1,207 @@
+"""Benchmark reprodutível dos caminhos críticos do controle de estoque.
+
+Uso:
+    python benchmarks/bench_estoque.py [--produtos N] [--movimentos N] [--anos N]
+                                       [--movimentacoes N] [--repeticoes N] [--semente N]
+                                       [--saida resultados.json] [--db arquivo.db]
+
+Gera um catálogo e um histórico sintéticos (mesma semente = mesmos dados),
+mede get_products (com e sem busca), get_transactions com limite, validade, vazão de
+change_stock e do escritor agrupado, a agregação do relatório (com e sem cache) e a
+exportação/importação CSV, e grava os tempos em JSON para comparação entre
+versões. Com --db o banco gerado é mantido nesse arquivo; sem ele é usado
+um diretório temporário.
+"""
+import argparse, datetime, json, os, platform, random, sqlite3, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import controle_de_estoque as app
+
+WORDS = ["arroz", "feijão", "açúcar", "café", "leite", "óleo", "sal", "macarrão", "farinha", "biscoito",
+         "sabão", "detergente", "azeite", "molho", "tomate", "milho", "aveia", "chocolate", "suco", "água"]
+BRANDS = ["Bom Preço", "Da Casa", "Premium", "Econômico", "Tradição", "Sabor", "Vale", "Serra"]
+CHUNK = 50000
+
+
+def generate(n_products, n_movements, years, seed):
+    """Popula o banco atual (app.DB_FILE) com dados sintéticos consistentes."""
+    rnd = random.Random(seed)
+    conn = app.get_connection()
+    app.migrate(conn)
+    now = datetime.datetime.now()
+    today = now.date()
+    conn.execute("PRAGMA synchronous=OFF")
+    with conn:
+        conn.executemany(
+            "INSERT INTO products (name,quantity,price,expiry_date,created_at,min_quantity) VALUES (?,?,?,?,?,?)",
+            ((f"{rnd.choice(WORDS).capitalize()} {rnd.choice(WORDS)} {rnd.choice(BRANDS)} {i}",
+              0, round(rnd.uniform(1, 200), 2),
+              (today + datetime.timedelta(days=rnd.randrange(-30, 720))).isoformat() if rnd.random() < 0.6 else None,
+              (now - datetime.timedelta(days=years * 365)).isoformat(), rnd.choice((0, 5, 10, 20)))
+             for i in range(n_products)))
+    net = [0] * (n_products + 1)
+    span = years * 365 * 24 * 3600
+    done = 0
+    while done < n_movements:
+        rows = []
+        for _ in range(min(CHUNK, n_movements - done)):
+            pid = rnd.randint(1, n_products)
+            ttype = "in" if rnd.random() < 0.55 else "out"
+            qty = rnd.randint(1, 30)
+            net[pid] += qty if ttype == "in" else -qty
+            created = (now - datetime.timedelta(seconds=rnd.randrange(span))).isoformat()
+            rows.append((pid, ttype, qty, created, ""))
+        with conn:
+            conn.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) VALUES (?,?,?,?,?)",
+                             rows)
+        done += len(rows)
+    # saldo inicial suficiente para que nenhum produto fique negativo
+    with conn:
+        conn.executemany("UPDATE products SET quantity=? WHERE id=?",
+                         ((max(0, n) + rnd.randint(0, 50), pid) for pid, n in enumerate(net) if pid))
+        # saldo gravado direto: abre os lotes correspondentes
+        app._reconcile_lots(conn.cursor(), range(1, n_products + 1), now.isoformat())
+    conn.execute("PRAGMA synchronous=NORMAL")
+    app.rebuild_daily_movements()
+    conn.execute("ANALYZE")
+
+
+def timed(fn, repeat):
+    times = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - t0)
+    return times, result
+
+
+def summarize(times, ops=None, rows=None):
+    out = {
+        "runs": len(times),
+        "min_ms": round(min(times) * 1000, 3),
+        "median_ms": round(statistics.median(times) * 1000, 3),
+        "mean_ms": round(statistics.fmean(times) * 1000, 3),
+    }
+    if ops:
+        out["ops_per_s"] = round(ops / statistics.median(times), 1)
+    if rows is not None:
+        out["rows"] = rows
+    return out
+
+
+def run(args, workdir):
+    results = {}
+    rnd = random.Random(args.seed + 1)
+    n_products = app.count_products()
+
+    def bench(name, fn, repeat=args.repeticoes, ops=None, count_rows=True):
+        # primeira execução fora da medição para aquecer cache de páginas e de comandos
+        first = fn()
+        times, result = timed(fn, repeat)
+        rows = len(result) if count_rows and hasattr(result, "__len__") else None
+        results[name] = summarize(times, ops, rows)
+        print(f"{name:<38} {results[name]['median_ms']:>10.2f} ms" +
+              (f"  {results[name]['ops_per_s']:>10.0f} op/s" if ops else ""))
+        return first
+
+    bench("get_products", lambda: app.get_products())
+    bench("get_products_page", lambda: app.get_products(limit=200, offset=n_products // 2))
+    for term in ("arr", "café leite", "chocolate premium"):
+        bench(f"get_products_search[{term}]", lambda term=term: app.get_products(term, limit=200))
+    bench("count_products_search[aç]", lambda: app.count_products("aç"), count_rows=False)
+    bench("get_transactions_limit10", lambda: app.get_transactions(limit=10))
+    bench("get_transactions_product_limit50",
+          lambda: app.get_transactions(product_id=rnd.randint(1, n_products), limit=50))
+    bench("get_transactions_offset_page",
+          lambda: app.get_transactions(limit=200, offset=app.count_transactions() // 2))
+
+    def report_cold(days, gran):
+        app.report_cache.clear()
+        return app.InventoryApp._load_report(days, gran)
+
+    for days in (30, 365):
+        for gran in ("day", "month"):
+            bench(f"report_aggregate[{days}d,{gran}]",
+                  lambda days=days, gran=gran: report_cold(days, gran), count_rows=False)
+    bench("report_cached[365d,day]", lambda: app.InventoryApp._load_report(365, "day"), count_rows=False)
+
+    def report_after_movement():
+        app.change_stock(rnd.randint(1, n_products), 1, "in", "bench")
+        return app.InventoryApp._load_report(365, "day")
+    bench("report_incremental[365d,day]", report_after_movement, count_rows=False)
+    bench("dashboard_load", app.InventoryApp._load_dashboard, count_rows=False)
+    bench("expiry_summary[30d]", lambda: app.get_expiry_summary(30), count_rows=False)
+    bench("get_expiring_page[30d]", lambda: app.get_expiring(30, True, limit=200))
+
+    n_moves = args.movimentacoes
+    pids = [rnd.randint(1, n_products) for _ in range(n_moves)]
+
+    def sequential():
+        for pid in pids:
+            app.change_stock(pid, 1, "in", "bench")
+    bench("change_stock_sequential", sequential, repeat=1, ops=n_moves, count_rows=False)
+
+    def grouped():
+        futs = [app.queue_movement(pid, 1, "in", "bench") for pid in pids]
+        for f in futs:
+            f.result()
+    bench("queue_movement_grouped", grouped, repeat=1, ops=n_moves, count_rows=False)
+
+    products_csv = os.path.join(workdir, "produtos.csv")
+    history_csv = os.path.join(workdir, "historico.csv.gz")
+    bench("export_products_csv", lambda: app.write_products_csv(products_csv), repeat=1, count_rows=False)
+    bench("export_transactions_csv_gz", lambda: app.write_transactions_csv(history_csv), repeat=1, count_rows=False)
+    bench("import_products_csv", lambda: app.import_products_csv(products_csv), repeat=1, count_rows=False)
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--produtos", type=int, default=10000)
+    ap.add_argument("--movimentos", type=int, default=100000)
+    ap.add_argument("--anos", type=int, default=3)
+    ap.add_argument("--movimentacoes", type=int, default=2000, help="movimentações na medição de vazão")
+    ap.add_argument("--repeticoes", type=int, default=5)
+    ap.add_argument("--semente", dest="seed", type=int, default=42)
+    ap.add_argument("--saida", help="arquivo JSON de resultados (padrão: saída padrão)")
+    ap.add_argument("--db", help="mantém o banco gerado neste arquivo")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DB_FILE = args.db or os.path.join(tmp, "bench.db")
+        if os.path.exists(app.DB_FILE):
+            sys.exit(f"{app.DB_FILE} já existe; escolha outro arquivo.")
+        t0 = time.perf_counter()
+        generate(args.produtos, args.movimentos, args.anos, args.seed)
+        gen_s = time.perf_counter() - t0
+        print(f"Dados gerados em {gen_s:.1f} s ({args.produtos} produtos, {args.movimentos} movimentações)")
+        results = run(args, tmp)
+        app.get_writer().close()
+        app.close_connections()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "platform": platform.platform(),
+            "products": args.produtos,
+            "movements": args.movimentos,
+            "years": args.anos,
+            "seed": args.seed,
+            "generate_s": round(gen_s, 2),
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+        print(f"Resultados gravados em {args.saida}")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
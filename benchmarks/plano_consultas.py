@@ -0,0 +1,75 @@
+"""Compara planos de consulta e tempos antes e depois dos índices (migração 2).
+
+Uso:
+    python benchmarks/plano_consultas.py [--produtos N] [--movimentos N]
+
+Gera um banco temporário com dados sintéticos no esquema da versão 1,
+mostra EXPLAIN QUERY PLAN e o tempo das consultas usadas por get_products
+e get_transactions, aplica as migrações pendentes e repete a medição.
+"""
+import argparse, datetime, os, random, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import controle_de_estoque as app
+
+# Montadas pelas mesmas funções usadas por get_products/get_transactions, na
+# hora da medição (a busca muda de LIKE para FTS5 quando o índice existe).
+QUERIES = [
+    ("get_products(limit=200)", lambda: app._products_query(limit=200)),
+    ("get_products('produto 12', limit=200)", lambda: app._products_query("produto 12", limit=200)),
+    ("get_transactions(limit=10)", lambda: app._transactions_query(limit=10)),
+    ("get_transactions(product_id, limit=50)", lambda: app._transactions_query(1, limit=50)),
+    ("get_transactions(limit=200, before=...)",
+     lambda: app._transactions_query(limit=200, before=(datetime.datetime.now().isoformat(), 1 << 62))),
+]
+
+
+def populate(conn, n_products, n_movements):
+    rnd = random.Random(42)
+    now = datetime.datetime.now()
+    conn.executemany("INSERT INTO products (name,quantity,price,expiry_date,created_at) VALUES (?,?,?,?,?)",
+                     ((f"Produto {rnd.randrange(10**8):08d}", rnd.randrange(500), rnd.random() * 100,
+                       None, now.isoformat()) for _ in range(n_products)))
+    conn.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) VALUES (?,?,?,?,?)",
+                     ((rnd.randrange(1, n_products + 1), rnd.choice(("in", "out")), rnd.randrange(1, 20),
+                       (now - datetime.timedelta(minutes=rnd.randrange(3 * 365 * 24 * 60))).isoformat(), "")
+                      for _ in range(n_movements)))
+    conn.commit()
+
+
+def report(conn, label, repeat=3):
+    print(f"\n== {label} (user_version={conn.execute('PRAGMA user_version').fetchone()[0]}) ==")
+    app._search_index.clear()  # o índice FTS5 pode ter sido criado pela migração
+    for name, build in QUERIES:
+        sql, params = build()
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        best = float("inf")
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            conn.execute(sql, params).fetchall()
+            best = min(best, time.perf_counter() - t0)
+        print(f"\n{name}: {best * 1000:.1f} ms")
+        for row in plan:
+            print(f"    {row['detail']}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--produtos", type=int, default=20000)
+    ap.add_argument("--movimentos", type=int, default=500000)
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        app.DB_FILE = os.path.join(tmp, "bench.db")
+        conn = app.get_connection()
+        app.migrate(conn, target=1)
+        populate(conn, args.produtos, args.movimentos)
+        report(conn, "Antes")
+        app.migrate(conn)
+        conn.execute("ANALYZE")
+        report(conn, "Depois")
+        app.close_connections()
+
+
+if __name__ == "__main__":
+    main()
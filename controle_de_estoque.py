@@ -1,152 +1,1914 @@
 import sqlite3
+import importlib.util
 import tkinter as tk
-from tkinter import ttk, messagebox, filedialog
-import csv, datetime, os, sys
+from tkinter import ttk, messagebox, filedialog, simpledialog
+import argparse, bisect, contextlib, csv, datetime, functools, gzip, math, os, re, sys
+import asyncio, atexit, json, queue, threading, time, traceback, urllib.parse
+from concurrent.futures import Future, ThreadPoolExecutor
+from collections import OrderedDict, deque
+
+# Referência para --medir-inicio (após as importações da biblioteca padrão)
+_STARTUP_T0 = time.perf_counter()
 
 DB_FILE = "inventory.db"
 
-# Optional libs
-HAS_MPL = True
-try:
-    import matplotlib
-    matplotlib.use("TkAgg")
-    import matplotlib.pyplot as plt
-    from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-except Exception:
-    HAS_MPL = False
+# Ajustes da conexão SQLite (cache negativo = KiB)
+DB_CACHE_KIB = 20000
+DB_MMAP_BYTES = 64 * 1024 * 1024
+DB_STATEMENT_CACHE = 256
+
+# Optional libs: só detectadas aqui; importadas no primeiro uso (a importação
+# do matplotlib sozinha custa segundos nos terminais mais fracos)
+HAS_MPL = importlib.util.find_spec("matplotlib") is not None
+HAS_TKCAL = importlib.util.find_spec("tkcalendar") is not None
+_mpl = None
+
+def _load_mpl():
+    """(Figure, FigureCanvasTkAgg), importados na primeira chamada; None sem matplotlib."""
+    global _mpl, HAS_MPL
+    if _mpl is None and HAS_MPL:
+        try:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+            _mpl = Figure, FigureCanvasTkAgg
+        except Exception:
+            HAS_MPL = False
+    return _mpl
+
+def _date_entry_class():
+    """tkcalendar.DateEntry, importado na primeira chamada; None sem tkcalendar."""
+    global HAS_TKCAL
+    if HAS_TKCAL:
+        try:
+            from tkcalendar import DateEntry
+            return DateEntry
+        except Exception:
+            HAS_TKCAL = False
+    return None
+
+
+# Instrumentação (desligada por padrão; ESTOQUE_PERFIL=1 ou --perfil)
+#
+# Desligada, cada função instrumentada custa só o teste de profiler.enabled e
+# as conexões são sqlite3.Connection comuns. Ligada, as conexões abertas a
+# partir daí medem cada comando SQL e registram os lentos com o plano.
+
+PROFILE_BUCKETS_MS = (0.1, 0.5, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 5000)
+PROFILE_SLOW_MS = 50.0
+PROFILE_SLOW_LOG = 200
+
+_profile_local = threading.local()
+
+def _p95(hist, max_ms):
+    total = sum(hist)
+    if not total:
+        return 0.0
+    seen = 0
+    for bound, n in zip(PROFILE_BUCKETS_MS, hist):
+        seen += n
+        if seen >= total * 0.95:
+            return min(bound, max_ms)
+    return max_ms
+
+class Profiler:
+    """Chamadas, histograma de latência, linhas retornadas e log de consultas lentas."""
+
+    def __init__(self, slow_ms=PROFILE_SLOW_MS):
+        self.enabled = False
+        self.slow_ms = slow_ms
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._functions = {}
+            self._queries = {}
+            self._slow = deque(maxlen=PROFILE_SLOW_LOG)
+            self.started = datetime.datetime.now().isoformat(timespec="seconds")
+
+    def _add(self, table, name, ms, rows, error):
+        st = table.get(name)
+        if st is None:
+            st = table[name] = {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "rows": 0,
+                                "hist": [0] * (len(PROFILE_BUCKETS_MS) + 1)}
+        st["calls"] += 1
+        st["total_ms"] += ms
+        if ms > st["max_ms"]:
+            st["max_ms"] = ms
+        if rows:
+            st["rows"] += rows
+        if error:
+            st["errors"] += 1
+        st["hist"][bisect.bisect_left(PROFILE_BUCKETS_MS, ms)] += 1
+
+    def record(self, name, elapsed, rows=None, error=False):
+        with self._lock:
+            self._add(self._functions, name, elapsed * 1000, rows, error)
+
+    def record_query(self, conn, sql, params, elapsed, rows=None, error=False):
+        ms = elapsed * 1000
+        sql = " ".join(sql.split())
+        with self._lock:
+            self._add(self._queries, sql, ms, rows, error)
+        if ms < self.slow_ms:
+            return
+        plan = []
+        if params is not None:
+            try:
+                plan = [r[3] for r in sqlite3.Cursor(conn).execute("EXPLAIN QUERY PLAN " + sql, params)]
+            except sqlite3.Error:
+                pass
+        entry = {"at": datetime.datetime.now().isoformat(timespec="milliseconds"), "ms": round(ms, 3),
+                 "function": getattr(_profile_local, "fn", None), "sql": sql, "params": repr(params)[:200],
+                 "rows": rows, "plan": plan}
+        with self._lock:
+            self._slow.append(entry)
+
+    def snapshot(self):
+        def table(stats):
+            out = {}
+            for name, st in stats.items():
+                out[name] = dict(st, hist=list(st["hist"]), total_ms=round(st["total_ms"], 3),
+                                 max_ms=round(st["max_ms"], 3), mean_ms=round(st["total_ms"] / st["calls"], 3),
+                                 p95_ms=round(_p95(st["hist"], st["max_ms"]), 3))
+            return out
+        # os caches contam sempre, com a instrumentação ligada ou não
+        caches = {"products": product_cache.stats(), "reports": report_cache.stats()}
+        with self._lock:
+            return {"enabled": self.enabled, "started": self.started, "slow_ms": self.slow_ms,
+                    "buckets_ms": list(PROFILE_BUCKETS_MS), "functions": table(self._functions),
+                    "queries": table(self._queries), "slow": list(self._slow), "caches": caches}
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=2)
+
+profiler = Profiler()
+
+def enable_profiling(slow_ms=None):
+    """Liga a instrumentação; chame antes de abrir conexões para medir também o SQL."""
+    if slow_ms is not None:
+        profiler.slow_ms = slow_ms
+    profiler.enabled = True
+
+def profiled(fn):
+    """Decorador: mede fn no profiler quando a instrumentação está ligada."""
+    name = fn.__qualname__
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not profiler.enabled:
+            return fn(*args, **kwargs)
+        outer = getattr(_profile_local, "fn", None)
+        _profile_local.fn = name
+        t0 = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException:
+            profiler.record(name, time.perf_counter() - t0, error=True)
+            raise
+        finally:
+            _profile_local.fn = outer
+        profiler.record(name, time.perf_counter() - t0, len(result) if isinstance(result, list) else None)
+        return result
+    return wrapper
+
+class _ProfiledCursor(sqlite3.Cursor):
+    # Um comando que retorna linhas só é contabilizado quando termina de ser
+    # lido (fetchall, fetchmany parcial, fim da iteração) ou no próximo execute.
+    _pending = None
+
+    def _finish(self, error=False):
+        p = self._pending
+        if p is not None:
+            self._pending = None
+            profiler.record_query(self.connection, *p, error=error)
+
+    def _fetched(self, t0, n, done):
+        p = self._pending
+        if p is not None:
+            p[2] += time.perf_counter() - t0
+            p[3] += n
+            if done:
+                self._finish()
+
+    def execute(self, sql, params=()):
+        self._finish()
+        t0 = time.perf_counter()
+        try:
+            super().execute(sql, params)
+        except sqlite3.Error:
+            profiler.record_query(self.connection, sql, None, time.perf_counter() - t0, error=True)
+            raise
+        self._pending = [sql, params, time.perf_counter() - t0, 0]
+        if self.description is None:
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq):
+        self._finish()
+        t0 = time.perf_counter()
+        try:
+            super().executemany(sql, seq)
+        except sqlite3.Error:
+            profiler.record_query(self.connection, sql, None, time.perf_counter() - t0, error=True)
+            raise
+        profiler.record_query(self.connection, sql, None, time.perf_counter() - t0, max(self.rowcount, 0))
+        return self
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(t0, row is not None, True)
+        return row
+
+    def fetchmany(self, size=None):
+        size = self.arraysize if size is None else size
+        t0 = time.perf_counter()
+        rows = super().fetchmany(size)
+        self._fetched(t0, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(t0, len(rows), True)
+        return rows
+
+    def __next__(self):
+        t0 = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._fetched(t0, 0, True)
+            raise
+        self._fetched(t0, 1, False)
+        return row
+
+class _ProfiledConnection(sqlite3.Connection):
+    # Connection.execute não passa por cursor(); por isso os três são redefinidos
+    def cursor(self, factory=_ProfiledCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
 
-HAS_TKCAL = True
-try:
-    from tkcalendar import DateEntry
-except Exception:
-    HAS_TKCAL = False
+    def executemany(self, sql, seq):
+        return self.cursor().executemany(sql, seq)
+
+if os.environ.get("ESTOQUE_PERFIL", "") not in ("", "0"):
+    enable_profiling()
 
 
 # Banco de dados
 
-def get_connection():
-    conn = sqlite3.connect(DB_FILE)
+_local = threading.local()
+_all_conns = []
+_conns_lock = threading.Lock()
+_conns_generation = 0
+
+def _open_connection(path):
+    factory = _ProfiledConnection if profiler.enabled else sqlite3.Connection
+    conn = sqlite3.connect(path, timeout=10, check_same_thread=False,
+                           cached_statements=DB_STATEMENT_CACHE, factory=factory)
     conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA cache_size=-{DB_CACHE_KIB}")
+    conn.execute(f"PRAGMA mmap_size={DB_MMAP_BYTES}")
+    conn.execute("PRAGMA temp_store=MEMORY")
     return conn
 
+@profiled
+def get_connection():
+    """Conexão persistente da thread atual (uma por thread e por arquivo).
+
+    As conexões ficam abertas durante toda a vida do processo; não feche
+    a conexão retornada, use close_connections() no encerramento.
+    """
+    conns = getattr(_local, "conns", None)
+    if conns is None:
+        conns = _local.conns = {}
+    key = (DB_FILE, _conns_generation)
+    conn = conns.get(key)
+    if conn is None:
+        conn = conns[key] = _open_connection(DB_FILE)
+        with _conns_lock:
+            _all_conns.append(conn)
+    return conn
+
+def close_connections():
+    global _conns_generation
+    with _conns_lock:
+        conns = list(_all_conns)
+        _all_conns.clear()
+        _conns_generation += 1
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+atexit.register(close_connections)
+
+# Estoque mínimo padrão de um produto novo (abaixo disso aparece em "estoque baixo")
+LOW_STOCK_DEFAULT = 5
+
+# Preenche daily_movements a partir de transactions
+ROLLUP_BACKFILL = """INSERT INTO daily_movements (product_id, day, in_qty, out_qty)
+    SELECT product_id, date(created_at),
+           SUM(CASE WHEN type='in' THEN quantity ELSE 0 END),
+           SUM(CASE WHEN type='in' THEN 0 ELSE quantity END)
+    FROM transactions WHERE created_at IS NOT NULL
+    GROUP BY product_id, date(created_at)"""
+
+def _create_search_index(conn):
+    """Índice FTS5 sobre products.name, mantido por triggers; sem FTS5 a busca usa LIKE."""
+    for tokenize in ("unicode61 remove_diacritics 2", "unicode61 remove_diacritics 1"):
+        try:
+            conn.execute(f"""CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+                                 name, content='products', content_rowid='id',
+                                 tokenize='{tokenize}', prefix='2 3')""")
+            break
+        except sqlite3.OperationalError:
+            continue
+    else:
+        return
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+                        INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+                        INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                    END""")
+    conn.execute("""CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name ON products BEGIN
+                        INSERT INTO products_fts(products_fts, rowid, name) VALUES ('delete', old.id, old.name);
+                        INSERT INTO products_fts(rowid, name) VALUES (new.id, new.name);
+                    END""")
+    conn.execute("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+
+# Migrações de esquema: MIGRATIONS[i] leva o banco da versão i para i+1
+# (PRAGMA user_version). Cada passo é um SQL ou uma função que recebe a conexão.
+# Nunca altere uma migração já publicada; acrescente outra.
+MIGRATIONS = [
+    # 1: tabelas base
+    (
+        """CREATE TABLE IF NOT EXISTS products (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            quantity INTEGER DEFAULT 0,
+            price REAL DEFAULT 0,
+            expiry_date TEXT,
+            created_at TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS transactions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            type TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            created_at TEXT,
+            note TEXT,
+            FOREIGN KEY(product_id) REFERENCES products(id)
+        )""",
+    ),
+    # 2: índices para histórico por produto, histórico geral e ordenação por nome
+    (
+        "CREATE INDEX IF NOT EXISTS idx_transactions_product_created ON transactions(product_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_created ON transactions(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_products_name ON products(name)",
+    ),
+    # 3: resumo diário de movimentações por produto, preenchido a partir do histórico
+    (
+        """CREATE TABLE IF NOT EXISTS daily_movements (
+            product_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            in_qty INTEGER NOT NULL DEFAULT 0,
+            out_qty INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (product_id, day)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_daily_movements_day ON daily_movements(day)",
+        ROLLUP_BACKFILL,
+    ),
+    # 4: busca por nome com FTS5 (prefixo, sem acentos, ordenada por relevância)
+    (
+        _create_search_index,
+    ),
+    # 5: estoque mínimo por produto e indicadores do resumo mantidos por triggers
+    (
+        f"ALTER TABLE products ADD COLUMN min_quantity INTEGER NOT NULL DEFAULT {LOW_STOCK_DEFAULT}",
+        "CREATE INDEX IF NOT EXISTS idx_products_low_stock ON products(quantity - min_quantity)",
+        """CREATE TABLE IF NOT EXISTS stock_summary (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_products INTEGER NOT NULL,
+            total_units INTEGER NOT NULL,
+            low_stock INTEGER NOT NULL
+        )""",
+        """INSERT OR REPLACE INTO stock_summary (id, total_products, total_units, low_stock)
+           SELECT 1, COUNT(*), COALESCE(SUM(quantity), 0),
+                  COALESCE(SUM(COALESCE(quantity, 0) <= min_quantity), 0)
+           FROM products""",
+        """CREATE TRIGGER IF NOT EXISTS stock_summary_ai AFTER INSERT ON products BEGIN
+               UPDATE stock_summary SET
+                   total_products = total_products + 1,
+                   total_units = total_units + COALESCE(new.quantity, 0),
+                   low_stock = low_stock + (COALESCE(new.quantity, 0) <= new.min_quantity)
+               WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS stock_summary_ad AFTER DELETE ON products BEGIN
+               UPDATE stock_summary SET
+                   total_products = total_products - 1,
+                   total_units = total_units - COALESCE(old.quantity, 0),
+                   low_stock = low_stock - (COALESCE(old.quantity, 0) <= old.min_quantity)
+               WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS stock_summary_au AFTER UPDATE OF quantity, min_quantity ON products BEGIN
+               UPDATE stock_summary SET
+                   total_units = total_units + COALESCE(new.quantity, 0) - COALESCE(old.quantity, 0),
+                   low_stock = low_stock + (COALESCE(new.quantity, 0) <= new.min_quantity)
+                                         - (COALESCE(old.quantity, 0) <= old.min_quantity)
+               WHERE id = 1;
+           END""",
+    ),
+    # 6: validade consultada por faixa (só produtos com estoque; quantity e price
+    # no índice para o valor em risco sair sem ler a tabela)
+    (
+        "UPDATE products SET expiry_date = NULL WHERE TRIM(expiry_date) = ''",
+        """CREATE INDEX IF NOT EXISTS idx_products_expiry ON products(expiry_date, quantity, price)
+           WHERE expiry_date IS NOT NULL AND quantity > 0""",
+    ),
+    # 7: lotes com validade própria, consumidos na ordem FEFO; o estoque atual
+    # de cada produto vira um lote inicial com a validade do cadastro
+    (
+        """CREATE TABLE IF NOT EXISTS lots (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            code TEXT,
+            expiry_date TEXT,
+            qty_remaining INTEGER NOT NULL,
+            created_at TEXT,
+            FOREIGN KEY(product_id) REFERENCES products(id)
+        )""",
+        """CREATE INDEX IF NOT EXISTS idx_lots_fefo ON lots(product_id, COALESCE(expiry_date, '9999-12-31'))
+           WHERE qty_remaining > 0""",
+        """INSERT INTO lots (product_id, code, expiry_date, qty_remaining, created_at)
+           SELECT id, 'INICIAL', expiry_date, quantity, created_at FROM products WHERE quantity > 0""",
+    ),
+    # 8: fechamentos (saldo e preço de cada produto ao fim de um dia)
+    (
+        """CREATE TABLE IF NOT EXISTS stock_snapshots (
+            day TEXT NOT NULL,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL,
+            PRIMARY KEY (day, product_id)
+        ) WITHOUT ROWID""",
+    ),
+    # 9: arquivamento do histórico (totais do que saiu do banco ativo e controle)
+    (
+        """CREATE TABLE IF NOT EXISTS archived_balances (
+            product_id INTEGER PRIMARY KEY,
+            in_qty INTEGER NOT NULL DEFAULT 0,
+            out_qty INTEGER NOT NULL DEFAULT 0,
+            movements INTEGER NOT NULL DEFAULT 0,
+            last_at TEXT
+        )""",
+        """CREATE TABLE IF NOT EXISTS archive_state (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            path TEXT NOT NULL,
+            cutoff TEXT,
+            archived_through TEXT,
+            archived INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT
+        )""",
+    ),
+    # 10: validade lida dos lotes (products.expiry_date é só a do primeiro lote aberto)
+    (
+        """CREATE INDEX IF NOT EXISTS idx_lots_expiry ON lots(expiry_date, product_id, qty_remaining)
+           WHERE expiry_date IS NOT NULL AND qty_remaining > 0""",
+        "DROP INDEX IF EXISTS idx_products_expiry",
+    ),
+    # 11: contador de alterações em products, para o cache de produtos separar
+    # o que este processo gravou do que outros processos gravaram
+    (
+        "CREATE TABLE IF NOT EXISTS product_changes (id INTEGER PRIMARY KEY CHECK (id = 1), n INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO product_changes (id, n) VALUES (1, 0)",
+        """CREATE TRIGGER IF NOT EXISTS product_changes_ai AFTER INSERT ON products BEGIN
+               UPDATE product_changes SET n = n + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS product_changes_ad AFTER DELETE ON products BEGIN
+               UPDATE product_changes SET n = n + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS product_changes_au AFTER UPDATE ON products BEGIN
+               UPDATE product_changes SET n = n + 1 WHERE id = 1;
+           END""",
+    ),
+    # 12: geração dos relatórios, que muda quando o histórico ou o resumo diário
+    # mudam de um jeito que não é só acréscimo (o cache de relatórios recarrega)
+    (
+        "CREATE TABLE IF NOT EXISTS report_changes (id INTEGER PRIMARY KEY CHECK (id = 1), n INTEGER NOT NULL)",
+        "INSERT OR IGNORE INTO report_changes (id, n) VALUES (1, 0)",
+        """CREATE TRIGGER IF NOT EXISTS report_changes_td AFTER DELETE ON transactions BEGIN
+               UPDATE report_changes SET n = n + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS report_changes_tu AFTER UPDATE ON transactions BEGIN
+               UPDATE report_changes SET n = n + 1 WHERE id = 1;
+           END""",
+        """CREATE TRIGGER IF NOT EXISTS report_changes_pn AFTER UPDATE OF name ON products
+               WHEN old.name IS NOT new.name BEGIN
+               UPDATE report_changes SET n = n + 1 WHERE id = 1;
+           END""",
+    ),
+]
+
+@profiled
+def migrate(conn, target=None):
+    """Aplica as migrações pendentes, uma transação por versão. Retorna a versão final."""
+    target = len(MIGRATIONS) if target is None else target
+    while True:
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if version >= target:
+                return version
+            for stmt in MIGRATIONS[version]:
+                stmt(conn) if callable(stmt) else conn.execute(stmt)
+            conn.execute(f"PRAGMA user_version={version + 1}")
+            _search_index.pop(DB_FILE, None)
+
 def init_db():
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS products (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT NOT NULL,
-        quantity INTEGER DEFAULT 0,
-        price REAL DEFAULT 0,
-        expiry_date TEXT,
-        created_at TEXT
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS transactions (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        product_id INTEGER NOT NULL,
-        type TEXT NOT NULL,
-        quantity INTEGER NOT NULL,
-        created_at TEXT,
-        note TEXT,
-        FOREIGN KEY(product_id) REFERENCES products(id)
-    )
-    """)
-    conn.commit()
-    conn.close()
+    migrate(get_connection())
 
 # Operações DB
 
-def add_product(name, quantity, price, expiry_date):
-    now = datetime.datetime.now().isoformat()
+# Notificação de alterações: cada listener recebe (kind, ids) depois do commit.
+# kind é "added", "updated", "deleted", "moved" (movimentação de estoque) ou
+# "archived" (histórico movido para o arquivo, ids vazio);
+# ids é o conjunto de product_id afetados. Pode ser chamado de qualquer thread.
+_listeners = []
+
+def subscribe(fn):
+    _listeners.append(fn)
+
+def unsubscribe(fn):
+    if fn in _listeners:
+        _listeners.remove(fn)
+
+def _notify(kind, ids):
+    for fn in list(_listeners):
+        fn(kind, set(ids))
+
+# Soma uma movimentação ao resumo diário (daily_movements) na mesma transação
+ROLLUP_UPSERT = """INSERT INTO daily_movements (product_id, day, in_qty, out_qty) VALUES (?,?,?,?)
+                   ON CONFLICT(product_id, day) DO UPDATE SET
+                       in_qty = in_qty + excluded.in_qty,
+                       out_qty = out_qty + excluded.out_qty"""
+
+# Recalcula daily_movements só a partir de um dia (os anteriores já foram arquivados)
+ROLLUP_REBUILD_FROM = """INSERT INTO daily_movements (product_id, day, in_qty, out_qty)
+    SELECT product_id, date(created_at),
+           SUM(CASE WHEN type='in' THEN quantity ELSE 0 END),
+           SUM(CASE WHEN type='in' THEN 0 ELSE quantity END)
+    FROM transactions WHERE created_at >= ?
+    GROUP BY product_id, date(created_at)"""
+
+@profiled
+def rebuild_daily_movements():
+    """Recalcula daily_movements a partir de transactions. Retorna o número de linhas.
+
+    Com histórico arquivado, os dias até o último arquivado ficam como estão:
+    suas movimentações já não estão em transactions.
+    """
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""INSERT INTO products (name,quantity,price,expiry_date,created_at)
-                   VALUES (?,?,?,?,?)""", (name, quantity, price, expiry_date, now))
-    conn.commit()
-    pid = cur.lastrowid
-    conn.close()
-    return pid
-
-def update_product(pid, name, quantity, price, expiry_date):
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""UPDATE products SET name=?, quantity=?, price=?, expiry_date=? WHERE id=?""",
-                (name, quantity, price, expiry_date, pid))
-    conn.commit()
-    conn.close()
-
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute("SELECT archived_through FROM archive_state WHERE id=1").fetchone()
+        if row is None or row[0] is None:
+            conn.execute("DELETE FROM daily_movements")
+            conn.execute(ROLLUP_BACKFILL)
+        else:
+            first = (datetime.date.fromisoformat(row[0][:10]) + datetime.timedelta(days=1)).isoformat()
+            conn.execute("DELETE FROM daily_movements WHERE day >= ?", (first,))
+            conn.execute(ROLLUP_REBUILD_FROM, (first,))
+        # sem trigger em daily_movements: o DELETE da tabela inteira continua rápido
+        conn.execute("UPDATE report_changes SET n = n + 1 WHERE id = 1")
+        n = conn.execute("SELECT COUNT(*) FROM daily_movements").fetchone()[0]
+    report_cache.clear()
+    return n
+
+# Cache de produtos em memória
+
+class ProductRecord:
+    """Produto em memória; aceita p["campo"] como um sqlite3.Row. Trate como imutável."""
+    __slots__ = ("id", "name", "quantity", "price", "expiry_date", "created_at", "min_quantity")
+
+    def __init__(self, id, name, quantity, price, expiry_date, created_at, min_quantity=LOW_STOCK_DEFAULT):
+        self.id = id
+        self.name = name
+        self.quantity = quantity
+        self.price = price
+        self.expiry_date = expiry_date
+        self.created_at = created_at
+        self.min_quantity = min_quantity
+
+    @classmethod
+    def from_row(cls, row):
+        return cls(*(row[k] for k in cls.__slots__))
+
+    def replace(self, **changes):
+        values = {k: getattr(self, k) for k in self.__slots__}
+        values.update(changes)
+        return ProductRecord(**values)
+
+    def keys(self):
+        return self.__slots__
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __repr__(self):
+        return f"ProductRecord(id={self.id!r}, name={self.name!r}, quantity={self.quantity!r})"
+
+class ProductCache:
+    """Cache LRU de produtos por id, atualizado pelas funções de escrita deste módulo.
+
+    Triggers contam as alterações em products (product_changes.n). Cada
+    transação deste processo informa em own_commit o trecho do contador que
+    gerou, e os produtos que ela alterou já foram atualizados no cache. Quando
+    PRAGMA data_version muda e o contador passou do que este processo explica,
+    outro processo alterou produtos e o cache é esvaziado.
+    """
+    def __init__(self, maxsize=5000):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = None
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._changes = None  # valor de product_changes.n com o qual o cache está coerente
+        self._own = {}  # commits deste processo ainda não alcançados: n antes -> n depois
+
+    def validate(self, conn):
+        version = conn.execute("PRAGMA data_version").fetchone()[0]
+        seen = getattr(_local, "data_versions", None)
+        if seen is None:
+            seen = _local.data_versions = {}
+        key = (DB_FILE, _conns_generation, id(conn))
+        if seen.get(key) == version:
+            return
+        changes = _product_changes(conn)
+        with self._lock:
+            self._check_db()
+            self._advance()
+            if changes != self._changes:
+                # alteração que não veio deste processo (ou ainda não registrada nele)
+                self._items.clear()
+                self.invalidations += 1
+                self._changes = changes
+                self._own = {k: v for k, v in self._own.items() if k > changes}
+        seen[key] = version
+
+    def own_commit(self, before, after):
+        """Registra que um commit deste processo levou o contador de `before` a `after`."""
+        if before == after:
+            return
+        with self._lock:
+            self._check_db()
+            if self._changes is not None and before >= self._changes:
+                self._own[before] = after
+                self._advance()
+
+    def _advance(self):
+        while self._changes in self._own:
+            self._changes = self._own.pop(self._changes)
+
+    def _check_db(self):
+        if self._db != DB_FILE:
+            self._items.clear()
+            self._changes = None
+            self._own = {}
+            self._db = DB_FILE
+
+    def get(self, pid):
+        with self._lock:
+            rec = self._items.get(pid)
+            if rec is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._items.move_to_end(pid)
+            return rec
+
+    def put(self, rec):
+        with self._lock:
+            self._check_db()
+            self._items[rec.id] = rec
+            self._items.move_to_end(rec.id)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def update(self, pid, **changes):
+        """Aplica alterações a um produto já em cache (sem efeito se não estiver)."""
+        with self._lock:
+            rec = self._items.get(pid)
+            if rec is not None:
+                self._items[pid] = rec.replace(**changes)
+
+    def discard(self, pid):
+        with self._lock:
+            self._items.pop(pid, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations,
+                    "hit_rate": self.hits / total if total else 0.0}
+
+product_cache = ProductCache()
+
+def _product_changes(conn):
+    return conn.execute("SELECT n FROM product_changes").fetchone()[0]
+
+@contextlib.contextmanager
+def _product_write(conn):
+    """Transação BEGIN IMMEDIATE que altera products; entrega o cursor.
+
+    Lê product_changes no início e no fim (com a escrita bloqueada para os
+    outros) para o cache saber que esse trecho do contador é deste processo.
+    """
+    with conn:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE")
+        before = _product_changes(cur)
+        yield cur
+        after = _product_changes(cur)
+    product_cache.own_commit(before, after)
+
+# Observações das movimentações geradas pelo cadastro
+INITIAL_STOCK_NOTE = "Estoque inicial"
+ADJUST_NOTE = "Ajuste de cadastro"
+
+def _insert_product(cur, name, quantity, price, expiry_date, min_quantity, now):
+    """Corpo de add_product, dentro de uma transação já aberta. Retorna o ProductRecord."""
+    cur.execute("""INSERT INTO products (name,quantity,price,expiry_date,created_at,min_quantity)
+                   VALUES (?,0,?,?,?,?)""", (name, price, expiry_date, now, min_quantity))
+    rec = ProductRecord(cur.lastrowid, name, 0, price, expiry_date, now, min_quantity)
+    if quantity and quantity > 0:
+        rec = rec.replace(quantity=_move_stock(cur, rec.id, quantity, "in", INITIAL_STOCK_NOTE, now,
+                                               expiry_date=expiry_date))
+    return rec
+
+def _product_added(rec):
+    product_cache.put(rec)
+    _notify("added", {rec.id})
+
+@profiled
+def add_product(name, quantity, price, expiry_date, min_quantity=LOW_STOCK_DEFAULT):
+    """Inclui o produto; a quantidade inicial entra como movimentação e primeiro lote."""
+    now = datetime.datetime.now().isoformat()
+    with _product_write(get_connection()) as cur:
+        rec = _insert_product(cur, name, quantity, price, expiry_date, min_quantity, now)
+    _product_added(rec)
+    return rec.id
+
+@profiled
+def update_product(pid, name, quantity, price, expiry_date, min_quantity=None):
+    """Atualiza o cadastro; min_quantity=None mantém o estoque mínimo atual.
+
+    Uma quantidade diferente da atual é registrada como movimentação
+    "Ajuste de cadastro" (lotes e histórico continuam batendo com o saldo);
+    uma validade diferente passa para o primeiro lote aberto.
+    """
+    now = datetime.datetime.now().isoformat()
+    # BEGIN IMMEDIATE: o saldo lido é a base do ajuste, nada pode mudar até o commit
+    with _product_write(get_connection()) as cur:
+        cur.execute("SELECT quantity, expiry_date FROM products WHERE id=?", (pid,))
+        old = cur.fetchone()
+        if old is None:
+            return
+        cur.execute("UPDATE products SET name=?, price=?, min_quantity=COALESCE(?, min_quantity) WHERE id=?",
+                    (name, price, min_quantity, pid))
+        if expiry_date != old["expiry_date"]:
+            cur.execute(f"""UPDATE lots SET expiry_date=? WHERE id = (
+                               SELECT id FROM lots WHERE product_id=? AND qty_remaining > 0
+                               ORDER BY {LOT_FEFO_ORDER} LIMIT 1)""", (expiry_date, pid))
+            if cur.rowcount == 0:
+                cur.execute("UPDATE products SET expiry_date=? WHERE id=?", (expiry_date, pid))
+            else:
+                _sync_product_expiry(cur, pid)
+        delta = (quantity or 0) - (old["quantity"] or 0)
+        if delta:
+            _move_stock(cur, pid, abs(delta), "in" if delta > 0 else "out", ADJUST_NOTE, now,
+                        expiry_date=expiry_date)
+        cur.execute("SELECT * FROM products WHERE id=?", (pid,))
+        rec = ProductRecord.from_row(cur.fetchone())
+    product_cache.put(rec)
+    _notify("updated", {pid})
+
+@profiled
 def delete_product(pid):
+    with _product_write(get_connection()) as cur:
+        cur.execute("DELETE FROM transactions WHERE product_id=?", (pid,))
+        cur.execute("DELETE FROM daily_movements WHERE product_id=?", (pid,))
+        cur.execute("DELETE FROM lots WHERE product_id=?", (pid,))
+        cur.execute("DELETE FROM archived_balances WHERE product_id=?", (pid,))
+        cur.execute("DELETE FROM products WHERE id=?", (pid,))
+    product_cache.discard(pid)
+    report_cache.clear()
+    _notify("deleted", {pid})
+
+_search_index = {}
+
+def has_search_index():
+    """Se o banco atual tem o índice FTS5 de produtos (verificado uma vez por arquivo)."""
+    ready = _search_index.get(DB_FILE)
+    if ready is None:
+        row = get_connection().execute("SELECT 1 FROM sqlite_master WHERE name='products_fts'").fetchone()
+        ready = _search_index[DB_FILE] = row is not None
+    return ready
+
+def _fts_match(search):
+    # cada palavra vira um prefixo entre aspas: "arr"* "int"*
+    tokens = re.findall(r"\w+", search)
+    return " ".join(f'"{t}"*' for t in tokens) or None
+
+def _products_source(search):
+    """(FROM/WHERE, parâmetros, ORDER BY) da listagem de produtos."""
+    if search:
+        match = _fts_match(search) if has_search_index() else None
+        if match:
+            return (" FROM products_fts f JOIN products p ON p.id = f.rowid WHERE products_fts MATCH ?",
+                    [match], " ORDER BY f.rank, p.name")
+        return " FROM products p WHERE p.name LIKE ?", [f"%{search}%"], " ORDER BY p.name"
+    return " FROM products p", [], " ORDER BY p.name"
+
+def _products_query(search=None, limit=None, offset=None):
+    source, params, order = _products_source(search)
+    sql = "SELECT p.*" + source + order
+    if limit or offset:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit if limit else -1, offset or 0]
+    return sql, params
+
+@profiled
+def get_products(search=None, limit=None, offset=None):
+    """Produtos por nome; com search, busca por prefixo das palavras, mais relevantes primeiro."""
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM transactions WHERE product_id=?", (pid,))
-    cur.execute("DELETE FROM products WHERE id=?", (pid,))
-    conn.commit()
-    conn.close()
-
-def get_products(search=None):
-    conn = get_connection()
-    cur = conn.cursor()
-    if search:
-        s = f"%{search}%"
-        cur.execute("SELECT * FROM products WHERE name LIKE ? ORDER BY name", (s,))
-    else:
-        cur.execute("SELECT * FROM products ORDER BY name")
+    cur.execute(*_products_query(search, limit, offset))
     rows = cur.fetchall()
-    conn.close()
     return rows
 
-def get_product(pid):
+@profiled
+def count_products(search=None):
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM products WHERE id=?", (pid,))
-    row = cur.fetchone()
-    conn.close()
-    return row
-
-def change_stock(pid, amount, ttype, note=""):
-    prod = get_product(pid)
-    if not prod:
-        raise ValueError("Produto não encontrado.")
-    new_q = prod["quantity"] + (amount if ttype == "in" else -amount)
-    if new_q < 0:
-        raise ValueError("Quantidade insuficiente.")
+    source, params, _ = _products_source(search)
+    return conn.execute("SELECT COUNT(*)" + source, params).fetchone()[0]
+
+@profiled
+def get_product(pid):
+    """ProductRecord do produto (do cache quando possível) ou None."""
     conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE products SET quantity=? WHERE id=?", (new_q, pid))
+    product_cache.validate(conn)
+    rec = product_cache.get(pid)
+    if rec is None:
+        cur = conn.cursor()
+        cur.execute("SELECT * FROM products WHERE id=?", (pid,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        rec = ProductRecord.from_row(row)
+        product_cache.put(rec)
+    return rec
+
+@profiled
+def get_stock_summary():
+    """(total de produtos, unidades em estoque, produtos com estoque baixo), mantidos por triggers."""
+    row = get_connection().execute(
+        "SELECT total_products, total_units, low_stock FROM stock_summary WHERE id=1").fetchone()
+    return tuple(row) if row else (0, 0, 0)
+
+@profiled
+def get_low_stock(limit=12):
+    """Produtos com quantidade <= estoque mínimo, os mais abaixo do mínimo primeiro."""
+    return get_connection().execute(
+        """SELECT * FROM products WHERE quantity - min_quantity <= 0
+           ORDER BY quantity - min_quantity LIMIT ?""", (limit,)).fetchall()
+
+# Horizonte padrão do alerta de validade, em dias
+EXPIRY_WARNING_DAYS = 30
+
+def _expiry_where(days, include_expired):
+    # mesmas condições do índice parcial idx_lots_expiry, mais a faixa de datas
+    today = datetime.date.today()
+    where = " WHERE l.expiry_date IS NOT NULL AND l.qty_remaining > 0 AND l.expiry_date <= ?"
+    params = [(today + datetime.timedelta(days=days)).isoformat()]
+    if not include_expired:
+        where += " AND l.expiry_date >= ?"
+        params.append(today.isoformat())
+    return where, params
+
+@profiled
+def get_expiring(days=EXPIRY_WARNING_DAYS, include_expired=False, limit=None, offset=None):
+    """Lotes com saldo que vencem em até `days` dias, o vencimento mais próximo primeiro.
+
+    Cada linha traz os campos do produto, lot_id, lot e, do lote, expiry_date,
+    quantity e value_at_risk (quantity * price). Com include_expired também
+    os já vencidos.
+    """
+    where, params = _expiry_where(days, include_expired)
+    sql = """SELECT p.id, p.name, p.price, p.min_quantity, l.id AS lot_id, l.code AS lot,
+                    l.expiry_date, l.qty_remaining AS quantity, l.qty_remaining * p.price AS value_at_risk
+             FROM lots l JOIN products p ON p.id = l.product_id""" + where + " ORDER BY l.expiry_date, l.id"
+    if limit or offset:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit if limit else -1, offset or 0]
+    return get_connection().execute(sql, params).fetchall()
+
+def get_expired(limit=None, offset=None):
+    """Lotes com saldo e validade anterior a hoje."""
+    return get_expiring(-1, True, limit, offset)
+
+@profiled
+def count_expiring(days=EXPIRY_WARNING_DAYS, include_expired=False):
+    """Número de lotes de get_expiring."""
+    where, params = _expiry_where(days, include_expired)
+    return get_connection().execute("SELECT COUNT(*) FROM lots l" + where, params).fetchone()[0]
+
+@profiled
+def get_expiry_summary(days=EXPIRY_WARNING_DAYS):
+    """(produtos vencidos, valor vencido, produtos vencendo em `days` dias, valor vencendo).
+
+    Conta só o saldo dos lotes que de fato vencem, numa só varredura do índice.
+    """
+    where, params = _expiry_where(days, True)
+    today = datetime.date.today().isoformat()
+    row = get_connection().execute(
+        """SELECT COUNT(DISTINCT CASE WHEN l.expiry_date < ? THEN l.product_id END),
+                  COALESCE(SUM(CASE WHEN l.expiry_date < ? THEN l.qty_remaining * p.price END), 0),
+                  COUNT(DISTINCT CASE WHEN l.expiry_date >= ? THEN l.product_id END),
+                  COALESCE(SUM(CASE WHEN l.expiry_date >= ? THEN l.qty_remaining * p.price END), 0)
+           FROM lots l JOIN products p ON p.id = l.product_id""" + where, [today] * 4 + params).fetchone()
+    return tuple(row)
+
+# Lotes
+#
+# products.quantity continua sendo o saldo (mantido a cada movimentação) e
+# products.expiry_date a validade do primeiro lote aberto; lots guarda o saldo
+# de cada lote. Ordem FEFO: validade mais próxima primeiro, lotes sem validade
+# por último, empate pelo mais antigo (mesma expressão do índice idx_lots_fefo).
+LOT_FEFO_ORDER = "COALESCE(expiry_date, '9999-12-31'), id"
+
+def _lots_in(cur, pid, amount, lot, expiry_date, now):
+    # soma ao lote aberto de mesmo código e validade, se houver (a igualdade
+    # pela expressão do índice evita ordenar os lotes do produto)
+    cur.execute("""UPDATE lots SET qty_remaining = qty_remaining + ? WHERE id = (
+                       SELECT id FROM lots WHERE product_id=? AND qty_remaining > 0
+                       AND COALESCE(expiry_date, '9999-12-31') = COALESCE(?, '9999-12-31')
+                       AND code IS ? AND expiry_date IS ? ORDER BY id DESC LIMIT 1)""",
+                (amount, pid, expiry_date, lot, expiry_date))
+    if cur.rowcount == 0:
+        cur.execute("INSERT INTO lots (product_id, code, expiry_date, qty_remaining, created_at) VALUES (?,?,?,?,?)",
+                    (pid, lot, expiry_date, amount, now))
+
+def _lots_out(cur, pid, amount):
+    """Baixa amount dos lotes abertos em ordem FEFO; True se algum lote zerou."""
+    taken, exhausted = [], False
+    cur.execute(f"SELECT id, qty_remaining FROM lots WHERE product_id=? AND qty_remaining > 0 ORDER BY {LOT_FEFO_ORDER}",
+                (pid,))
+    for lot_id, qty in cur:
+        take = min(qty, amount)
+        taken.append((take, lot_id))
+        exhausted = exhausted or take == qty
+        amount -= take
+        if not amount:
+            break
+    if len(taken) == 1:
+        cur.execute("UPDATE lots SET qty_remaining = qty_remaining - ? WHERE id=?", taken[0])
+    elif taken:
+        cur.executemany("UPDATE lots SET qty_remaining = qty_remaining - ? WHERE id=?", taken)
+    return exhausted
+
+def _sync_product_expiry(cur, pid):
+    """Copia a validade do primeiro lote aberto para o produto; True se mudou."""
+    cur.execute(f"""UPDATE products SET expiry_date = (
+                        SELECT expiry_date FROM lots WHERE product_id=? AND qty_remaining > 0
+                        ORDER BY {LOT_FEFO_ORDER} LIMIT 1)
+                    WHERE id=? AND EXISTS (SELECT 1 FROM lots WHERE product_id=? AND qty_remaining > 0)
+                      AND expiry_date IS NOT (
+                        SELECT expiry_date FROM lots WHERE product_id=? AND qty_remaining > 0
+                        ORDER BY {LOT_FEFO_ORDER} LIMIT 1)""", (pid, pid, pid, pid))
+    return cur.rowcount > 0
+
+@profiled
+def get_lots(pid, open_only=True):
+    """Lotes do produto na ordem de consumo (FEFO)."""
+    where = " AND qty_remaining > 0" if open_only else ""
+    return get_connection().execute(
+        f"SELECT * FROM lots WHERE product_id=?{where} ORDER BY {LOT_FEFO_ORDER}", (pid,)).fetchall()
+
+def _reconcile_lots(cur, ids, now):
+    """Acerta os lotes dos produtos `ids` com o saldo e a validade gravados direto em products (importação).
+
+    A validade do produto passa para o primeiro lote aberto, saldo a mais vira
+    um lote "AJUSTE" e saldo a menos é baixado em ordem FEFO. Roda na mesma
+    transação que gravou os produtos.
+    """
+    ids = list(ids)
+    changed = 0
+    for k in range(0, len(ids), 500):
+        chunk = ids[k:k+500]
+        marks = ",".join("?" * len(chunk))
+        cur.execute(f"""UPDATE lots SET expiry_date = (SELECT p.expiry_date FROM products p WHERE p.id = lots.product_id)
+                        WHERE id IN (
+                            SELECT f.id FROM (
+                                SELECT id, product_id, expiry_date, ROW_NUMBER() OVER (
+                                    PARTITION BY product_id ORDER BY {LOT_FEFO_ORDER}) AS n
+                                FROM lots WHERE qty_remaining > 0 AND product_id IN ({marks})) f
+                            JOIN products p ON p.id = f.product_id
+                            WHERE f.n = 1 AND p.expiry_date IS NOT NULL AND f.expiry_date IS NOT p.expiry_date)""",
+                    chunk)
+        cur.execute(f"""SELECT p.id, COALESCE(p.quantity, 0) - (
+                            SELECT COALESCE(SUM(qty_remaining), 0) FROM lots
+                            WHERE product_id = p.id AND qty_remaining > 0), p.expiry_date
+                        FROM products p WHERE p.id IN ({marks})""", chunk)
+        diffs = [r for r in cur.fetchall() if r[1]]
+        for pid, diff, expiry in diffs:
+            if diff > 0:
+                _lots_in(cur, pid, diff, "AJUSTE", expiry, now)
+            else:
+                _lots_out(cur, pid, -diff)
+        cur.execute(f"""UPDATE products SET expiry_date = (
+                            SELECT expiry_date FROM lots WHERE product_id = products.id AND qty_remaining > 0
+                            ORDER BY {LOT_FEFO_ORDER} LIMIT 1)
+                        WHERE id IN ({marks})
+                          AND EXISTS (SELECT 1 FROM lots WHERE product_id = products.id AND qty_remaining > 0)""",
+                    chunk)
+        changed += len(diffs)
+    return changed
+
+@profiled
+def change_stock(pid, amount, ttype, note="", lot=None, expiry_date=None):
+    """Aplica uma movimentação em uma única transação e retorna a nova quantidade.
+
+    O UPDATE só acontece se o saldo não ficar negativo, então não há
+    leitura prévia nem perda de atualização entre terminais concorrentes.
+    Entradas criam (ou somam a) um lote com código e validade; saídas baixam
+    os lotes de validade mais próxima primeiro.
+    """
     now = datetime.datetime.now().isoformat()
+    with _product_write(get_connection()) as cur:
+        new_q = _move_stock(cur, pid, amount, ttype, note, now, lot, expiry_date)
+    _stock_moved(pid, new_q)
+    return new_q
+
+def _move_stock(cur, pid, amount, ttype, note, now, lot=None, expiry_date=None):
+    """Corpo de change_stock, dentro de uma transação já aberta. Retorna a nova quantidade."""
+    if amount is None or amount <= 0:
+        raise ValueError("Quantidade deve ser positiva.")
+    if ttype not in ("in", "out"):
+        raise ValueError("Tipo deve ser 'in' ou 'out'.")
+    delta = amount if ttype == "in" else -amount
+    cur.execute("UPDATE products SET quantity = quantity + ? WHERE id=? AND quantity + ? >= 0",
+                (delta, pid, delta))
+    if cur.rowcount == 0:
+        cur.execute("SELECT 1 FROM products WHERE id=?", (pid,))
+        if cur.fetchone() is None:
+            raise ValueError("Produto não encontrado.")
+        raise ValueError("Quantidade insuficiente.")
+    cur.execute("SELECT quantity FROM products WHERE id=?", (pid,))
+    new_q = cur.fetchone()[0]
+    if ttype == "in":
+        _lots_in(cur, pid, amount, lot, expiry_date, now)
+        # lote sem validade vai para o fim da fila: só conta se o estoque estava zerado
+        check_expiry = expiry_date is not None or new_q == amount
+    else:
+        check_expiry = _lots_out(cur, pid, amount)
+    if check_expiry and _sync_product_expiry(cur, pid):
+        # a validade mudou: o registro sai do cache e é relido na próxima consulta
+        product_cache.discard(pid)
     cur.execute("INSERT INTO transactions (product_id,type,quantity,created_at,note) VALUES (?,?,?,?,?)",
                 (pid, ttype, amount, now, note))
-    conn.commit()
-    conn.close()
+    cur.execute(ROLLUP_UPSERT, (pid, now[:10], amount if ttype == "in" else 0, 0 if ttype == "in" else amount))
+    return new_q
+
+def _stock_moved(pid, new_q):
+    product_cache.update(pid, quantity=new_q)
+    _notify("moved", {pid})
+
+MOVEMENT_TYPES = {"in": "in", "out": "out", "entrada": "in", "saída": "out", "saida": "out"}
+
+@profiled
+def apply_movements(movements):
+    """Aplica um lote de movimentações (pid, qtd, tipo, observação[, lote, validade]) em uma transação.
+
+    Linhas inválidas ou que deixariam o estoque negativo são recusadas sem
+    afetar as demais. Retorna (aplicadas, falhas), onde falhas é uma lista
+    de (índice da linha, motivo).
+    """
+    rows, failures = [], []
+    for i, mv in enumerate(movements):
+        mv = tuple(mv) + (None,) * (6 - len(mv))
+        pid, qty, ttype, note, lot, expiry = mv[:6]
+        pid = safe_int(pid, None)
+        qty = safe_int(qty, 0)
+        ttype = MOVEMENT_TYPES.get(str(ttype or "").strip().lower())
+        if pid is None:
+            failures.append((i, "Produto inválido."))
+        elif qty <= 0:
+            failures.append((i, "Quantidade deve ser positiva."))
+        elif ttype is None:
+            failures.append((i, "Tipo deve ser 'in' ou 'out'."))
+        else:
+            rows.append((i, pid, qty, ttype, note or "", (lot or "").strip() or None, parse_date_str(expiry)))
+    if not rows:
+        return 0, failures
 
-def get_transactions(product_id=None, limit=None):
+    now = datetime.datetime.now().isoformat()
+    with _product_write(get_connection()) as cur:
+        stock = {}
+        pids = list({r[1] for r in rows})
+        for k in range(0, len(pids), 500):
+            chunk = pids[k:k+500]
+            cur.execute(f"SELECT id, quantity FROM products WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+            stock.update((r[0], r[1]) for r in cur.fetchall())
+        deltas, ledger, rollup = {}, [], {}
+        for i, pid, qty, ttype, note, lot, expiry in rows:
+            if pid not in stock:
+                failures.append((i, "Produto não encontrado."))
+                continue
+            delta = qty if ttype == "in" else -qty
+            if stock[pid] + delta < 0:
+                failures.append((i, "Quantidade insuficiente."))
+                continue
+            stock[pid] += delta
+            deltas[pid] = deltas.get(pid, 0) + delta
+            if ttype == "in":
+                _lots_in(cur, pid, qty, lot, expiry, now)
+            else:
+                _lots_out(cur, pid, qty)
+            ledger.append((pid, ttype, qty, now, note))
+            day = rollup.setdefault(pid, [0, 0])
+            day[0 if ttype == "in" else 1] += qty
+        cur.executemany("UPDATE products SET quantity = quantity + ? WHERE id=?",
+                        [(d, pid) for pid, d in deltas.items() if d])
+        cur.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) VALUES (?,?,?,?,?)",
+                        ledger)
+        cur.executemany(ROLLUP_UPSERT, [(pid, now[:10], q_in, q_out) for pid, (q_in, q_out) in rollup.items()])
+        expiry_changed = [pid for pid in deltas if _sync_product_expiry(cur, pid)]
+    failures.sort()
+    for pid in deltas:
+        product_cache.update(pid, quantity=stock[pid])
+    for pid in expiry_changed:
+        product_cache.discard(pid)
+    if ledger:
+        _notify("moved", deltas)
+    return len(ledger), failures
+
+@profiled
+def read_movements_csv(path):
+    """Lê movimentações de um CSV com colunas product_id, quantity, type, note e,
+    opcionais para entradas, lot e expiry_date."""
+    with open(path, newline='', encoding="utf-8-sig") as f:
+        return [(r.get("product_id"), r.get("quantity"), r.get("type"), r.get("note"),
+                 r.get("lot"), r.get("expiry_date"))
+                for r in csv.DictReader(f)]
+
+def _transactions_where(product_id=None, before=None, start=None, end=None, after=None):
+    where, params = [], []
+    if product_id:
+        where.append("t.product_id=?")
+        params.append(product_id)
+    if before:
+        # keyset: (created_at, id) da última linha da página anterior
+        where.append("(t.created_at, t.id) < (?, ?)")
+        params.extend(before)
+    if after:
+        # keyset para trás: (created_at, id) da primeira linha da página seguinte
+        where.append("(t.created_at, t.id) > (?, ?)")
+        params.extend(after)
+    if start:
+        where.append("t.created_at >= ?")
+        params.append(start.isoformat())
+    if end:
+        where.append("t.created_at < ?")
+        params.append((end + datetime.timedelta(days=1)).isoformat())
+    return (" WHERE " + " AND ".join(where) if where else ""), params
+
+def _transactions_query(product_id=None, limit=None, offset=None, before=None, start=None, end=None, after=None):
+    """SQL do histórico; com after a ordem é crescente (quem chama inverte)."""
+    where, params = _transactions_where(product_id, before, start, end, after)
+    sql = """SELECT t.*, p.name FROM transactions t
+             JOIN products p ON p.id = t.product_id""" + where
+    sql += " ORDER BY t.created_at, t.id" if after else " ORDER BY t.created_at DESC, t.id DESC"
+    if limit or offset:
+        sql += " LIMIT ? OFFSET ?"
+        params.extend((limit if limit else -1, offset or 0))
+    return sql, params
+
+@profiled
+def get_transactions(product_id=None, limit=None, offset=None, before=None, after=None):
+    """Histórico mais recente primeiro; limit/offset e before=(created_at, id) são aplicados no SQL.
+
+    after=(created_at, id) traz as `limit` linhas imediatamente mais novas que
+    a chave, também da mais recente para a mais antiga.
+    """
     conn = get_connection()
     cur = conn.cursor()
-    if product_id:
-        cur.execute("""SELECT t.*, p.name FROM transactions t
-                       JOIN products p ON p.id = t.product_id
-                       WHERE product_id=?
-                       ORDER BY created_at DESC""", (product_id,))
-    else:
-        cur.execute("""SELECT t.*, p.name FROM transactions t
-                       JOIN products p ON p.id = t.product_id
-                       ORDER BY created_at DESC""")
+    cur.execute(*_transactions_query(product_id, limit, offset, before, after=after))
     rows = cur.fetchall()
-    conn.close()
+    return rows[::-1] if after else rows
+
+@profiled
+def count_transactions(product_id=None, start=None, end=None):
+    where, params = _transactions_where(product_id, start=start, end=end)
+    return get_connection().execute("SELECT COUNT(*) FROM transactions t" + where, params).fetchone()[0]
+
+def iter_transactions(product_id=None, before=None, chunk_size=500, start=None, end=None):
+    """Itera o histórico sem carregá-lo inteiro na memória (start/end são datas, inclusive)."""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(*_transactions_query(product_id, before=before, start=start, end=end))
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield from rows
+
+
+# Relatórios (lidos do resumo diário): expressão SQL do início de cada período
+REPORT_BUCKETS = {
+    "day": "d.day",
+    "week": "date(d.day, 'weekday 0', '-6 days')",
+    "month": "date(d.day, 'start of month')",
+}
+
+def report_buckets(start, end, granularity="day"):
+    """Datas (ISO) de início de cada período entre start e end, inclusive."""
+    if granularity == "week":
+        d = start - datetime.timedelta(days=start.weekday())
+    elif granularity == "month":
+        d = start.replace(day=1)
+    else:
+        d = start
+    out = []
+    while d <= end:
+        out.append(d.isoformat())
+        if granularity == "week":
+            d += datetime.timedelta(days=7)
+        elif granularity == "month":
+            d = (d + datetime.timedelta(days=32)).replace(day=1)
+        else:
+            d += datetime.timedelta(days=1)
+    return out
+
+@profiled
+def get_movement_totals(start, end, granularity="day", product_id=None, by_product=False):
+    """Entradas e saídas somadas por período (bucket) entre start e end, a partir de daily_movements.
+
+    Com by_product=True cada linha traz também product_id e name.
+    """
+    bucket = REPORT_BUCKETS[granularity]
+    cols = f"{bucket} AS bucket"
+    group = "bucket"
+    join = ""
+    if by_product:
+        cols += ", d.product_id, p.name"
+        group += ", d.product_id"
+        join = " JOIN products p ON p.id = d.product_id"
+    sql = f"""SELECT {cols}, SUM(d.in_qty) AS in_qty, SUM(d.out_qty) AS out_qty
+              FROM daily_movements d{join}
+              WHERE d.day BETWEEN ? AND ?"""
+    params = [start.isoformat(), end.isoformat()]
+    if product_id:
+        sql += " AND d.product_id=?"
+        params.append(product_id)
+    sql += f" GROUP BY {group} ORDER BY bucket"
+    return get_connection().execute(sql, params).fetchall()
+
+@profiled
+def get_product_totals(start, end, limit=None):
+    """Entradas e saídas por produto entre start e end, maiores saídas primeiro."""
+    sql = """SELECT d.product_id, p.name, SUM(d.in_qty) AS in_qty, SUM(d.out_qty) AS out_qty
+             FROM daily_movements d JOIN products p ON p.id = d.product_id
+             WHERE d.day BETWEEN ? AND ?
+             GROUP BY d.product_id ORDER BY out_qty DESC, in_qty DESC"""
+    params = [start.isoformat(), end.isoformat()]
     if limit:
-        return rows[:limit]
-    return rows
+        sql += " LIMIT ?"
+        params.append(limit)
+    return get_connection().execute(sql, params).fetchall()
+
+@profiled
+def get_day_totals(day=None):
+    """(entradas, saídas) de um dia inteiro, padrão hoje."""
+    day = (day or datetime.date.today()).isoformat()
+    row = get_connection().execute("SELECT TOTAL(in_qty), TOTAL(out_qty) FROM daily_movements WHERE day=?",
+                                   (day,)).fetchone()
+    return int(row[0]), int(row[1])
+
+def _bucket_of(day, granularity):
+    """Início do período (como em REPORT_BUCKETS) que contém a data `day`."""
+    if granularity == "week":
+        return day - datetime.timedelta(days=day.weekday())
+    if granularity == "month":
+        return day.replace(day=1)
+    return day
+
+class ReportSeries:
+    """Séries de um relatório (últimos `days` dias, por `granularity`) até a movimentação last_id."""
+    __slots__ = ("db", "days", "granularity", "start", "end", "buckets", "index", "y_in", "y_out",
+                 "products", "last_id", "generation")
+
+    def top_products(self, limit):
+        rows = sorted(self.products.items(), key=lambda kv: (-kv[1][2], -kv[1][1]))[:limit]
+        return [{"product_id": pid, "name": name, "in_qty": q_in, "out_qty": q_out}
+                for pid, (name, q_in, q_out) in rows]
+
+class ReportCache:
+    """Séries de relatório em memória por (dias, agrupamento), válidas até a última movimentação lida.
+
+    Movimentações novas (id maior que last_id) são somadas só aos períodos e
+    produtos afetados. Exclusões, alterações no histórico, nomes trocados e a
+    reconstrução do resumo (de qualquer processo) mudam report_changes.n e,
+    como a virada do dia, recarregam a série do banco.
+    """
+    def __init__(self, maxsize=16):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.updates = 0
+        self.misses = 0
+
+    @profiled
+    def get(self, days, granularity, limit=50):
+        """(buckets, y_in, y_out, produtos com mais saídas) dos últimos `days` dias."""
+        key = (days, granularity)
+        end = datetime.date.today()
+        conn = get_connection()
+        with self._lock:
+            series = self._items.get(key)
+            with conn:
+                conn.execute("BEGIN")  # mesma leitura para last_id, geração e totais
+                last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM transactions").fetchone()[0]
+                generation = conn.execute("SELECT n FROM report_changes").fetchone()[0]
+                if (series is None or series.db != DB_FILE or series.end != end
+                        or series.generation != generation or last_id < series.last_id):
+                    series = self._load(conn, days, granularity, end, last_id)
+                    series.generation = generation
+                    self.misses += 1
+                elif last_id == series.last_id:
+                    self.hits += 1
+                else:
+                    self._apply(conn, series, last_id)
+                    self.updates += 1
+            self._items[key] = series
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+            return series.buckets, list(series.y_in), list(series.y_out), series.top_products(limit)
+
+    @staticmethod
+    def _load(conn, days, granularity, end, last_id):
+        series = ReportSeries()
+        series.db, series.days, series.granularity, series.end = DB_FILE, days, granularity, end
+        series.start = end - datetime.timedelta(days=days - 1)
+        series.buckets = report_buckets(series.start, end, granularity)
+        series.index = {d: i for i, d in enumerate(series.buckets)}
+        series.y_in = [0] * len(series.buckets)
+        series.y_out = [0] * len(series.buckets)
+        for r in get_movement_totals(series.start, end, granularity):
+            i = series.index[r["bucket"]]
+            series.y_in[i], series.y_out[i] = r["in_qty"], r["out_qty"]
+        series.products = {r["product_id"]: (r["name"], r["in_qty"], r["out_qty"])
+                           for r in get_product_totals(series.start, end)}
+        series.last_id = last_id
+        return series
+
+    @staticmethod
+    def _apply(conn, series, last_id):
+        start, end = series.start.isoformat(), series.end.isoformat()
+        for pid, ttype, qty, created in conn.execute(
+                """SELECT product_id, type, quantity, created_at FROM transactions
+                   WHERE id > ? AND id <= ? AND created_at IS NOT NULL""", (series.last_id, last_id)):
+            day = created[:10]
+            if not start <= day <= end:
+                continue
+            q_in, q_out = (qty, 0) if ttype == "in" else (0, qty)
+            i = series.index[_bucket_of(datetime.date.fromisoformat(day), series.granularity).isoformat()]
+            series.y_in[i] += q_in
+            series.y_out[i] += q_out
+            name, p_in, p_out = series.products.get(pid) or (None, 0, 0)
+            if name is None:
+                rec = get_product(pid)
+                name = rec["name"] if rec else str(pid)
+            series.products[pid] = (name, p_in + q_in, p_out + q_out)
+        series.last_id = last_id
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "updates": self.updates, "misses": self.misses}
+
+report_cache = ReportCache()
+
+
+# Posição de estoque em uma data
+#
+# stock_snapshots guarda o saldo de cada produto ao fim de um dia (fechamentos
+# mensais). A posição numa data parte da referência mais próxima (fechamento
+# anterior, fechamento posterior ou o saldo atual) e aplica só os totais de
+# daily_movements entre as duas datas, nunca o histórico inteiro. O valor usa
+# o preço gravado no fechamento de referência (ou o preço atual).
+
+def _as_of_query(conn, day):
+    """(colunas, FROM/WHERE, parâmetros) da posição ao fim de `day` (YYYY-MM-DD)."""
+    today = datetime.date.today().isoformat()
+    before = conn.execute("SELECT MAX(day) FROM stock_snapshots WHERE day <= ?", (day,)).fetchone()[0]
+    after = conn.execute("SELECT MIN(day) FROM stock_snapshots WHERE day > ? AND day < ?", (day, today)).fetchone()[0]
+    gap = lambda a, b: abs((datetime.date.fromisoformat(b) - datetime.date.fromisoformat(a)).days)
+    options = [(gap(day, today), "current", today)]
+    if before:
+        options.append((gap(before, day), "before", before))
+    if after:
+        options.append((gap(day, after), "after", after))
+    _, kind, base = min(options)
+    if kind == "current":
+        qty, price, join, params, lo, hi = "p.quantity - COALESCE(d.delta, 0)", "p.price", "", [], day, today
+    else:
+        sign = "+" if kind == "before" else "-"
+        qty = f"COALESCE(s.quantity, 0) {sign} COALESCE(d.delta, 0)"
+        price = "COALESCE(s.price, p.price)"
+        join = "LEFT JOIN stock_snapshots s ON s.day = ? AND s.product_id = p.id"
+        params = [base]
+        lo, hi = (base, day) if kind == "before" else (day, base)
+    columns = f"p.id, p.name, {qty} AS quantity, {price} AS price, ({qty}) * ({price}) AS value"
+    source = f""" FROM products p {join}
+        LEFT JOIN (SELECT product_id, SUM(in_qty - out_qty) AS delta FROM daily_movements
+                   WHERE day > ? AND day <= ? GROUP BY product_id) d ON d.product_id = p.id
+        WHERE COALESCE(NULLIF(substr(p.created_at, 1, 10), ''), ?) <= ?"""
+    return columns, source, params + [lo, hi, day, day]
+
+def _day_str(day):
+    return day.isoformat() if isinstance(day, datetime.date) else str(day)
+
+@profiled
+def stock_as_of(day, limit=None, offset=None):
+    """Quantidade, preço e valor de cada produto ao fim de `day`, por nome."""
+    conn = get_connection()
+    columns, source, params = _as_of_query(conn, _day_str(day))
+    sql = "SELECT " + columns + source + " ORDER BY p.name"
+    if limit or offset:
+        sql += " LIMIT ? OFFSET ?"
+        params += [limit if limit else -1, offset or 0]
+    return conn.execute(sql, params).fetchall()
+
+@profiled
+def stock_as_of_totals(day):
+    """(produtos, unidades, valor) ao fim de `day`."""
+    conn = get_connection()
+    columns, source, params = _as_of_query(conn, _day_str(day))
+    row = conn.execute(f"SELECT COUNT(*), TOTAL(quantity), TOTAL(value) FROM (SELECT {columns}{source})",
+                       params).fetchone()
+    return row[0], int(row[1]), row[2]
+
+@profiled
+def take_stock_snapshot(day):
+    """Grava (ou regrava) o fechamento de `day`. Retorna o número de produtos."""
+    day = _day_str(day)
+    conn = get_connection()
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        columns, source, params = _as_of_query(conn, day)
+        conn.execute("DELETE FROM stock_snapshots WHERE day=?", (day,))
+        cur = conn.execute(f"""INSERT INTO stock_snapshots (day, product_id, quantity, price)
+                               SELECT ?, id, quantity, price FROM (SELECT {columns}{source})""", [day] + params)
+        return cur.rowcount
+
+def month_ends(start, end):
+    """Últimos dias de cada mês entre start e end (datas), inclusive."""
+    days = []
+    d = datetime.date(start.year, start.month, 1)
+    while True:
+        nxt = datetime.date(d.year + d.month // 12, d.month % 12 + 1, 1)
+        last = nxt - datetime.timedelta(days=1)
+        if last > end:
+            return days
+        if last >= start:
+            days.append(last)
+        d = nxt
+
+@profiled
+def ensure_month_end_snapshots():
+    """Cria os fechamentos mensais que faltam até o último mês encerrado. Retorna quantos criou.
+
+    Vai do mês mais recente para o mais antigo, para cada fechamento partir do
+    seguinte (ou do saldo atual) e reaplicar só um mês de movimentações.
+    """
+    conn = get_connection()
+    first = conn.execute("SELECT MIN(day) FROM daily_movements").fetchone()[0]
+    if first is None:
+        return 0
+    today = datetime.date.today()
+    existing = {r[0] for r in conn.execute("SELECT DISTINCT day FROM stock_snapshots")}
+    missing = [d for d in month_ends(datetime.date.fromisoformat(first), today - datetime.timedelta(days=1))
+               if d.isoformat() not in existing]
+    for d in reversed(missing):
+        take_stock_snapshot(d)
+    return len(missing)
+
+
+# Arquivamento do histórico
+#
+# Movimentações antigas saem de transactions para um banco de arquivo separado
+# (anexado com ATTACH só durante a operação). No banco ativo ficam o resumo
+# diário (daily_movements, usado pelos relatórios e pela posição em uma data),
+# os fechamentos e, em archived_balances, os totais arquivados por produto.
+# Cada bloco é copiado e confirmado no arquivo antes de ser apagado do banco
+# ativo; repetir após uma interrupção não duplica nada.
+
+ARCHIVE_BATCH = 20000
+
+ARCHIVE_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS arquivo.transactions (
+        id INTEGER PRIMARY KEY,
+        product_id INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        quantity INTEGER NOT NULL,
+        created_at TEXT,
+        note TEXT
+    )""",
+    "CREATE INDEX IF NOT EXISTS arquivo.idx_archive_product_created ON transactions(product_id, created_at)",
+    "CREATE INDEX IF NOT EXISTS arquivo.idx_archive_created ON transactions(created_at)",
+]
+
+ARCHIVE_BALANCE_UPSERT = """INSERT INTO archived_balances (product_id, in_qty, out_qty, movements, last_at)
+    SELECT product_id,
+           SUM(CASE WHEN type='in' THEN quantity ELSE 0 END),
+           SUM(CASE WHEN type='in' THEN 0 ELSE quantity END),
+           COUNT(*), MAX(created_at)
+    FROM main.transactions WHERE id IN (SELECT id FROM temp.archive_ids)
+    GROUP BY product_id
+    ON CONFLICT(product_id) DO UPDATE SET
+        in_qty = in_qty + excluded.in_qty,
+        out_qty = out_qty + excluded.out_qty,
+        movements = movements + excluded.movements,
+        last_at = MAX(COALESCE(last_at, ''), excluded.last_at)"""
+
+def default_archive_path():
+    """Arquivo padrão do histórico arquivado, ao lado do banco atual."""
+    return os.path.splitext(DB_FILE)[0] + ".arquivo.db"
+
+def get_archive_state():
+    """Linha de archive_state (path, cutoff, archived_through, archived) ou None."""
+    return get_connection().execute("SELECT * FROM archive_state WHERE id=1").fetchone()
+
+ARCHIVED_BALANCE_TYPE = "saldo"
+
+def get_archived_balance(product_id):
+    """Linha de saldo transportado do histórico arquivado de um produto, ou None.
+
+    Tem as mesmas chaves das linhas de get_transactions (id vazio, type
+    "saldo") e quantity = entradas - saídas arquivadas, isto é, o saldo no
+    fim do período arquivado; vai depois da movimentação mais antiga.
+    """
+    row = get_connection().execute(
+        """SELECT b.product_id, p.name, b.in_qty - b.out_qty AS quantity, b.movements, b.last_at
+           FROM archived_balances b JOIN products p ON p.id = b.product_id WHERE b.product_id=?""",
+        (product_id,)).fetchone()
+    if row is None:
+        return None
+    return {"id": None, "product_id": row["product_id"], "name": row["name"], "type": ARCHIVED_BALANCE_TYPE,
+            "quantity": row["quantity"], "created_at": row["last_at"],
+            "note": f"Saldo arquivado ({row['movements']} movimentações até {(row['last_at'] or '')[:10]})"}
+
+@profiled
+def archive_transactions(cutoff, path=None, progress=None):
+    """Move para o arquivo as movimentações anteriores a `cutoff` (data). Retorna quantas moveu.
+
+    progress(movidas) é chamado a cada bloco. O arquivo é sempre o mesmo para
+    um banco: o primeiro usado fica gravado em archive_state.
+    """
+    cutoff = datetime.date.fromisoformat(_day_str(cutoff)).isoformat()
+    if cutoff > datetime.date.today().isoformat():
+        raise ValueError("A data de corte não pode estar no futuro.")
+    conn = get_connection()
+    state = get_archive_state()
+    path = os.path.abspath(path or (state["path"] if state else default_archive_path()))
+    if state and state["path"] != path:
+        raise ValueError(f"O histórico deste banco já é arquivado em {state['path']}.")
+    conn.execute("ATTACH DATABASE ? AS arquivo", (path,))
+    try:
+        with conn:
+            for sql in ARCHIVE_SCHEMA:
+                conn.execute(sql)
+            conn.execute("CREATE TEMP TABLE IF NOT EXISTS archive_ids (id INTEGER PRIMARY KEY)")
+        moved = 0
+        while True:
+            # 1) copia o bloco para o arquivo e confirma
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("DELETE FROM temp.archive_ids")
+                conn.execute("""INSERT INTO temp.archive_ids
+                                SELECT id FROM main.transactions WHERE created_at < ?
+                                ORDER BY created_at LIMIT ?""", (cutoff, ARCHIVE_BATCH))
+                n = conn.execute("SELECT COUNT(*) FROM temp.archive_ids").fetchone()[0]
+                if n:
+                    conn.execute("""INSERT OR IGNORE INTO arquivo.transactions
+                                    SELECT t.id, t.product_id, t.type, t.quantity, t.created_at, t.note
+                                    FROM main.transactions t WHERE t.id IN (SELECT id FROM temp.archive_ids)""")
+            if not n:
+                break
+            # 2) totais, remoção e controle numa única transação do banco ativo
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(ARCHIVE_BALANCE_UPSERT)
+                through = conn.execute("""SELECT MAX(created_at) FROM main.transactions
+                                          WHERE id IN (SELECT id FROM temp.archive_ids)""").fetchone()[0]
+                conn.execute("DELETE FROM main.transactions WHERE id IN (SELECT id FROM temp.archive_ids)")
+                conn.execute("""INSERT INTO archive_state (id, path, cutoff, archived_through, archived, updated_at)
+                                VALUES (1, ?, ?, ?, ?, ?)
+                                ON CONFLICT(id) DO UPDATE SET
+                                    cutoff = MAX(COALESCE(cutoff, ''), excluded.cutoff),
+                                    archived_through = MAX(COALESCE(archived_through, ''), excluded.archived_through),
+                                    archived = archived + excluded.archived,
+                                    updated_at = excluded.updated_at""",
+                             (path, cutoff, through, n, datetime.datetime.now().isoformat()))
+            moved += n
+            if progress:
+                progress(moved)
+        with conn:
+            conn.execute("DROP TABLE IF EXISTS temp.archive_ids")
+    finally:
+        conn.execute("DETACH DATABASE arquivo")
+    if moved:
+        _notify("archived", ())
+    return moved
+
+@profiled
+def compact_database():
+    """Devolve ao sistema o espaço livre do banco atual. Retorna (bytes antes, bytes depois).
+
+    Na primeira vez ativa auto_vacuum incremental (exige um VACUUM completo);
+    depois basta o incremental_vacuum, que só solta as páginas livres.
+    """
+    conn = get_connection()
+    size = lambda: conn.execute("PRAGMA page_count").fetchone()[0] * conn.execute("PRAGMA page_size").fetchone()[0]
+    before = size()
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    else:
+        # por execute() o pragma solta uma página por chamada; executescript roda até o fim
+        conn.executescript("PRAGMA incremental_vacuum;")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.execute("PRAGMA optimize")
+    return before, size()
+
+
+# Exportação: lê em blocos com fetchmany e grava em buffer, com memória constante.
+# progress(gravadas, total) é chamado a cada bloco; se cancel (threading.Event)
+# for acionado o arquivo parcial é removido e a função retorna None.
+# Caminhos terminados em .gz são gravados com gzip.
+
+EXPORT_CHUNK = 2000
+
+def _open_export(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "wt", newline='', encoding="utf-8")
+    return open(path, "w", newline='', encoding="utf-8", buffering=1 << 16)
+
+def _stream_csv(path, header, cur, row_fn, total, progress, cancel, tail=()):
+    written = 0
+    created = False
+    try:
+        with _open_export(path) as f:
+            created = True
+            w = csv.writer(f)
+            w.writerow(header)
+            while True:
+                if cancel is not None and cancel.is_set():
+                    break
+                rows = cur.fetchmany(EXPORT_CHUNK)
+                if not rows:
+                    break
+                w.writerows(map(row_fn, rows))
+                written += len(rows)
+                if progress:
+                    progress(written, total)
+            if tail and not (cancel is not None and cancel.is_set()):
+                w.writerows(map(row_fn, tail))
+                written += len(tail)
+    except BaseException:
+        # só apaga o que esta exportação criou; se nem abriu, o erro original sobe
+        if created:
+            os.remove(path)
+        raise
+    finally:
+        cur.close()
+    if cancel is not None and cancel.is_set():
+        os.remove(path)
+        return None
+    return written
+
+@profiled
+def write_products_csv(path, search=None, progress=None, cancel=None):
+    total = count_products(search)
+    source, params, order = _products_source(search)
+    cur = get_connection().cursor()
+    cur.execute("SELECT p.*" + source + order, params)
+    return _stream_csv(path, ["id","name","quantity","price","expiry_date","created_at","min_quantity"], cur,
+                       lambda r: (r["id"], r["name"], r["quantity"], r["price"], r["expiry_date"], r["created_at"],
+                                  r["min_quantity"]),
+                       total, progress, cancel)
+
+@profiled
+def write_transactions_csv(path, product_id=None, start=None, end=None, progress=None, cancel=None):
+    """Histórico em CSV; de um produto só, sem data inicial, termina com o saldo arquivado."""
+    total = count_transactions(product_id, start, end)
+    carried = get_archived_balance(product_id) if product_id and start is None else None
+    cur = get_connection().cursor()
+    cur.execute(*_transactions_query(product_id, start=start, end=end))
+    return _stream_csv(path, ["id","product_id","product_name","type","quantity","created_at","note"], cur,
+                       lambda r: (r["id"], r["product_id"], r["name"], r["type"], r["quantity"], r["created_at"], r["note"]),
+                       total, progress, cancel, tail=[carried] if carried else ())
+
+
+@profiled
+def write_stock_as_of_csv(path, day, progress=None, cancel=None):
+    """Posição de estoque ao fim de `day` (inventário valorizado)."""
+    day = _day_str(day)
+    conn = get_connection()
+    total = stock_as_of_totals(day)[0]
+    columns, source, params = _as_of_query(conn, day)
+    cur = conn.cursor()
+    cur.execute("SELECT " + columns + source + " ORDER BY p.name", params)
+    return _stream_csv(path, ["date","product_id","name","quantity","price","value"], cur,
+                       lambda r: (day, r["id"], r["name"], r["quantity"], r["price"], round(r["value"], 2)),
+                       total, progress, cancel)
+
+
+# Importação de produtos (mesmo layout de write_products_csv)
+
+IMPORT_BATCH = 5000
+
+def _validate_product_row(r):
+    """Converte uma linha do CSV; retorna (pid, name, qty, price, expiry, created_at, min_qty) ou o motivo da recusa."""
+    name = (r.get("name") or "").strip()
+    if not name:
+        return "Nome é obrigatório."
+    raw_id = (r.get("id") or "").strip()
+    pid = safe_int(raw_id, None) if raw_id else None
+    if raw_id and pid is None:
+        return f"ID inválido: {raw_id}"
+    raw_q = (r.get("quantity") or "").strip()
+    qty = safe_int(raw_q, None) if raw_q else 0
+    if qty is None or qty < 0:
+        return f"Quantidade inválida: {raw_q}"
+    raw_p = (r.get("price") or "").strip()
+    price = safe_float(raw_p, None) if raw_p else 0.0
+    if price is None or price < 0:
+        return f"Preço inválido: {raw_p}"
+    raw_e = (r.get("expiry_date") or "").strip()
+    expiry = parse_date_str(raw_e)
+    if raw_e and expiry is None:
+        return f"Data de validade inválida: {raw_e}"
+    raw_m = (r.get("min_quantity") or "").strip()
+    min_qty = safe_int(raw_m, None) if raw_m else None
+    if raw_m and (min_qty is None or min_qty < 0):
+        return f"Estoque mínimo inválido: {raw_m}"
+    return pid, name, qty, price, expiry, (r.get("created_at") or "").strip() or None, min_qty
+
+def _import_batch(cur, batch, now):
+    """Aplica um lote já validado; cada chave (id ou nome) fica com a última linha do lote.
+
+    Roda dentro de uma transação BEGIN IMMEDIATE já aberta. A diferença de
+    saldo de cada produto entra no histórico (e no resumo diário) como
+    "Estoque inicial" ou "Ajuste de cadastro", como no cadastro manual, e os
+    lotes dos produtos do lote são acertados na mesma transação.
+    """
+    ids = [b[0] for b in batch if b[0] is not None]
+    names = list({b[1] for b in batch})
+    stock, by_name = {}, {}
+    for k in range(0, len(ids), 500):
+        chunk = ids[k:k+500]
+        cur.execute(f"SELECT id, quantity FROM products WHERE id IN ({','.join('?' * len(chunk))})", chunk)
+        stock.update((r[0], r[1] or 0) for r in cur.fetchall())
+    for k in range(0, len(names), 500):
+        chunk = names[k:k+500]
+        cur.execute(f"""SELECT id, name, quantity FROM products WHERE name IN ({','.join('?' * len(chunk))})
+                        ORDER BY id DESC""", chunk)
+        for r in cur.fetchall():
+            by_name[r[1]] = r[0]
+            stock[r[0]] = r[2] or 0
+    updates, inserts = {}, {}
+    for pid, name, qty, price, expiry, created, min_qty in batch:
+        target = pid if pid in stock else by_name.get(name)
+        if target is not None:
+            updates[target] = (name, qty, price, expiry, min_qty, target)
+        else:
+            inserts[pid if pid is not None else name] = [pid, name, qty, price, expiry, created or now,
+                                                         LOW_STOCK_DEFAULT if min_qty is None else min_qty]
+    # ids novos definidos aqui, para gravar as movimentações no mesmo executemany
+    cur.execute("""SELECT MAX(COALESCE((SELECT MAX(id) FROM products), 0),
+                              COALESCE((SELECT seq FROM sqlite_sequence WHERE name='products'), 0))""")
+    next_id = max([cur.fetchone()[0]] + [r[0] for r in inserts.values() if r[0] is not None]) + 1
+    for r in inserts.values():
+        if r[0] is None:
+            r[0], next_id = next_id, next_id + 1
+    ledger = []
+    for pid, (name, qty, *_) in updates.items():
+        diff = qty - stock[pid]
+        if diff:
+            ledger.append((pid, "in" if diff > 0 else "out", abs(diff), now, ADJUST_NOTE))
+    for pid, name, qty, *_ in inserts.values():
+        if qty:
+            ledger.append((pid, "in", qty, now, INITIAL_STOCK_NOTE))
+    cur.executemany("""UPDATE products SET name=?, quantity=?, price=?, expiry_date=?,
+                       min_quantity=COALESCE(?, min_quantity) WHERE id=?""", updates.values())
+    cur.executemany("""INSERT INTO products (id,name,quantity,price,expiry_date,created_at,min_quantity)
+                       VALUES (?,?,?,?,?,?,?)""", inserts.values())
+    cur.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) VALUES (?,?,?,?,?)",
+                    ledger)
+    cur.executemany(ROLLUP_UPSERT, [(pid, now[:10], qty if ttype == "in" else 0, 0 if ttype == "in" else qty)
+                                    for pid, ttype, qty, _, _ in ledger])
+    _reconcile_lots(cur, list(updates) + [r[0] for r in inserts.values()], now)
+    return len(inserts), set(updates)
+
+@profiled
+def import_products_csv(path, progress=None):
+    """Importa produtos em lotes com executemany, atualizando por id ou nome.
+
+    Durante a carga o banco fica com synchronous=OFF; cada lote é uma
+    transação. Linhas recusadas vão para <arquivo>.rejeitados.csv.
+    Retorna (inseridos, atualizados, recusados, caminho do relatório ou None).
+    """
+    now = datetime.datetime.now().isoformat()
+    conn = get_connection()
+    opener = gzip.open if path.endswith(".gz") else open
+    report_path = os.path.splitext(path[:-3] if path.endswith(".gz") else path)[0] + ".rejeitados.csv"
+    inserted, updated, rejected, done = 0, set(), [], 0
+    conn.execute("PRAGMA synchronous=OFF")
+    try:
+        with opener(path, "rt", newline='', encoding="utf-8-sig") as f:
+            reader = csv.DictReader(f)
+            batch = []
+            for line, r in enumerate(reader, start=2):
+                v = _validate_product_row(r)
+                if isinstance(v, str):
+                    rejected.append((line, v, r))
+                else:
+                    batch.append(v)
+                if len(batch) >= IMPORT_BATCH:
+                    with _product_write(conn) as cur:
+                        n, ids = _import_batch(cur, batch, now)
+                    for pid in ids:
+                        product_cache.discard(pid)
+                    inserted, done = inserted + n, done + len(batch)
+                    updated |= ids
+                    batch = []
+                    if progress:
+                        progress(done)
+            if batch:
+                with _product_write(conn) as cur:
+                    n, ids = _import_batch(cur, batch, now)
+                for pid in ids:
+                    product_cache.discard(pid)
+                inserted += n
+                updated |= ids
+            fields = reader.fieldnames or []
+    finally:
+        conn.execute("PRAGMA synchronous=NORMAL")
+    if rejected:
+        with open(report_path, "w", newline='', encoding="utf-8") as f:
+            w = csv.writer(f)
+            w.writerow(["linha", "motivo"] + fields)
+            for line, reason, r in rejected:
+                w.writerow([line, reason] + [r.get(k) for k in fields])
+    if inserted:
+        _notify("added", ())
+    if updated:
+        _notify("updated", updated)
+    return inserted, len(updated), len(rejected), report_path if rejected else None
 
 
 # Utilitários
 
 def safe_float(v, default=0.0):
     try:
-        return float(v)
+        f = float(v)
     except:
         return default
+    # "nan" e "inf" são aceitos por float(), mas não são valores válidos
+    return f if math.isfinite(f) else default
 
 def safe_int(v, default=0):
     try:
@@ -165,9 +1927,765 @@ def parse_date_str(s):
         return None
 
 
+# Escrita agrupada (group commit)
+
+# Durabilidade de uma escrita = PRAGMA synchronous usado no commit do lote:
+# "off" não espera o disco, "normal" (padrão, WAL) pode perder os últimos
+# commits numa queda de energia, "full" faz fsync a cada commit.
+DURABILITY_LEVELS = ("off", "normal", "full")
+
+class GroupCommitWriter:
+    """Thread escritora única que agrupa escritas em uma transação por janela.
+
+    submit(fn, *args) enfileira fn(cursor, *args) e devolve um Future. Tudo o
+    que chega dentro de `window` segundos após a primeira escrita pendente é
+    aplicado em uma só transação (um commit), com a durabilidade mais forte
+    pedida no lote. Cada escrita roda em um SAVEPOINT próprio: se falhar, só
+    ela é desfeita e seu Future recebe a exceção. on_commit(resultado) roda
+    na thread escritora após o commit; um erro nele é só registrado em stderr.
+    A thread escreve por uma conexão própria, que close_connections() não
+    fecha; ela é fechada quando o escritor termina (close()).
+    """
+    def __init__(self, window=0.005, max_batch=500):
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.writes = 0
+        self._closed = False
+        self._synchronous = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="estoque-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, fn, *args, on_commit=None, durability="normal"):
+        if durability not in DURABILITY_LEVELS:
+            raise ValueError(f"Durabilidade deve ser uma de {', '.join(DURABILITY_LEVELS)}.")
+        if self._closed:
+            raise RuntimeError("Escritor encerrado.")
+        fut = Future()
+        self._queue.put((fut, fn, args, on_commit, DURABILITY_LEVELS.index(durability)))
+        return fut
+
+    def queue_movement(self, pid, amount, ttype, note="", durability="normal", lot=None, expiry_date=None):
+        """Enfileira uma movimentação; o Future resolve para a nova quantidade ou ValueError."""
+        now = datetime.datetime.now().isoformat()
+        return self.submit(_move_stock, pid, amount, ttype, note, now, lot, expiry_date,
+                           on_commit=lambda new_q: _stock_moved(pid, new_q), durability=durability)
+
+    def stats(self):
+        return {"batches": self.batches, "writes": self.writes,
+                "avg_batch": self.writes / self.batches if self.batches else 0.0}
+
+    def close(self):
+        global _writer
+        with _writer_lock:
+            if _writer is self:
+                _writer = None
+            if self._closed:
+                return
+            self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        # conexão própria, fora de close_connections(): dura o mesmo que a thread
+        conn = _open_connection(DB_FILE)
+        try:
+            stop = False
+            while not stop:
+                item = self._queue.get()
+                if item is None:
+                    break
+                batch = [item]
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    try:
+                        item = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        stop = True
+                        break
+                    batch.append(item)
+                self._apply(conn, batch)
+        finally:
+            conn.close()
+
+    def _apply(self, conn, batch):
+        level = DURABILITY_LEVELS[max(item[4] for item in batch)]
+        done = []
+        try:
+            if level != self._synchronous:
+                conn.execute(f"PRAGMA synchronous={level.upper()}")
+                self._synchronous = level
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                cur = conn.cursor()
+                before = _product_changes(cur)
+                for fut, fn, args, on_commit, _ in batch:
+                    if not fut.set_running_or_notify_cancel():
+                        continue
+                    cur.execute("SAVEPOINT op")
+                    try:
+                        result = fn(cur, *args)
+                    except Exception as e:
+                        cur.execute("ROLLBACK TO op")
+                        cur.execute("RELEASE op")
+                        done.append((fut, e, None, None))
+                    else:
+                        cur.execute("RELEASE op")
+                        done.append((fut, None, result, on_commit))
+                after = _product_changes(cur)
+        except Exception as e:
+            for item in batch:
+                if not item[0].done():
+                    item[0].set_exception(e)
+            return
+        product_cache.own_commit(before, after)
+        self.batches += 1
+        self.writes += len(done)
+        for fut, exc, result, on_commit in done:
+            if exc is not None:
+                fut.set_exception(exc)
+                continue
+            if on_commit:
+                try:
+                    on_commit(result)
+                except Exception:
+                    # a escrita já foi confirmada: o erro não pode derrubar a thread nem o Future
+                    traceback.print_exc()
+            fut.set_result(result)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+def get_writer():
+    """GroupCommitWriter compartilhado do processo (criado no primeiro uso)."""
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = GroupCommitWriter()
+        return _writer
+
+def queue_movement(pid, amount, ttype, note="", durability="normal", lot=None, expiry_date=None):
+    """Como change_stock, mas pelo escritor agrupado; retorna um Future da nova quantidade."""
+    return get_writer().queue_movement(pid, amount, ttype, note, durability, lot, expiry_date)
+
+
+# Servidor HTTP/JSON (sem interface gráfica)
+
+def _row_dict(row):
+    return {k: row[k] for k in row.keys()}
+
+def _query_date(q, name):
+    d = _body_date(q, name)
+    return datetime.date.fromisoformat(d) if d else None
+
+def _body_date(data, name):
+    """Data YYYY-MM-DD opcional do corpo JSON; valor inválido é erro 400, não descartado."""
+    raw = str(data.get(name) or "").strip()
+    d = parse_date_str(raw)
+    if raw and d is None:
+        raise HttpError(400, f"{name} inválida: use YYYY-MM-DD.")
+    return d
+
+def _int_param(data, name, default=None, minimum=0):
+    """Inteiro opcional da query string ou do corpo JSON; valor inválido é erro 400."""
+    value = data.get(name)
+    raw = "" if value is None else str(value).strip()
+    if not raw:
+        return default
+    n = safe_int(raw, None)
+    if n is None or (minimum is not None and n < minimum):
+        raise HttpError(400, f"{name} inválido: use um inteiro >= {minimum}.")
+    return n
+
+def _float_param(data, name, default=0.0):
+    """Número >= 0 opcional do corpo JSON; valor inválido (inclusive nan/inf) é erro 400."""
+    value = data.get(name)
+    if value is None or str(value).strip() == "" or isinstance(value, bool):
+        return default
+    f = safe_float(value, None)
+    if f is None or f < 0:
+        raise HttpError(400, f"{name} inválido: use um número >= 0.")
+    return f
+
+class HttpError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class InventoryServer:
+    """API HTTP/JSON sobre as funções de dados, só com a biblioteca padrão (asyncio).
+
+    Leituras rodam em um pool de threads (uma conexão por thread); todas as
+    escritas passam pelo GroupCommitWriter, uma única conexão escritora.
+
+    Rotas:
+        GET  /produtos?busca=&limite=&offset=       GET /produtos/<id>
+        POST /produtos   {name, quantity, price, expiry_date, min_quantity}
+        GET  /movimentos?product_id=&limite=&offset=&antes_data=&antes_id=
+                         (de um produto: a última página termina com o saldo arquivado)
+        POST /movimentos {product_id, quantity, type, note, durability, lot, expiry_date}
+        GET  /relatorios/movimentos?inicio=&fim=&granularidade=&product_id=&por_produto=
+        GET  /relatorios/produtos?inicio=&fim=&limite=
+        GET  /validade?dias=&vencidos=&limite=&offset=
+        GET  /estoque?data=&limite=&offset=         (posição ao fim de uma data)
+        GET  /resumo                                 GET /diagnostico
+
+    limite vai de 1 a MAX_PAGE (padrão 100); parâmetro ou campo inválido responde 400.
+    """
+    STATUS_TEXT = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+                   405: "Method Not Allowed", 409: "Conflict", 431: "Request Header Fields Too Large",
+                   500: "Internal Server Error"}
+    MAX_BODY = 1 << 20
+    MAX_HEADERS = 100
+    MAX_PAGE = 1000  # maior `limite` aceito nas listagens
+
+    def __init__(self, host="127.0.0.1", port=8765, readers=4, writer=None):
+        self.host = host
+        self.port = port
+        self.readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="estoque-reader")
+        self.writer = writer or get_writer()
+
+    async def serve_forever(self):
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"Servidor de estoque em http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.writer.close()
+        self.readers.shutdown()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                except ValueError:
+                    await self._send(writer, 400, {"erro": "Requisição inválida."}, False)
+                    break
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    if len(headers) >= self.MAX_HEADERS:
+                        await self._send(writer, 431, {"erro": "Cabeçalhos demais."}, False)
+                        return
+                    k, _, v = h.decode("latin-1").partition(":")
+                    headers[k.strip().lower()] = v.strip()
+                length = safe_int(headers.get("content-length"), 0)
+                if length < 0:
+                    await self._send(writer, 400, {"erro": "Content-Length inválido."}, False)
+                    break
+                if length > self.MAX_BODY:
+                    await self._send(writer, 400, {"erro": "Corpo muito grande."}, False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = (headers.get("connection", "").lower() != "close"
+                              and version.upper() == "HTTP/1.1")
+                try:
+                    status, payload = await self._dispatch(method.upper(), target, body)
+                except HttpError as e:
+                    status, payload = e.status, {"erro": str(e)}
+                except ValueError as e:
+                    status, payload = 409, {"erro": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"erro": str(e)}
+                await self._send(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except (ValueError, asyncio.LimitOverrunError):
+            # linha de requisição ou cabeçalho maior que o limite do StreamReader (64 KiB)
+            try:
+                await self._send(writer, 431, {"erro": "Linha de requisição ou cabeçalho muito longo."}, False)
+            except ConnectionError:
+                pass
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        head = (f"HTTP/1.1 {status} {self.STATUS_TEXT.get(status, '')}\r\n"
+                f"Content-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode("latin-1") + data)
+        await writer.drain()
+
+    async def _read(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.readers, fn, *args)
+
+    async def _write(self, fn, *args, on_commit=None):
+        return await asyncio.wrap_future(self.writer.submit(fn, *args, on_commit=on_commit))
+
+    def _page(self, q, default=100):
+        """(limite, offset) da query string; limite entre 1 e MAX_PAGE."""
+        return (min(_int_param(q, "limite", default, minimum=1), self.MAX_PAGE),
+                _int_param(q, "offset", 0))
+
+    async def _dispatch(self, method, target, body):
+        url = urllib.parse.urlsplit(target)
+        parts = [p for p in url.path.split("/") if p]
+        q = dict(urllib.parse.parse_qsl(url.query))
+        data = {}
+        if body:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                raise HttpError(400, "JSON inválido.")
+            if not isinstance(data, dict):
+                raise HttpError(400, "O corpo deve ser um objeto JSON.")
+
+        if parts == ["produtos"] and method == "GET":
+            rows = await self._read(get_products, q.get("busca") or None, *self._page(q))
+            return 200, [_row_dict(r) for r in rows]
+        if parts == ["produtos"] and method == "POST":
+            name = str(data.get("name") or "").strip()
+            if not name:
+                raise HttpError(400, "Nome é obrigatório.")
+            expiry = _body_date(data, "expiry_date")
+            now = datetime.datetime.now().isoformat()
+            rec = await self._write(_insert_product, name, _int_param(data, "quantity", 0),
+                                    _float_param(data, "price"), expiry,
+                                    _int_param(data, "min_quantity", LOW_STOCK_DEFAULT), now,
+                                    on_commit=_product_added)
+            return 201, _row_dict(rec)
+        if len(parts) == 2 and parts[0] == "produtos" and method == "GET":
+            rec = await self._read(get_product, safe_int(parts[1], -1))
+            if rec is None:
+                raise HttpError(404, "Produto não encontrado.")
+            return 200, _row_dict(rec)
+        if parts == ["movimentos"] and method == "GET":
+            before = None
+            if q.get("antes_data"):
+                try:
+                    datetime.datetime.fromisoformat(q["antes_data"])
+                except ValueError:
+                    raise HttpError(400, "antes_data inválida: use a created_at da última linha.")
+                before = (q["antes_data"], _int_param(q, "antes_id", 0))
+            pid = _int_param(q, "product_id", minimum=1)
+            limit, offset = self._page(q)
+            rows = await self._read(get_transactions, pid, limit, offset, before)
+            out = [_row_dict(r) for r in rows]
+            if pid and len(rows) < limit:
+                # última página do produto: fecha com o saldo transportado do arquivo
+                carried = await self._read(get_archived_balance, pid)
+                if carried:
+                    out.append(carried)
+            return 200, out
+        if parts == ["movimentos"] and method == "POST":
+            pid = _int_param(data, "product_id", minimum=1)
+            qty = _int_param(data, "quantity", 0, minimum=None)
+            ttype = MOVEMENT_TYPES.get(str(data.get("type") or "").strip().lower())
+            if pid is None or qty <= 0 or ttype is None:
+                raise HttpError(400, "Informe product_id, quantity positiva e type 'in' ou 'out'.")
+            durability = data.get("durability") or "normal"
+            if durability not in DURABILITY_LEVELS:
+                raise HttpError(400, f"durability deve ser uma de {', '.join(DURABILITY_LEVELS)}.")
+            expiry = _body_date(data, "expiry_date")
+            fut = self.writer.queue_movement(pid, qty, ttype, str(data.get("note") or ""), durability,
+                                             str(data.get("lot") or "").strip() or None, expiry)
+            new_q = await asyncio.wrap_future(fut)
+            return 201, {"product_id": pid, "quantity": new_q}
+        if parts == ["relatorios", "movimentos"] and method == "GET":
+            end = _query_date(q, "fim") or datetime.date.today()
+            start = _query_date(q, "inicio") or end - datetime.timedelta(days=29)
+            gran = q.get("granularidade", "day")
+            if gran not in REPORT_BUCKETS:
+                raise HttpError(400, f"granularidade deve ser uma de {', '.join(REPORT_BUCKETS)}.")
+            rows = await self._read(get_movement_totals, start, end, gran, _int_param(q, "product_id", minimum=1),
+                                    q.get("por_produto") in ("1", "true", "sim"))
+            return 200, [_row_dict(r) for r in rows]
+        if parts == ["relatorios", "produtos"] and method == "GET":
+            end = _query_date(q, "fim") or datetime.date.today()
+            start = _query_date(q, "inicio") or end - datetime.timedelta(days=29)
+            rows = await self._read(get_product_totals, start, end, self._page(q, self.MAX_PAGE)[0])
+            return 200, [_row_dict(r) for r in rows]
+        if parts == ["validade"] and method == "GET":
+            rows = await self._read(get_expiring, _int_param(q, "dias", EXPIRY_WARNING_DAYS),
+                                    q.get("vencidos") in ("1", "true", "sim"), *self._page(q))
+            return 200, [_row_dict(r) for r in rows]
+        if parts == ["estoque"] and method == "GET":
+            day = (_query_date(q, "data") or datetime.date.today()).isoformat()
+            products, units, value = await self._read(stock_as_of_totals, day)
+            rows = await self._read(stock_as_of, day, *self._page(q))
+            return 200, {"date": day, "products": products, "units": units, "value": value,
+                         "items": [_row_dict(r) for r in rows]}
+        if parts == ["resumo"] and method == "GET":
+            total, units, low = await self._read(get_stock_summary)
+            q_in, q_out = await self._read(get_day_totals)
+            expired, expired_value, expiring, expiring_value = await self._read(get_expiry_summary)
+            return 200, {"total_products": total, "total_units": units, "low_stock": low,
+                         "today_in": q_in, "today_out": q_out,
+                         "expired": expired, "expired_value": expired_value,
+                         "expiring": expiring, "expiring_value": expiring_value,
+                         "writer": self.writer.stats()}
+        if parts == ["diagnostico"] and method == "GET":
+            return 200, profiler.snapshot()
+        if parts and parts[0] in ("produtos", "movimentos", "relatorios", "validade", "estoque", "resumo", "diagnostico"):
+            raise HttpError(405, "Método não permitido.")
+        raise HttpError(404, "Rota não encontrada.")
+
+def run_server(host="127.0.0.1", port=8765):
+    server = InventoryServer(host, port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
 # Aplicação (UI)
 
+class BackgroundJobs:
+    """Executa trabalhos de banco/arquivo fora da thread do Tk.
+
+    submit(key, fn, on_done) roda fn() em um worker e chama on_done(resultado)
+    na thread do Tk (via root.after). Um novo submit com a mesma chave torna
+    o anterior obsoleto: se ainda não começou é cancelado, e o resultado de
+    um trabalho obsoleto é descartado. O status_var mostra o que está em curso.
+    """
+    POLL_MS = 50
+
+    def __init__(self, root, status_var, workers=2):
+        self.root = root
+        self.status_var = status_var
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="estoque-db")
+        self._results = queue.Queue()
+        self._generation = {}
+        self._pending = {}
+        self._progress = {}
+        self._polling = False
+
+    def submit(self, key, fn, on_done=None, on_error=None, label=None):
+        gen = self._generation.get(key, 0) + 1
+        self._generation[key] = gen
+        old = self._pending.pop(key, None)
+        if old:
+            old[0].cancel()
+        fut = self.executor.submit(fn)
+        self._pending[key] = (fut, label or key)
+        fut.add_done_callback(lambda f: self._results.put(("done", key, gen, f, on_done, on_error)))
+        self._update_status()
+        self._start_polling()
+        return fut
+
+    def progress(self, key, text):
+        """Atualiza o texto de progresso de um trabalho; pode ser chamado do worker."""
+        self._results.put(("progress", key, text))
+
+    def post(self, fn, *args):
+        """Agenda fn(*args) na thread do Tk.
+
+        Chamado da thread do Tk executa na hora; de um worker, a chamada é
+        entregue pelo mesmo laço que entrega os resultados dos trabalhos.
+        """
+        if threading.current_thread() is threading.main_thread():
+            fn(*args)
+        else:
+            self._results.put(("call", fn, args))
+
+    def is_busy(self, key=None):
+        """Se o trabalho key (ou, sem key, algum trabalho) ainda está pendente."""
+        return key in self._pending if key is not None else bool(self._pending)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _start_polling(self):
+        if not self._polling:
+            self._polling = True
+            self.root.after(self.POLL_MS, self._poll)
+
+    def _poll(self):
+        while True:
+            try:
+                item = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if item[0] == "call":
+                item[1](*item[2])
+            elif item[0] == "progress":
+                if item[1] in self._pending:
+                    self._progress[item[1]] = item[2]
+            else:
+                self._finish(*item[1:])
+        self._update_status()
+        if self._pending:
+            self.root.after(self.POLL_MS, self._poll)
+        else:
+            self._polling = False
+
+    def _finish(self, key, gen, fut, on_done, on_error):
+        if self._generation.get(key) != gen or fut.cancelled():
+            return
+        self._pending.pop(key, None)
+        self._progress.pop(key, None)
+        exc = fut.exception()
+        if exc is not None:
+            (on_error or self._show_error)(exc)
+        elif on_done:
+            on_done(fut.result())
+
+    def _update_status(self):
+        if not self._pending:
+            self.status_var.set("Pronto")
+            return
+        parts = [self._progress.get(k, label) for k, (_, label) in self._pending.items()]
+        self.status_var.set("Carregando: " + ", ".join(parts) + "...")
+
+    def _show_error(self, exc):
+        messagebox.showerror("Erro", str(exc))
+
+class VirtualTreeview(ttk.Frame):
+    """Treeview que materializa só as linhas visíveis, buscando páginas do banco sob demanda.
+
+    count_fn() retorna o total de linhas, fetch_fn(offset, limit) uma página
+    e row_fn(row) o par (iid, values) de cada linha. As páginas lidas ficam
+    em um pequeno cache LRU até o próximo refresh().
+
+    Com jobs (BackgroundJobs) as páginas que faltam ao rolar são lidas fora
+    da thread do Tk; até chegarem a janela mostra linhas "…". seek_fn(row,
+    direção, limit), se dado, lê as `limit` linhas depois (1) ou antes (-1)
+    de uma linha já carregada, por keyset, em vez de OFFSET; pode retornar
+    None quando a linha não serve de chave.
+    """
+    PLACEHOLDER = "…"
+
+    def __init__(self, parent, columns, count_fn, fetch_fn, row_fn, page_size=200, cached_pages=8,
+                 jobs=None, seek_fn=None):
+        super().__init__(parent)
+        self.count_fn = count_fn
+        self.fetch_fn = fetch_fn
+        self.row_fn = row_fn
+        self.seek_fn = seek_fn
+        self.jobs = jobs
+        self.page_size = page_size
+        self.cached_pages = cached_pages
+        self.total = 0
+        self.first = 0
+        self.visible = 20
+        self._pages = OrderedDict()
+        self._version = 0
+        self._requested = None
+        self._selected = None
+        self._rendering = False
+        self._columns = columns
+        self.tree = ttk.Treeview(self, columns=columns, show="headings", selectmode="browse")
+        self.vsb = ttk.Scrollbar(self, orient="vertical", command=self._on_scrollbar)
+        self.vsb.pack(side="right", fill="y")
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.tree.bind("<Configure>", self._on_resize)
+        self.tree.bind("<<TreeviewSelect>>", self._on_select)
+        self.tree.bind("<MouseWheel>", lambda e: self.scroll(-3 if e.delta > 0 else 3))
+        self.tree.bind("<Button-4>", lambda e: self.scroll(-3))
+        self.tree.bind("<Button-5>", lambda e: self.scroll(3))
+        self.tree.bind("<Up>", lambda e: self._move_selection(-1))
+        self.tree.bind("<Down>", lambda e: self._move_selection(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll(-1, "pages"))
+        self.tree.bind("<Next>", lambda e: self.scroll(1, "pages"))
+
+    def heading(self, *args, **kw):
+        return self.tree.heading(*args, **kw)
+
+    def column(self, *args, **kw):
+        return self.tree.column(*args, **kw)
+
+    def selection(self):
+        return (self._selected,) if self._selected is not None else ()
+
+    def clear_selection(self):
+        self._selected = None
+        self.tree.selection_set(())
+
+    def loaded_ids(self, ids):
+        """Dos iids pedidos, os que estão na janela ou no cache de páginas."""
+        wanted = {str(i) for i in ids}
+        found = {i for i in wanted if self.tree.exists(i)}
+        for page in self._pages.values():
+            found.update(str(iid) for iid, _ in map(self.row_fn, page) if str(iid) in wanted)
+        return found
+
+    def update_rows(self, rows):
+        """Substitui linhas já carregadas (janela e cache) sem recarregar a lista."""
+        by_iid = {str(self.row_fn(r)[0]): r for r in rows}
+        for page in self._pages.values():
+            for i, r in enumerate(page):
+                new = by_iid.get(str(self.row_fn(r)[0]))
+                if new is not None:
+                    page[i] = new
+        for iid, r in by_iid.items():
+            if self.tree.exists(iid):
+                self.tree.item(iid, values=self.row_fn(r)[1])
+
+    def load(self, reset=False):
+        """Lê o total e as páginas da janela atual; pode rodar fora da thread do Tk."""
+        total = self.count_fn()
+        first = max(0, min(0 if reset else self.first, total - self.visible))
+        pages = {}
+        for n in range(first // self.page_size, (first + self.visible) // self.page_size + 1):
+            pages[n] = list(self.fetch_fn(n * self.page_size, self.page_size))
+        return total, first, pages, reset
+
+    def apply(self, data):
+        self.total, self.first, pages, reset = data
+        self._pages = OrderedDict(pages)
+        self._version += 1
+        if self._selected is not None and (reset or not any(
+                str(self.row_fn(r)[0]) == self._selected for page in pages.values() for r in page)):
+            # a linha selecionada saiu da lista: Editar/Excluir não podem agir sobre ela
+            self.clear_selection()
+        self._render()
+
+    def refresh(self, reset=False):
+        self.apply(self.load(reset))
+
+    def scroll(self, n, what="units"):
+        if what == "pages":
+            n *= max(1, self.visible - 1)
+        self.first += n
+        self._render()
+        return "break"
+
+    def _page(self, n):
+        """Página n do cache, ou None se ainda não foi lida (com jobs a leitura é agendada)."""
+        rows = self._pages.get(n)
+        if rows is not None:
+            self._pages.move_to_end(n)
+            return rows
+        if self.jobs is None:
+            rows = self._pages[n] = list(self._page_loader(n)())
+            self._trim()
+            return rows
+        return None
+
+    def _page_loader(self, n):
+        """Função que lê a página n: keyset a partir de uma vizinha em cache, senão OFFSET."""
+        size = self.page_size
+        prev, nxt = self._pages.get(n - 1), self._pages.get(n + 1)
+        if self.seek_fn is not None:
+            if prev is not None and len(prev) == size:
+                row = prev[-1]
+                return lambda: self.seek_fn(row, 1, size) or self.fetch_fn(n * size, size)
+            if nxt:
+                row = nxt[0]
+                return lambda: self.seek_fn(row, -1, size) or self.fetch_fn(n * size, size)
+        return lambda: self.fetch_fn(n * size, size)
+
+    def _request_pages(self, missing):
+        version = self._version
+        request = (version, tuple(missing))
+        if request == self._requested and self.jobs.is_busy(("page", id(self))):
+            return  # as mesmas páginas já estão sendo lidas
+        self._requested = request
+        loaders = [(n, self._page_loader(n)) for n in missing]
+
+        def done(pages):
+            if version != self._version:
+                return  # lista recarregada enquanto a página era lida
+            for n, rows in pages:
+                self._pages[n] = rows
+            self._trim()
+            self._render()
+
+        self.jobs.submit(("page", id(self)), lambda: [(n, list(fn())) for n, fn in loaders], done, label="lista")
+
+    def _trim(self):
+        while len(self._pages) > self.cached_pages:
+            self._pages.popitem(last=False)
+
+    def _rows(self, start, count):
+        """Linhas da janela; None no lugar das que estão em páginas ainda não lidas."""
+        rows, missing = [], []
+        n = start // self.page_size
+        skip = start - n * self.page_size
+        while len(rows) < count and n * self.page_size < max(self.total, 1):
+            page = self._page(n)
+            if page is None:
+                missing.append(n)
+                take = min(self.page_size - skip, count - len(rows))
+                rows.extend([None] * take)
+            else:
+                rows.extend(page[skip:skip + count - len(rows)])
+                if len(page) < self.page_size:
+                    break
+            n, skip = n + 1, 0
+        if missing:
+            self._request_pages(missing)
+        return rows
+
+    def _render(self):
+        self.first = max(0, min(self.first, self.total - self.visible))
+        self._rendering = True
+        try:
+            self.tree.delete(*self.tree.get_children())
+            blank = (self.PLACEHOLDER,) * len(self._columns)
+            for k, row in enumerate(self._rows(self.first, self.visible)):
+                if row is None:
+                    self.tree.insert("", "end", iid=f"~{k}", values=blank)
+                    continue
+                iid, values = self.row_fn(row)
+                self.tree.insert("", "end", iid=iid, values=values)
+            if self._selected is not None and self.tree.exists(self._selected):
+                self.tree.selection_set(self._selected)
+                self.tree.focus(self._selected)
+        finally:
+            self._rendering = False
+        if self.total:
+            self.vsb.set(self.first / self.total, min(1.0, (self.first + self.visible) / self.total))
+        else:
+            self.vsb.set(0, 1)
+
+    def _on_scrollbar(self, action, *args):
+        if action == "moveto":
+            self.first = int(float(args[0]) * self.total)
+            self._render()
+        elif action == "scroll":
+            self.scroll(int(args[0]), args[1])
+
+    def _on_resize(self, event):
+        rowheight = int(ttk.Style(self).lookup("Treeview", "rowheight") or 20)
+        visible = max(1, event.height // rowheight - 1)
+        if visible != self.visible:
+            self.visible = visible
+            self._render()
+
+    def _on_select(self, event):
+        if self._rendering:
+            return
+        sel = self.tree.selection()
+        if sel and not sel[0].startswith("~"):
+            self._selected = sel[0]
+
+    def _move_selection(self, step):
+        children = self.tree.get_children()
+        if not children:
+            return "break"
+        idx = children.index(self._selected) if self._selected in children else -step
+        idx += step
+        if idx < 0 or idx >= len(children):
+            self.scroll(step)
+            children = self.tree.get_children()
+            idx = 0 if idx < 0 else len(children) - 1
+        if children and not children[idx].startswith("~"):
+            self._selected = children[idx]
+            self.tree.selection_set(self._selected)
+            self.tree.focus(self._selected)
+        return "break"
+
+
 class InventoryApp:
+    REPORT_GRANULARITY = {"Dia": "day", "Semana": "week", "Mês": "month"}
+
     def __init__(self, root):
         self.root = root
         self.root.title("Controle de Estoque")
@@ -176,8 +2694,29 @@ class InventoryApp:
         self._create_header()
         self._create_notebook()
         self._create_statusbar()
+        self.jobs = BackgroundJobs(self.root, self.status_var)
+        for tree in (self.tree_inv, self.tree_tr, self.tree_exp, self.tree_pos):
+            tree.jobs = self.jobs  # páginas lidas ao rolar vão para os workers
+        self._views = {
+            str(self.tab_dashboard): self.refresh_dashboard,
+            str(self.tab_inventory): self.refresh_inventory,
+            str(self.tab_transactions): self.refresh_transactions,
+            str(self.tab_expiry): self.refresh_expiry,
+            str(self.tab_position): self.refresh_position,
+            str(self.tab_reports): self.update_report_chart,
+            str(self.tab_diagnostics): self.refresh_diagnostics,
+        }
+        self._dirty = set()
+        subscribe(self._on_db_change)
+        self.nb.bind("<<NotebookTabChanged>>", self._on_tab_changed)
+        self.root.protocol("WM_DELETE_WINDOW", self._on_close)
         self.refresh_all()
 
+    def _on_close(self):
+        unsubscribe(self._on_db_change)
+        self.jobs.shutdown()
+        self.root.destroy()
+
     def _create_styles(self):
         style = ttk.Style(self.root)
         try:
@@ -200,6 +2739,7 @@ class InventoryApp:
         ttk.Button(toolbar, text="Atualizar", command=self.refresh_all).pack(side="left")
         ttk.Button(toolbar, text="Exportar Produtos CSV", command=self.export_products_csv).pack(side="left", padx=6)
         ttk.Button(toolbar, text="Exportar Histórico CSV", command=self.export_transactions_csv).pack(side="left", padx=6)
+        ttk.Button(toolbar, text="Importar Produtos CSV", command=self.import_products_csv).pack(side="left", padx=6)
         if HAS_MPL:
             ttk.Button(toolbar, text="Atualizar Gráfico", command=self.update_report_chart).pack(side="left", padx=6)
         else:
@@ -218,19 +2758,33 @@ class InventoryApp:
         self.tab_transactions = ttk.Frame(self.nb)
         self.nb.add(self.tab_transactions, text="Movimentações")
 
+        self.tab_expiry = ttk.Frame(self.nb)
+        self.nb.add(self.tab_expiry, text="Validade")
+
+        self.tab_position = ttk.Frame(self.nb)
+        self.nb.add(self.tab_position, text="Posição")
+
         self.tab_reports = ttk.Frame(self.nb)
         self.nb.add(self.tab_reports, text="Relatórios")
 
+        self.tab_diagnostics = ttk.Frame(self.nb)
+        self.nb.add(self.tab_diagnostics, text="Diagnóstico")
+
         self._build_dashboard()
         self._build_inventory()
         self._build_transactions()
-        self._build_reports()
+        self._build_expiry()
+        self._build_position()
+        self._build_diagnostics()
+        self._reports_built = False  # gráfico e tabelas montados na primeira exibição
 
     def _create_statusbar(self):
         self.status_var = tk.StringVar(value="Pronto")
         status = ttk.Frame(self.root)
         status.pack(fill="x", side="bottom")
         ttk.Label(status, textvariable=self.status_var).pack(side="left", padx=6, pady=4)
+        self.status_bar = status
+        self._exports = {}  # chave -> (Event de cancelamento, botão) de cada exportação em curso
 
     #Dashboard
     def _build_dashboard(self):
@@ -241,7 +2795,11 @@ class InventoryApp:
         self.card_total = self._card(top, "Total de Produtos", "0")
         self.card_units = self._card(top, "Unidades em Estoque", "0")
         self.card_low = self._card(top, "Produtos com Estoque Baixo", "0")
-        for c in (self.card_total, self.card_units, self.card_low):
+        self.card_today = self._card(top, "Movimentação Hoje", "+0 / -0")
+        self.card_expiry = self._card(top, f"Vencidos / Vencendo ({EXPIRY_WARNING_DAYS} dias)", "0 / 0")
+        self.card_expiry.detail_label = ttk.Label(self.card_expiry, foreground="gray")
+        self.card_expiry.detail_label.pack(anchor="w")
+        for c in (self.card_total, self.card_units, self.card_low, self.card_today, self.card_expiry):
             c.pack(side="left", padx=6, expand=True, fill="x")
 
         bottom = ttk.Frame(frame)
@@ -258,9 +2816,12 @@ class InventoryApp:
         right = ttk.Frame(bottom, width=260)
         right.pack(side="left", fill="y")
         ttk.Label(right, text="Produtos com estoque baixo", font=("Segoe UI", 10, "bold")).pack(anchor="w")
-        self.lv_low = ttk.Treeview(right, columns=("name","qty"), show="headings", height=12)
+        self.lv_low = ttk.Treeview(right, columns=("name","qty","min"), show="headings", height=12)
         self.lv_low.heading("name", text="Produto")
         self.lv_low.heading("qty", text="Qtd")
+        self.lv_low.heading("min", text="Mín.")
+        self.lv_low.column("qty", width=60, anchor="center")
+        self.lv_low.column("min", width=60, anchor="center")
         self.lv_low.pack(fill="both", expand=True, pady=6)
 
     def _card(self, parent, title, value):
@@ -279,11 +2840,17 @@ class InventoryApp:
         top.pack(fill="x")
         ttk.Label(top, text="Pesquisar:").pack(side="left")
         self.inv_search = tk.StringVar()
+        self._inv_term = None
+        self._search_after = None
+        self.inv_search.trace_add("write", self._on_search_typed)
         ttk.Entry(top, textvariable=self.inv_search).pack(side="left", padx=6)
-        ttk.Button(top, text="Pesquisar", command=self.refresh_inventory).pack(side="left")
+        ttk.Button(top, text="Pesquisar", command=lambda: self.refresh_inventory(reset=True)).pack(side="left")
         ttk.Button(top, text="Novo Produto", command=self.open_add_product).pack(side="left", padx=6)
 
-        self.tree_inv = ttk.Treeview(container, columns=("id","name","qty","price","expiry"), show="headings")
+        self.tree_inv = VirtualTreeview(container, ("id","name","qty","price","expiry"),
+                                        count_fn=lambda: count_products(self._inv_term),
+                                        fetch_fn=lambda off, lim: get_products(self._inv_term, lim, off),
+                                        row_fn=self._inventory_row)
         self.tree_inv.heading("id", text="ID"); self.tree_inv.column("id", width=60, anchor="center")
         self.tree_inv.heading("name", text="Nome"); self.tree_inv.column("name", width=380)
         self.tree_inv.heading("qty", text="Qtd"); self.tree_inv.column("qty", width=80, anchor="center")
@@ -297,6 +2864,7 @@ class InventoryApp:
         ttk.Button(footer, text="Entrada", command=lambda: self.open_stock("in")).pack(side="left", padx=4)
         ttk.Button(footer, text="Saída", command=lambda: self.open_stock("out")).pack(side="left", padx=4)
         ttk.Button(footer, text="Excluir", command=self.delete_selected).pack(side="left", padx=4)
+        ttk.Button(footer, text="Importar Movimentações CSV", command=self.import_movements_csv).pack(side="left", padx=4)
         ttk.Button(footer, text="Exportar CSV", command=self.export_products_csv).pack(side="right")
 
     #Transactions
@@ -307,8 +2875,12 @@ class InventoryApp:
         top.pack(fill="x")
         ttk.Button(top, text="Atualizar", command=self.refresh_transactions).pack(side="left")
         ttk.Button(top, text="Exportar CSV", command=self.export_transactions_csv).pack(side="left", padx=6)
+        ttk.Button(top, text="Arquivar antigas...", command=self.archive_history).pack(side="left")
 
-        self.tree_tr = ttk.Treeview(container, columns=("prod","type","qty","date","note"), show="headings")
+        self.tree_tr = VirtualTreeview(container, ("prod","type","qty","date","note"),
+                                       count_fn=count_transactions,
+                                       fetch_fn=lambda off, lim: get_transactions(limit=lim, offset=off),
+                                       row_fn=self._transaction_row, seek_fn=self._transactions_seek)
         self.tree_tr.heading("prod", text="Produto")
         self.tree_tr.heading("type", text="Tipo")
         self.tree_tr.heading("qty", text="Qtd")
@@ -316,8 +2888,64 @@ class InventoryApp:
         self.tree_tr.heading("note", text="Observação")
         self.tree_tr.pack(fill="both", expand=True, pady=8)
 
+    #Validade
+    def _build_expiry(self):
+        container = ttk.Frame(self.tab_expiry, padding=10)
+        container.pack(fill="both", expand=True)
+        top = ttk.Frame(container)
+        top.pack(fill="x")
+        ttk.Label(top, text="Vencendo em (dias):").pack(side="left")
+        self.exp_days = tk.StringVar(value=str(EXPIRY_WARNING_DAYS))
+        ttk.Entry(top, textvariable=self.exp_days, width=6).pack(side="left", padx=6)
+        self.exp_include = tk.BooleanVar(value=True)
+        ttk.Checkbutton(top, text="Incluir vencidos", variable=self.exp_include,
+                        command=lambda: self.refresh_expiry(reset=True)).pack(side="left", padx=6)
+        ttk.Button(top, text="Atualizar", command=lambda: self.refresh_expiry(reset=True)).pack(side="left")
+        self.exp_summary = ttk.Label(top)
+        self.exp_summary.pack(side="left", padx=12)
+
+        self._exp_filter = (EXPIRY_WARNING_DAYS, True)
+        self.tree_exp = VirtualTreeview(container, ("id","name","lot","qty","price","expiry","days","value"),
+                                        count_fn=lambda: count_expiring(*self._exp_filter),
+                                        fetch_fn=lambda off, lim: get_expiring(*self._exp_filter, lim, off),
+                                        row_fn=self._expiry_row)
+        for col, text, width in (("id", "ID", 60), ("name", "Nome", 300), ("lot", "Lote", 100), ("qty", "Qtd", 70),
+                                 ("price", "Preço (R$)", 100), ("expiry", "Validade", 110),
+                                 ("days", "Dias", 70), ("value", "Valor em risco (R$)", 140)):
+            self.tree_exp.heading(col, text=text)
+            self.tree_exp.column(col, width=width, anchor="w" if col == "name" else "center")
+        self.tree_exp.pack(fill="both", expand=True, pady=8)
+
+    #Posição em uma data
+    def _build_position(self):
+        container = ttk.Frame(self.tab_position, padding=10)
+        container.pack(fill="both", expand=True)
+        top = ttk.Frame(container)
+        top.pack(fill="x")
+        ttk.Label(top, text="Posição ao fim de (YYYY-MM-DD):").pack(side="left")
+        last_close = datetime.date.today().replace(day=1) - datetime.timedelta(days=1)
+        self.pos_day = tk.StringVar(value=last_close.isoformat())
+        ttk.Entry(top, textvariable=self.pos_day, width=12).pack(side="left", padx=6)
+        ttk.Button(top, text="Calcular", command=lambda: self.refresh_position(reset=True)).pack(side="left")
+        ttk.Button(top, text="Exportar CSV", command=self.export_position_csv).pack(side="left", padx=6)
+        self.pos_summary = ttk.Label(top)
+        self.pos_summary.pack(side="left", padx=12)
+
+        self._pos_date = last_close.isoformat()
+        self.tree_pos = VirtualTreeview(container, ("id","name","qty","price","value"),
+                                        count_fn=lambda: self._pos_count,
+                                        fetch_fn=lambda off, lim: stock_as_of(self._pos_date, lim, off),
+                                        row_fn=self._position_row)
+        self._pos_count = 0
+        for col, text, width in (("id", "ID", 60), ("name", "Nome", 380), ("qty", "Qtd", 90),
+                                 ("price", "Preço (R$)", 110), ("value", "Valor (R$)", 130)):
+            self.tree_pos.heading(col, text=text)
+            self.tree_pos.column(col, width=width, anchor="w" if col == "name" else "center")
+        self.tree_pos.pack(fill="both", expand=True, pady=8)
+
     #Reports
     def _build_reports(self):
+        self._reports_built = True
         container = ttk.Frame(self.tab_reports, padding=10)
         container.pack(fill="both", expand=True)
         top = ttk.Frame(container)
@@ -325,13 +2953,28 @@ class InventoryApp:
         ttk.Label(top, text="Período (dias):").pack(side="left")
         self.report_days = tk.IntVar(value=30)
         ttk.Entry(top, textvariable=self.report_days, width=6).pack(side="left", padx=6)
+        ttk.Label(top, text="Agrupar por:").pack(side="left")
+        self.report_gran = tk.StringVar(value="Dia")
+        ttk.Combobox(top, textvariable=self.report_gran, values=list(self.REPORT_GRANULARITY), state="readonly",
+                     width=8).pack(side="left", padx=6)
         ttk.Button(top, text="Gerar Relatório", command=self.update_report_chart).pack(side="left")
         if not HAS_MPL:
             ttk.Label(container, text="matplotlib não instalado. Instale com: pip install matplotlib", foreground="gray").pack(pady=12)
             return
 
-        self.fig = plt.Figure(figsize=(8,4))
+        Figure, FigureCanvasTkAgg = _load_mpl() or (None, None)
+        if Figure is None:
+            ttk.Label(container, text="Não foi possível carregar o matplotlib.", foreground="gray").pack(pady=12)
+            return
+        self.fig = Figure(figsize=(8,4))
         self.ax = self.fig.add_subplot(111)
+        self.ax.grid(True)
+        self.ax.tick_params(axis="x", labelrotation=30)
+        self.fig.subplots_adjust(bottom=0.2)
+        self._report_lines = None
+        self._report_key = None
+        self._report_shown = None
+        self._report_products_shown = None
         self.canvas = FigureCanvasTkAgg(self.fig, master=container)
         self.canvas.get_tk_widget().pack(fill="both", expand=True)
         self.report_table = ttk.Treeview(container, columns=("date","in","out"), show="headings", height=6)
@@ -339,47 +2982,255 @@ class InventoryApp:
         self.report_table.heading("in", text="Entradas")
         self.report_table.heading("out", text="Saídas")
         self.report_table.pack(fill="x", pady=8)
+        self.report_products = ttk.Treeview(container, columns=("prod","in","out"), show="headings", height=6)
+        self.report_products.heading("prod", text="Produto")
+        self.report_products.heading("in", text="Entradas")
+        self.report_products.heading("out", text="Saídas")
+        self.report_products.pack(fill="x")
+
+    #Diagnóstico
+    def _build_diagnostics(self):
+        container = ttk.Frame(self.tab_diagnostics, padding=10)
+        container.pack(fill="both", expand=True)
+        top = ttk.Frame(container)
+        top.pack(fill="x")
+        ttk.Button(top, text="Atualizar", command=self.refresh_diagnostics).pack(side="left")
+        ttk.Button(top, text="Zerar", command=self._reset_diagnostics).pack(side="left", padx=6)
+        ttk.Button(top, text="Salvar JSON...", command=self._dump_diagnostics).pack(side="left")
+        self.diag_info = ttk.Label(top, foreground="gray")
+        self.diag_info.pack(side="left", padx=12)
+
+        cols = ("name", "calls", "mean", "p95", "max", "rows", "errors")
+        self.diag_table = ttk.Treeview(container, columns=cols, show="headings", height=10)
+        for col, text, width in zip(cols, ("Operação", "Chamadas", "Média ms", "p95 ms", "Máx ms", "Linhas", "Erros"),
+                                    (420, 80, 80, 80, 80, 80, 60)):
+            self.diag_table.heading(col, text=text)
+            self.diag_table.column(col, width=width, anchor="w" if col == "name" else "e", stretch=col == "name")
+        self.diag_table.pack(fill="both", expand=True, pady=8)
+
+        ttk.Label(container, text="Consultas lentas").pack(anchor="w")
+        bottom = ttk.Frame(container)
+        bottom.pack(fill="both", expand=True)
+        self.diag_slow = ttk.Treeview(bottom, columns=("at", "ms", "fn", "sql"), show="headings", height=6)
+        for col, text, width in (("at", "Quando", 160), ("ms", "ms", 70), ("fn", "Função", 160), ("sql", "SQL", 400)):
+            self.diag_slow.heading(col, text=text)
+            self.diag_slow.column(col, width=width, stretch=col == "sql")
+        self.diag_slow.pack(side="left", fill="both", expand=True)
+        self.diag_plan = tk.Text(bottom, width=50, height=6, wrap="word")
+        self.diag_plan.pack(side="left", fill="both", padx=(8, 0))
+        self.diag_slow.bind("<<TreeviewSelect>>", self._show_slow_plan)
+        self._slow_entries = []
+
+    @profiled
+    def refresh_diagnostics(self):
+        snap = profiler.snapshot()
+        if not snap["enabled"]:
+            info = "Instrumentação desligada: inicie com --perfil ou ESTOQUE_PERFIL=1."
+        else:
+            info = f"Desde {snap['started']}; consultas lentas a partir de {snap['slow_ms']:g} ms"
+        pc = snap["caches"]["products"]
+        info += (f"\nCache de produtos: {pc['size']} itens, {pc['hits']} acertos, {pc['misses']} faltas "
+                 f"({pc['hit_rate']:.0%}), {pc['invalidations']} invalidações")
+        rc = snap["caches"]["reports"]
+        info += (f"; relatórios: {rc['hits']} acertos, {rc['updates']} incrementais, "
+                 f"{rc['misses']} recálculos")
+        self.diag_info.config(text=info)
+        self.diag_table.delete(*self.diag_table.get_children())
+        rows = [(name, st) for name, st in snap["functions"].items()]
+        rows += [("SQL " + name, st) for name, st in snap["queries"].items()]
+        rows.sort(key=lambda item: item[1]["total_ms"], reverse=True)
+        for name, st in rows:
+            self.diag_table.insert("", "end", values=(name[:200], st["calls"], f"{st['mean_ms']:.2f}",
+                                                      f"{st['p95_ms']:.2f}", f"{st['max_ms']:.2f}",
+                                                      st["rows"], st["errors"]))
+        self.diag_slow.delete(*self.diag_slow.get_children())
+        self._slow_entries = snap["slow"][::-1]
+        for i, e in enumerate(self._slow_entries):
+            self.diag_slow.insert("", "end", iid=str(i), values=(e["at"], f"{e['ms']:.1f}", e["function"] or "-",
+                                                                e["sql"][:200]))
+        self.diag_plan.delete("1.0", "end")
+
+    def _show_slow_plan(self, event=None):
+        sel = self.diag_slow.selection()
+        if not sel:
+            return
+        e = self._slow_entries[int(sel[0])]
+        text = f"{e['sql']}\n\nParâmetros: {e['params']}\nLinhas: {e['rows']}\n\nPlano:\n"
+        text += "\n".join(e["plan"]) or "(sem plano)"
+        self.diag_plan.delete("1.0", "end")
+        self.diag_plan.insert("1.0", text)
+
+    def _reset_diagnostics(self):
+        profiler.reset()
+        self.refresh_diagnostics()
+
+    def _dump_diagnostics(self):
+        path = filedialog.asksaveasfilename(defaultextension=".json", filetypes=[("JSON", "*.json")])
+        if not path: return
+        profiler.dump(path)
+        messagebox.showinfo("Diagnóstico", f"Diagnóstico salvo em {os.path.basename(path)}")
 
     #Actions / Refresh
     def refresh_all(self):
-        self.refresh_dashboard()
-        self.refresh_inventory()
-        self.refresh_transactions()
-        self.update_report_chart()
+        # só a aba visível recarrega agora; as outras ao serem selecionadas
+        self._invalidate(*self._views)
+
+    def _invalidate(self, *tabs):
+        current = self.nb.select()
+        for tab in map(str, tabs):
+            if tab == current:
+                self._dirty.discard(tab)
+                self._views[tab]()
+            else:
+                self._dirty.add(tab)
+
+    def _on_tab_changed(self, event=None):
+        current = self.nb.select()
+        if current in self._dirty:
+            self._dirty.discard(current)
+            self._views[current]()
+
+    def _on_db_change(self, kind, ids):
+        # pode vir de um worker (importação); aplica na thread do Tk
+        self.jobs.post(self._apply_db_change, kind, ids)
+
+    def _apply_db_change(self, kind, ids):
+        if kind in ("moved", "updated"):
+            self._patch_inventory(ids)
+            self._invalidate(self.tab_dashboard, self.tab_transactions, self.tab_expiry, self.tab_position,
+                             self.tab_reports)
+        elif kind == "added":
+            # o saldo inicial entra como movimentação "Estoque inicial"
+            self._invalidate(self.tab_inventory, self.tab_dashboard, self.tab_expiry, self.tab_transactions,
+                             self.tab_reports, self.tab_position)
+        else:
+            self._invalidate(*self._views)
+
+    def _patch_inventory(self, ids):
+        ids = self.tree_inv.loaded_ids(ids)
+        rows = [get_product(int(i)) for i in ids]
+        self.tree_inv.update_rows([r for r in rows if r is not None])
 
+    @profiled
     def refresh_dashboard(self):
-        prods = get_products()
-        total_products = len(prods)
-        total_units = sum([p["quantity"] for p in prods])
-        low = [p for p in prods if p["quantity"] <= 5]
-        self.card_total.value_label.config(text=str(total_products))
-        self.card_units.value_label.config(text=str(total_units))
-        self.card_low.value_label.config(text=str(len(low)))
+        self.jobs.submit("dashboard", self._load_dashboard, self._show_dashboard, label="resumo")
+
+    @staticmethod
+    @profiled
+    def _load_dashboard():
+        total, units, low_count = get_stock_summary()
+        return {
+            "total": total,
+            "units": units,
+            "low_count": low_count,
+            "low": get_low_stock(12),
+            "today": get_day_totals(),
+            "recent": get_transactions(limit=10),
+            "expiry": get_expiry_summary(),
+        }
+
+    @profiled
+    def _show_dashboard(self, data):
+        self.card_total.value_label.config(text=str(data["total"]))
+        self.card_units.value_label.config(text=str(data["units"]))
+        self.card_low.value_label.config(text=str(data["low_count"]))
+        q_in, q_out = data["today"]
+        self.card_today.value_label.config(text=f"+{q_in} / -{q_out}")
+        expired, expired_value, expiring, expiring_value = data["expiry"]
+        self.card_expiry.value_label.config(text=f"{expired} / {expiring}")
+        self.card_expiry.detail_label.config(text=f"Em risco: R$ {expired_value + expiring_value:.2f}")
 
         for i in self.rv_recent.get_children(): self.rv_recent.delete(i)
-        recent = get_transactions(limit=10)
-        for r in recent:
+        for r in data["recent"]:
             tipo = "Entrada" if r["type"] == "in" else "Saída"
             self.rv_recent.insert("", "end", values=(r["name"], tipo, r["quantity"], r["created_at"][:19]))
 
         for i in self.lv_low.get_children(): self.lv_low.delete(i)
-        for p in low[:12]:
-            self.lv_low.insert("", "end", values=(p["name"], p["quantity"]))
+        for p in data["low"]:
+            self.lv_low.insert("", "end", values=(p["name"], p["quantity"], p["min_quantity"]))
+
+    def _inventory_row(self, r):
+        exp = r["expiry_date"] or "-"
+        return r["id"], (r["id"], r["name"], r["quantity"], f"{r['price']:.2f}", exp)
+
+    @staticmethod
+    def _transactions_seek(row, direction, limit):
+        if row["created_at"] is None:
+            return None
+        key = (row["created_at"], row["id"])
+        return get_transactions(limit=limit, before=key) if direction > 0 else get_transactions(limit=limit, after=key)
+
+    def _transaction_row(self, r):
+        tipo = "Entrada" if r["type"] == "in" else "Saída"
+        return r["id"], (r["name"], tipo, r["quantity"], r["created_at"][:19], r["note"] or "")
+
+    SEARCH_DEBOUNCE_MS = 250
+
+    def _on_search_typed(self, *args):
+        if self._search_after is not None:
+            self.root.after_cancel(self._search_after)
+        self._search_after = self.root.after(self.SEARCH_DEBOUNCE_MS, self._search_now)
 
-    def refresh_inventory(self):
-        s = self.inv_search.get().strip()
-        rows = get_products(s if s else None)
-        for i in self.tree_inv.get_children(): self.tree_inv.delete(i)
-        for r in rows:
-            exp = r["expiry_date"] or "-"
-            self.tree_inv.insert("", "end", iid=r["id"], values=(r["id"], r["name"], r["quantity"], f"{r['price']:.2f}", exp))
+    def _search_now(self):
+        self._search_after = None
+        self.refresh_inventory(reset=True)
 
+    @profiled
+    def refresh_inventory(self, reset=False):
+        self._inv_term = self.inv_search.get().strip() or None
+        self.jobs.submit("inventory", lambda: self.tree_inv.load(reset), self.tree_inv.apply, label="estoque")
+
+    @profiled
     def refresh_transactions(self):
-        for i in self.tree_tr.get_children(): self.tree_tr.delete(i)
-        rows = get_transactions()
-        for r in rows:
-            tipo = "Entrada" if r["type"] == "in" else "Saída"
-            self.tree_tr.insert("", "end", values=(r["name"], tipo, r["quantity"], r["created_at"][:19], r["note"] or ""))
+        self.jobs.submit("transactions", self.tree_tr.load, self.tree_tr.apply, label="movimentações")
+
+    def _expiry_row(self, r):
+        try:
+            days = (datetime.date.fromisoformat(r["expiry_date"]) - datetime.date.today()).days
+        except ValueError:
+            days = "-"
+        return r["lot_id"], (r["id"], r["name"], r["lot"] or "", r["quantity"], f"{r['price']:.2f}",
+                             r["expiry_date"], days, f"{r['value_at_risk']:.2f}")
+
+    @profiled
+    def refresh_expiry(self, reset=False):
+        days = max(0, safe_int(self.exp_days.get(), EXPIRY_WARNING_DAYS))
+        self._exp_filter = (days, self.exp_include.get())
+        self.jobs.submit("expiry", lambda: (self.tree_exp.load(reset), get_expiry_summary(days)),
+                         lambda data: self._show_expiry(days, data), label="validade")
+
+    def _show_expiry(self, days, data):
+        view, (expired, expired_value, expiring, expiring_value) = data
+        self.tree_exp.apply(view)
+        self.exp_summary.config(text=f"Vencidos: {expired} (R$ {expired_value:.2f})    "
+                                     f"Vencendo em {days} dias: {expiring} (R$ {expiring_value:.2f})")
+
+    def _position_row(self, r):
+        return r["id"], (r["id"], r["name"], r["quantity"], f"{r['price']:.2f}", f"{r['value']:.2f}")
+
+    def _position_day(self):
+        day = parse_date_str(self.pos_day.get())
+        if day is None:
+            messagebox.showerror("Erro", "Data inválida; use YYYY-MM-DD.")
+        return day
+
+    @profiled
+    def refresh_position(self, reset=False):
+        day = self._position_day()
+        if day is None:
+            return
+
+        def load():
+            ensure_month_end_snapshots()
+            totals = stock_as_of_totals(day)
+            self._pos_date, self._pos_count = day, totals[0]
+            return self.tree_pos.load(reset), totals
+        self.jobs.submit("position", load, lambda data: self._show_position(day, data), label="posição")
+
+    def _show_position(self, day, data):
+        view, (products, units, value) = data
+        self.tree_pos.apply(view)
+        self.pos_summary.config(text=f"{products} produtos, {units} unidades, valor total R$ {value:.2f}")
 
     def get_selected_inventory_id(self):
         sel = self.tree_inv.selection()
@@ -392,10 +3243,8 @@ class InventoryApp:
         dlg = ProductDialog(self.root, title="Novo Produto")
         self.root.wait_window(dlg)
         if getattr(dlg, "saved", False):
-            name, qty, price, expiry = dlg.result
-            add_product(name, qty, price, expiry)
-            self.refresh_inventory()
-            self.refresh_dashboard()
+            name, qty, price, expiry, min_qty = dlg.result
+            add_product(name, qty, price, expiry, min_qty)
 
     def open_edit_selected(self):
         pid = self.get_selected_inventory_id()
@@ -404,10 +3253,8 @@ class InventoryApp:
         dlg = ProductDialog(self.root, product=prod, title="Editar Produto")
         self.root.wait_window(dlg)
         if getattr(dlg, "saved", False):
-            name, qty, price, expiry = dlg.result
-            update_product(pid, name, qty, price, expiry)
-            self.refresh_inventory()
-            self.refresh_dashboard()
+            name, qty, price, expiry, min_qty = dlg.result
+            update_product(pid, name, qty, price, expiry, min_qty)
 
     def delete_selected(self):
         pid = self.get_selected_inventory_id()
@@ -415,85 +3262,202 @@ class InventoryApp:
         p = get_product(pid)
         if messagebox.askyesno("Confirmar", f"Excluir '{p['name']}' e histórico?"):
             delete_product(pid)
-            self.refresh_inventory()
-            self.refresh_dashboard()
+            self.tree_inv.clear_selection()
 
     def open_stock(self, ttype):
         pid = self.get_selected_inventory_id()
         if not pid: return
         prod = get_product(pid)
-        dlg = StockDialog(self.root, product=prod, ttype=ttype)
+        dlg = StockDialog(self.root, product=prod, ttype=ttype, lots=get_lots(pid))
         self.root.wait_window(dlg)
         if getattr(dlg, "applied", False):
-            qty, note = dlg.result
+            qty, note, lot, expiry = dlg.result
             try:
-                change_stock(pid, qty, ttype, note)
+                change_stock(pid, qty, ttype, note, lot, expiry)
                 messagebox.showinfo("Sucesso", "Movimentação registrada.")
-                self.refresh_inventory()
-                self.refresh_dashboard()
-                self.refresh_transactions()
             except Exception as e:
                 messagebox.showerror("Erro", str(e))
 
+    def import_movements_csv(self):
+        path = filedialog.askopenfilename(filetypes=[("CSV","*.csv")])
+        if not path: return
+        self.jobs.submit("import_movements", lambda: apply_movements(read_movements_csv(path)),
+                         self._show_movements_import, label="importando movimentações")
+
+    def import_products_csv(self):
+        path = filedialog.askopenfilename(filetypes=self.EXPORT_FILETYPES)
+        if not path: return
+        self.jobs.submit("import_products",
+                         lambda: import_products_csv(path, lambda n: self.jobs.progress("import_products",
+                                                                                       f"importando produtos {n}")),
+                         self._show_products_import, label="importando produtos")
+
+    def _show_products_import(self, result):
+        inserted, updated, rejected, report = result
+        msg = f"{inserted} produtos incluídos, {updated} atualizados, {rejected} recusados."
+        if report:
+            msg += f"\n\nLinhas recusadas em {os.path.basename(report)}"
+        messagebox.showinfo("Importação", msg)
+
+    def _show_movements_import(self, result):
+        applied, failures = result
+        msg = f"{applied} movimentações aplicadas, {len(failures)} recusadas."
+        if failures:
+            # linha 1 do CSV é o cabeçalho
+            msg += "\n\n" + "\n".join(f"Linha {i+2}: {m}" for i, m in failures[:15])
+            if len(failures) > 15:
+                msg += f"\n... e mais {len(failures) - 15}"
+        messagebox.showinfo("Importação", msg)
+
     #Reports
+    @profiled
     def update_report_chart(self):
+        if not self._reports_built:
+            self._build_reports()
         if not HAS_MPL:
             return
         days = max(1, int(self.report_days.get() or 30))
-        end = datetime.date.today()
-        start = end - datetime.timedelta(days=days-1)
-        dates = [(start + datetime.timedelta(days=i)).isoformat() for i in range(days)]
-        in_map = {d:0 for d in dates}
-        out_map = {d:0 for d in dates}
-        rows = get_transactions()
-        for r in rows:
-            dt = r["created_at"][:10]
-            if dt >= start.isoformat() and dt <= end.isoformat():
-                if r["type"] == "in":
-                    in_map[dt] += r["quantity"]
-                else:
-                    out_map[dt] += r["quantity"]
-        x = [datetime.date.fromisoformat(d) for d in dates]
-        y_in = [in_map[d] for d in dates]
-        y_out = [out_map[d] for d in dates]
-        self.ax.clear()
-        self.ax.plot(x, y_in, label="Entradas")
-        self.ax.plot(x, y_out, label="Saídas")
-        self.ax.set_title(f"Entradas vs Saídas (últimos {days} dias)")
-        self.ax.legend()
-        self.ax.grid(True)
-        self.fig.autofmt_xdate()
-        self.canvas.draw()
-
-        for i in self.report_table.get_children(): self.report_table.delete(i)
-        for d in dates:
-            self.report_table.insert("", "end", values=(d, in_map[d], out_map[d]))
+        gran = self.REPORT_GRANULARITY.get(self.report_gran.get(), "day")
+        label = self.report_gran.get().lower()
+        self.jobs.submit("report", lambda: self._load_report(days, gran),
+                         lambda data: self._show_report(days, gran, label, data), label="relatório")
+
+    @staticmethod
+    @profiled
+    def _load_report(days, gran):
+        return report_cache.get(days, gran)
+
+    @profiled
+    def _show_report(self, days, gran, label, data):
+        buckets, y_in, y_out, products = data
+        key = (days, gran, buckets[0])
+        if key != self._report_key:
+            # outra série: troca os dados das linhas existentes e remonta a tabela
+            x = [datetime.date.fromisoformat(d) for d in buckets]
+            if self._report_lines is None:
+                self._report_lines = (self.ax.plot(x, y_in, label="Entradas")[0],
+                                      self.ax.plot(x, y_out, label="Saídas")[0])
+                self.ax.legend()
+            else:
+                self._report_lines[0].set_data(x, y_in)
+                self._report_lines[1].set_data(x, y_out)
+            self.ax.set_title(f"Entradas vs Saídas (últimos {days} dias, por {label})")
+            self.report_table.delete(*self.report_table.get_children())
+            for d, yi, yo in zip(buckets, y_in, y_out):
+                self.report_table.insert("", "end", iid=d, values=(d, yi, yo))
+            self._report_key = key
+        else:
+            # mesma série: só os períodos que mudaram desde o que está na tela
+            shown_in, shown_out = self._report_shown
+            changed = [i for i in range(len(buckets)) if (y_in[i], y_out[i]) != (shown_in[i], shown_out[i])]
+            if not changed and products == self._report_products_shown:
+                return
+            self._report_lines[0].set_ydata(y_in)
+            self._report_lines[1].set_ydata(y_out)
+            for i in changed:
+                self.report_table.item(buckets[i], values=(buckets[i], y_in[i], y_out[i]))
+        self._report_shown = (y_in, y_out)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self.canvas.draw_idle()
+        if products != self._report_products_shown:
+            self.report_products.delete(*self.report_products.get_children())
+            for r in products:
+                self.report_products.insert("", "end", values=(r["name"], r["in_qty"], r["out_qty"]))
+            self._report_products_shown = products
 
     def _inform_mpl(self):
         messagebox.showinfo("matplotlib ausente", "Instale matplotlib para habilitar gráficos:\n\npip install matplotlib")
 
     # ---------------- Export ----------------
+    EXPORT_FILETYPES = [("CSV","*.csv"), ("CSV compactado (gzip)","*.csv.gz")]
+
     def export_products_csv(self):
-        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV","*.csv")])
+        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=self.EXPORT_FILETYPES)
         if not path: return
-        rows = get_products()
-        with open(path, "w", newline='', encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["id","name","quantity","price","expiry_date","created_at"])
-            for r in rows:
-                w.writerow([r["id"], r["name"], r["quantity"], r["price"], r["expiry_date"], r["created_at"]])
-        messagebox.showinfo("Exportado", f"Produtos exportados para {os.path.basename(path)}")
+        self._run_export("export_products", "exportando produtos",
+                         lambda progress, cancel: write_products_csv(path, progress=progress, cancel=cancel),
+                         f"Produtos exportados para {os.path.basename(path)}")
 
     def export_transactions_csv(self):
-        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV","*.csv")])
+        dlg = ExportDialog(self.root)
+        self.root.wait_window(dlg)
+        if not getattr(dlg, "confirmed", False):
+            return
+        product_id, start, end = dlg.result
+        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=self.EXPORT_FILETYPES)
         if not path: return
-        rows = get_transactions()
-        with open(path, "w", newline='', encoding="utf-8") as f:
-            w = csv.writer(f)
-            w.writerow(["id","product_id","product_name","type","quantity","created_at","note"])
-            for r in rows:
-                w.writerow([r["id"], r["product_id"], r["name"], r["type"], r["quantity"], r["created_at"], r["note"]])
-        messagebox.showinfo("Exportado", f"Histórico exportado para {os.path.basename(path)}")
+        self._run_export("export_transactions", "exportando histórico",
+                         lambda progress, cancel: write_transactions_csv(path, product_id, start, end,
+                                                                         progress=progress, cancel=cancel),
+                         f"Histórico exportado para {os.path.basename(path)}")
+
+    def export_position_csv(self):
+        day = self._position_day()
+        if day is None: return
+        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=self.EXPORT_FILETYPES,
+                                            initialfile=f"posicao_{day}.csv")
+        if not path: return
+        self._run_export("export_position", "exportando posição",
+                         lambda progress, cancel: write_stock_as_of_csv(path, day, progress, cancel),
+                         f"Posição de {day} exportada para {os.path.basename(path)}")
+
+    def archive_history(self):
+        default = (datetime.date.today() - datetime.timedelta(days=365)).isoformat()
+        day = simpledialog.askstring("Arquivar histórico",
+                                     "Arquivar movimentações anteriores a (YYYY-MM-DD):\n"
+                                     "Relatórios e posição em datas passadas continuam disponíveis.",
+                                     initialvalue=default, parent=self.root)
+        if day is None: return
+        day = parse_date_str(day)
+        if day is None:
+            messagebox.showerror("Erro", "Data inválida.")
+            return
+
+        def work():
+            n = archive_transactions(day, progress=lambda done: self.jobs.progress("archive", f"arquivando {done}"))
+            return n, compact_database()
+
+        def finished(result):
+            n, (before, after) = result
+            messagebox.showinfo("Arquivado", f"{n} movimentações arquivadas; banco de {before / 1048576:.1f} MiB "
+                                             f"para {after / 1048576:.1f} MiB.")
+
+        self.jobs.submit("archive", work, finished, lambda exc: messagebox.showerror("Erro", str(exc)),
+                         label="arquivando histórico")
+
+    def _run_export(self, key, label, fn, done_msg):
+        # cada exportação tem o seu cancelamento; uma nova com a mesma chave
+        # torna a anterior obsoleta, então a anterior é cancelada
+        cancel = threading.Event()
+        old = self._exports.pop(key, None)
+        if old:
+            old[0].set()
+            old[1].destroy()
+        button = ttk.Button(self.status_bar, text=f"Cancelar ({label})", command=cancel.set)
+        button.pack(side="right", padx=6, pady=2)
+        self._exports[key] = (cancel, button)
+
+        def progress(done, total):
+            self.jobs.progress(key, f"{label} {done}/{total}")
+
+        def hide_cancel():
+            if self._exports.get(key, (None,))[0] is cancel:
+                del self._exports[key]
+            button.destroy()
+
+        def finished(n):
+            hide_cancel()
+            if n is None:
+                messagebox.showinfo("Exportação", "Exportação cancelada.")
+            else:
+                messagebox.showinfo("Exportado", f"{done_msg} ({n} linhas)")
+
+        def failed(exc):
+            hide_cancel()
+            messagebox.showerror("Erro", str(exc))
+
+        self.jobs.submit(key, lambda: fn(progress, cancel), finished, failed, label=label)
 
 #Dialogs 
 class ProductDialog(tk.Toplevel):
@@ -503,7 +3467,7 @@ class ProductDialog(tk.Toplevel):
         self.result = None
         self.saved = False
         self.title(title)
-        self.geometry("420x340")
+        self.geometry("420x380")
         self.configure(padx=12, pady=12)
         self._build()
         if product:
@@ -524,13 +3488,18 @@ class ProductDialog(tk.Toplevel):
         ttk.Label(frm, text="Data de validade (YYYY-MM-DD):").grid(row=3, column=0, sticky="w", pady=6)
 
         # If tkcalendar is present, use DateEntry; else use simple Entry
-        if HAS_TKCAL:
+        DateEntry = _date_entry_class()
+        if DateEntry is not None:
             self.e_expiry = DateEntry(frm, date_pattern="yyyy-mm-dd")
             self.e_expiry.grid(row=3, column=1, sticky="w", pady=6)
         else:
             self.e_expiry = ttk.Entry(frm, width=18)
             self.e_expiry.grid(row=3, column=1, sticky="w", pady=6)
             ttk.Label(frm, text="(Instale tkcalendar para um seletor de datas)").grid(row=4, column=1, sticky="w")
+        ttk.Label(frm, text="Estoque mínimo:").grid(row=5, column=0, sticky="w", pady=6)
+        self.e_min = ttk.Entry(frm, width=12)
+        self.e_min.insert(0, str(LOW_STOCK_DEFAULT))
+        self.e_min.grid(row=5, column=1, sticky="w", pady=6)
 
         btns = ttk.Frame(frm)
         btns.grid(row=6, column=0, columnspan=2, pady=12)
@@ -541,6 +3510,8 @@ class ProductDialog(tk.Toplevel):
         self.e_name.insert(0, p["name"])
         self.e_qty.insert(0, str(p["quantity"]))
         self.e_price.insert(0, f"{p['price']:.2f}")
+        self.e_min.delete(0, "end")
+        self.e_min.insert(0, str(p["min_quantity"]))
         if p["expiry_date"]:
             # if DateEntry, set via set_date if available
             try:
@@ -555,6 +3526,7 @@ class ProductDialog(tk.Toplevel):
         name = self.e_name.get().strip()
         qty = safe_int(self.e_qty.get().strip(), 0)
         price = safe_float(self.e_price.get().strip(), 0.0)
+        min_qty = max(0, safe_int(self.e_min.get().strip(), LOW_STOCK_DEFAULT))
         # read expiry depending on widget
         expiry = None
         if HAS_TKCAL and hasattr(self.e_expiry, "get_date"):
@@ -569,19 +3541,62 @@ class ProductDialog(tk.Toplevel):
         if not name:
             messagebox.showerror("Erro", "Nome é obrigatório.")
             return
-        self.result = (name, qty, price, expiry)
+        self.result = (name, qty, price, expiry, min_qty)
         self.saved = True
         self.destroy()
 
+class ExportDialog(tk.Toplevel):
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.result = None
+        self.confirmed = False
+        self.title("Exportar Histórico")
+        self.geometry("360x220")
+        self.configure(padx=12, pady=12)
+        self._build()
+
+    def _build(self):
+        frm = ttk.Frame(self)
+        frm.pack(fill="both", expand=True)
+        ttk.Label(frm, text="Filtros opcionais (deixe em branco para exportar tudo)").grid(row=0, column=0, columnspan=2, sticky="w", pady=(0,8))
+        ttk.Label(frm, text="De (YYYY-MM-DD):").grid(row=1, column=0, sticky="w", pady=4)
+        self.e_start = ttk.Entry(frm, width=14)
+        self.e_start.grid(row=1, column=1, sticky="w", pady=4)
+        ttk.Label(frm, text="Até (YYYY-MM-DD):").grid(row=2, column=0, sticky="w", pady=4)
+        self.e_end = ttk.Entry(frm, width=14)
+        self.e_end.grid(row=2, column=1, sticky="w", pady=4)
+        ttk.Label(frm, text="ID do produto:").grid(row=3, column=0, sticky="w", pady=4)
+        self.e_pid = ttk.Entry(frm, width=10)
+        self.e_pid.grid(row=3, column=1, sticky="w", pady=4)
+        btns = ttk.Frame(frm)
+        btns.grid(row=4, column=0, columnspan=2, pady=12)
+        ttk.Button(btns, text="Exportar", command=self._on_ok).pack(side="left", padx=6)
+        ttk.Button(btns, text="Cancelar", command=self.destroy).pack(side="left", padx=6)
+
+    def _on_ok(self):
+        dates = []
+        for e in (self.e_start, self.e_end):
+            raw = e.get().strip()
+            d = parse_date_str(raw)
+            if raw and d is None:
+                messagebox.showerror("Erro", f"Data inválida: {raw}")
+                return
+            dates.append(datetime.date.fromisoformat(d) if d else None)
+        pid = safe_int(self.e_pid.get().strip(), None)
+        self.result = (pid, dates[0], dates[1])
+        self.confirmed = True
+        self.destroy()
+
 class StockDialog(tk.Toplevel):
-    def __init__(self, parent, product, ttype):
+    def __init__(self, parent, product, ttype, lots=()):
         super().__init__(parent)
         self.product = product
         self.ttype = ttype
+        self.lots = lots
         self.result = None
         self.applied = False
         self.title(f"{'Entrada' if ttype=='in' else 'Saída'} - {product['name']}")
-        self.geometry("360x240")
+        self.geometry("400x400")
         self.configure(padx=12, pady=12)
         self._build()
 
@@ -594,6 +3609,24 @@ class StockDialog(tk.Toplevel):
         self.e_qty = ttk.Entry(frm, width=12)
         self.e_qty.insert(0, "1")
         self.e_qty.pack(anchor="w", pady=4)
+        if self.ttype == "in":
+            row = ttk.Frame(frm)
+            row.pack(fill="x", pady=4)
+            ttk.Label(row, text="Lote:").pack(side="left")
+            self.e_lot = ttk.Entry(row, width=12)
+            self.e_lot.pack(side="left", padx=(4, 12))
+            ttk.Label(row, text="Validade (YYYY-MM-DD):").pack(side="left")
+            self.e_expiry = ttk.Entry(row, width=11)
+            self.e_expiry.pack(side="left", padx=4)
+        else:
+            ttk.Label(frm, text="Lotes abertos (baixados de cima para baixo):").pack(anchor="w")
+            lv = ttk.Treeview(frm, columns=("lot", "expiry", "qty"), show="headings", height=4)
+            for col, text in (("lot", "Lote"), ("expiry", "Validade"), ("qty", "Saldo")):
+                lv.heading(col, text=text)
+                lv.column(col, width=100, anchor="center")
+            for lot in self.lots:
+                lv.insert("", "end", values=(lot["code"] or "-", lot["expiry_date"] or "-", lot["qty_remaining"]))
+            lv.pack(fill="x", pady=4)
         ttk.Label(frm, text="Observação (opcional):").pack(anchor="w")
         self.tx_note = tk.Text(frm, height=4, width=38)
         self.tx_note.pack()
@@ -608,21 +3641,109 @@ class StockDialog(tk.Toplevel):
             messagebox.showerror("Erro", "Quantidade deve ser positiva.")
             return
         note = self.tx_note.get("1.0", "end").strip()
-        self.result = (qty, note)
+        lot = expiry = None
+        if self.ttype == "in":
+            lot = self.e_lot.get().strip() or None
+            text = self.e_expiry.get().strip()
+            expiry = parse_date_str(text)
+            if text and expiry is None:
+                messagebox.showerror("Erro", "Validade inválida; use YYYY-MM-DD.")
+                return
+        self.result = (qty, note, lot, expiry)
         self.applied = True
         self.destroy()
 
 
 # Main
 
-def main():
+def _report_startup(root, app, marks):
+    """Modo --medir-inicio: espera a aba visível carregar, imprime as etapas e fecha."""
+    def check():
+        if app.jobs.is_busy():
+            root.after(5, check)
+            return
+        marks.append(("aba visível carregada", time.perf_counter()))
+        prev = 0.0
+        for label, t in marks:
+            ms = (t - _STARTUP_T0) * 1000
+            print(f"{label:<24} {ms:9.1f} ms  (+{ms - prev:.1f})")
+            prev = ms
+        print(f"matplotlib carregado: {'sim' if 'matplotlib' in sys.modules else 'não'}")
+        app._on_close()
+
+    def shown():
+        marks.append(("janela exibida", time.perf_counter()))
+        check()
+    root.after_idle(shown)
+
+def main(argv=None):
+    global DB_FILE
+    marks = [("módulos importados", time.perf_counter())]
+    ap = argparse.ArgumentParser(description="Controle de Estoque")
+    ap.add_argument("--db", help=f"arquivo do banco SQLite (padrão: {DB_FILE})")
+    ap.add_argument("--reconstruir-resumo", action="store_true",
+                    help="recalcula o resumo diário de movimentações a partir do histórico e sai")
+    ap.add_argument("--fechamentos", action="store_true",
+                    help="grava os fechamentos mensais de estoque que faltam e sai")
+    ap.add_argument("--arquivar", metavar="AAAA-MM-DD",
+                    help="move para o arquivo as movimentações anteriores a esta data, compacta o banco e sai")
+    ap.add_argument("--arquivo", metavar="DB",
+                    help="banco de arquivo usado por --arquivar (padrão: <banco>.arquivo.db)")
+    ap.add_argument("--importar-produtos", metavar="CSV",
+                    help="importa produtos de um CSV no formato da exportação e sai")
+    ap.add_argument("--servidor", action="store_true",
+                    help="inicia a API HTTP/JSON sem interface gráfica")
+    ap.add_argument("--host", default="127.0.0.1", help="endereço do servidor (padrão: 127.0.0.1)")
+    ap.add_argument("--porta", type=int, default=8765, help="porta do servidor (padrão: 8765)")
+    ap.add_argument("--perfil", action="store_true",
+                    help="liga a instrumentação (tempos, consultas lentas; também via ESTOQUE_PERFIL=1)")
+    ap.add_argument("--perfil-lento-ms", type=float, metavar="MS",
+                    help=f"limite de consulta lenta em ms (padrão: {PROFILE_SLOW_MS:g})")
+    ap.add_argument("--perfil-saida", metavar="JSON",
+                    help="grava o diagnóstico neste arquivo ao sair (implica --perfil)")
+    ap.add_argument("--medir-inicio", action="store_true",
+                    help="mede o tempo de abertura da janela e da primeira aba, imprime e sai")
+    args = ap.parse_args(argv)
+    if args.db:
+        DB_FILE = args.db
+    if args.perfil or args.perfil_saida or args.perfil_lento_ms is not None:
+        enable_profiling(args.perfil_lento_ms)
+    if args.perfil_saida:
+        atexit.register(profiler.dump, args.perfil_saida)
     init_db()
+    marks.append(("banco aberto", time.perf_counter()))
+    if args.reconstruir_resumo:
+        n = rebuild_daily_movements()
+        print(f"Resumo diário reconstruído: {n} linhas.")
+        return
+    if args.fechamentos:
+        n = ensure_month_end_snapshots()
+        print(f"{n} fechamentos mensais gravados.")
+        return
+    if args.arquivar:
+        if parse_date_str(args.arquivar) is None:
+            ap.error("--arquivar espera uma data AAAA-MM-DD")
+        n = archive_transactions(args.arquivar, args.arquivo,
+                                 progress=lambda done: print(f"  {done} movimentações arquivadas...", end="\r"))
+        before, after = compact_database()
+        state = get_archive_state()
+        where = f" em {state['path']}" if state else ""
+        print(f"\r{n} movimentações arquivadas{where}; banco de {before / 1048576:.1f} MiB para {after / 1048576:.1f} MiB.")
+        return
+    if args.importar_produtos:
+        inserted, updated, rejected, report = import_products_csv(args.importar_produtos)
+        print(f"{inserted} produtos incluídos, {updated} atualizados, {rejected} recusados.")
+        if report:
+            print(f"Linhas recusadas em {report}")
+        return
+    if args.servidor:
+        run_server(args.host, args.porta)
+        return
     root = tk.Tk()
     app = InventoryApp(root)
-    # If matplotlib is available, initialize report axes
-    if HAS_MPL:
-        # create axes placeholders so update_report_chart won't break if invoked early
-        app.ax = app.fig.add_subplot(111) if hasattr(app, 'fig') else None
+    if args.medir_inicio:
+        marks.append(("interface montada", time.perf_counter()))
+        _report_startup(root, app, marks)
     root.mainloop()
 
 if __name__ == "__main__":
@@ -0,0 +1,633 @@
+"""Testes das funções de dados do controle de estoque, em um banco temporário."""
+import asyncio, datetime, gzip, json, os, random, sqlite3, sys, tempfile, threading, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import controle_de_estoque as app
+
+
+class BancoTemporario(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.old_db = app.DB_FILE
+        app.DB_FILE = os.path.join(self.tmp.name, "teste.db")
+        app.product_cache.clear()
+        app.report_cache.clear()
+        app.init_db()
+        self.conn = app.get_connection()
+
+    def tearDown(self):
+        if app._writer is not None:
+            app._writer.close()
+        app.close_connections()
+        app.product_cache.clear()
+        app.report_cache.clear()
+        app.DB_FILE = self.old_db
+        self.tmp.cleanup()
+
+    def quantity(self, pid):
+        return self.conn.execute("SELECT quantity FROM products WHERE id=?", (pid,)).fetchone()[0]
+
+
+class TestChangeStock(BancoTemporario):
+    def test_saida_maior_que_saldo_e_recusada(self):
+        pid = app.add_product("Arroz", 5, 10.0, None)
+        with self.assertRaisesRegex(ValueError, "Quantidade insuficiente."):
+            app.change_stock(pid, 6, "out")
+        self.assertEqual(self.quantity(pid), 5)
+        self.assertEqual(app.count_transactions(pid), 1)  # só o estoque inicial
+        self.assertEqual(app.change_stock(pid, 5, "out"), 0)
+
+    def test_produto_inexistente(self):
+        with self.assertRaisesRegex(ValueError, "Produto não encontrado."):
+            app.change_stock(999, 1, "in")
+        self.assertEqual(app.count_transactions(), 0)
+
+
+class TestApplyMovements(BancoTemporario):
+    def test_falhas_parciais_nao_afetam_as_demais(self):
+        a = app.add_product("A", 10, 1.0, None)
+        b = app.add_product("B", 2, 1.0, None)
+        applied, failures = app.apply_movements([
+            (a, 3, "out", "ok"),
+            (b, 5, "out", "sem saldo"),
+            (999, 1, "in", "sem produto"),
+            (a, 0, "in", "quantidade zero"),
+            (a, 1, "x", "tipo inválido"),
+            (b, 4, "in", "ok"),
+        ])
+        self.assertEqual(applied, 2)
+        self.assertEqual([i for i, _ in failures], [1, 2, 3, 4])
+        self.assertEqual(dict(failures)[1], "Quantidade insuficiente.")
+        self.assertEqual(dict(failures)[2], "Produto não encontrado.")
+        self.assertEqual(self.quantity(a), 7)
+        self.assertEqual(self.quantity(b), 6)
+
+
+class TestMigracoes(BancoTemporario):
+    def test_banco_antigo_chega_a_versao_atual(self):
+        path = os.path.join(self.tmp.name, "antigo.db")
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        try:
+            # esquema anterior às migrações, com dados
+            conn.executescript("""
+                CREATE TABLE products (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT NOT NULL,
+                    quantity INTEGER DEFAULT 0, price REAL DEFAULT 0, expiry_date TEXT, created_at TEXT);
+                CREATE TABLE transactions (id INTEGER PRIMARY KEY AUTOINCREMENT, product_id INTEGER NOT NULL,
+                    type TEXT NOT NULL, quantity INTEGER NOT NULL, created_at TEXT, note TEXT);
+                INSERT INTO products (name, quantity, price, expiry_date, created_at)
+                    VALUES ('Feijão', 4, 8.5, '', '2024-01-02T10:00:00');
+                INSERT INTO transactions (product_id, type, quantity, created_at, note)
+                    VALUES (1, 'in', 4, '2024-01-02T10:00:00', 'Estoque inicial');
+            """)
+            self.assertEqual(app.migrate(conn), len(app.MIGRATIONS))
+            self.assertEqual(app.migrate(conn), len(app.MIGRATIONS))
+            row = conn.execute("SELECT quantity, min_quantity, expiry_date FROM products").fetchone()
+            self.assertEqual(tuple(row), (4, app.LOW_STOCK_DEFAULT, None))
+            self.assertEqual(conn.execute("SELECT qty_remaining FROM lots").fetchone()[0], 4)
+            self.assertEqual(tuple(conn.execute("SELECT day, in_qty FROM daily_movements").fetchone()),
+                             ("2024-01-02", 4))
+            plan = " ".join(r[-1] for r in conn.execute(
+                "EXPLAIN QUERY PLAN " + app._transactions_query(1, limit=10)[0], [1, 10, 0]))
+            self.assertIn("idx_transactions_product_created", plan)
+        finally:
+            conn.close()
+
+
+class TestPaginacao(BancoTemporario):
+    def test_paginas_por_chave_iguais_as_por_offset(self):
+        pid = app.add_product("Açúcar", 0, 3.0, None)
+        when = "2025-03-01T08:00:00"
+        with self.conn:
+            # horários repetidos: o id desempata a ordem
+            self.conn.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) "
+                                  "VALUES (?,'in',?,?,'')", [(pid, k, when) for k in range(1, 24)])
+        total = app.count_transactions()
+        everything = [r["id"] for r in app.get_transactions()]
+        self.assertEqual(len(everything), total)
+        self.assertEqual([r["id"] for r in app.iter_transactions(chunk_size=4)], everything)
+        pages, before = [], None
+        while True:
+            page = app.get_transactions(limit=5, before=before)
+            if not page:
+                break
+            self.assertEqual([r["id"] for r in page],
+                             [r["id"] for r in app.get_transactions(limit=5, offset=len(pages) * 5)])
+            pages.append(page)
+            before = (page[-1]["created_at"], page[-1]["id"])
+        self.assertEqual([r["id"] for p in pages for r in p], everything)
+        newer = app.get_transactions(limit=5, after=(pages[2][0]["created_at"], pages[2][0]["id"]))
+        self.assertEqual([r["id"] for r in newer], [r["id"] for r in pages[1]])
+
+
+class TestExportacao(BancoTemporario):
+    def setUp(self):
+        super().setUp()
+        for k in range(30):
+            app.add_product(f"Produto {k}", k, 1.0, None)
+        self.path = os.path.join(self.tmp.name, "produtos.csv")
+
+    def test_cancelada_nao_deixa_arquivo(self):
+        cancel = threading.Event()
+        old_chunk, app.EXPORT_CHUNK = app.EXPORT_CHUNK, 10
+        try:
+            result = app.write_products_csv(self.path, progress=lambda done, total: cancel.set(), cancel=cancel)
+        finally:
+            app.EXPORT_CHUNK = old_chunk
+        self.assertIsNone(result)
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(app.write_products_csv(self.path + ".gz"), 30)
+        with gzip.open(self.path + ".gz", "rt", encoding="utf-8") as f:
+            self.assertEqual(len(f.read().splitlines()), 31)
+
+    def test_falha_ao_abrir_preserva_arquivo_existente(self):
+        with open(self.path, "w") as f:
+            f.write("anterior")
+
+        def falha(path):
+            raise OSError("disco cheio")
+
+        old_open, app._open_export = app._open_export, falha
+        try:
+            with self.assertRaisesRegex(OSError, "disco cheio"):
+                app.write_products_csv(self.path)
+        finally:
+            app._open_export = old_open
+        with open(self.path) as f:
+            self.assertEqual(f.read(), "anterior")
+
+
+class TestImportacaoProdutos(BancoTemporario):
+    def write_csv(self, lines):
+        path = os.path.join(self.tmp.name, "catalogo.csv")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("id,name,quantity,price,expiry_date,created_at,min_quantity\n" + "\n".join(lines) + "\n")
+        return path
+
+    def lots_match_stock(self):
+        return self.conn.execute("""SELECT COUNT(*) FROM products p WHERE p.quantity <> (
+                                        SELECT COALESCE(SUM(qty_remaining), 0) FROM lots
+                                        WHERE product_id = p.id AND qty_remaining > 0)""").fetchone()[0] == 0
+
+    def test_linhas_invalidas_sao_recusadas(self):
+        path = self.write_csv([",Arroz,10,5.5,,,", ",Feijão,3,nan,,,", ",Milho,3,inf,,,", ",Trigo,-1,2,,,",
+                               ",Sal,2,1,2025-02-30,,", ",,1,1,,,", ",Óleo,4,7.25,2030-01-01,,2"])
+        inserted, updated, rejected, report = app.import_products_csv(path)
+        self.assertEqual((inserted, updated, rejected), (2, 0, 5))
+        self.assertEqual(sorted(r["name"] for r in app.get_products()), ["Arroz", "Óleo"])
+        with open(report, encoding="utf-8") as f:
+            reasons = [line.split(",")[1] for line in f.read().splitlines()[1:]]
+        self.assertEqual(reasons, ["Preço inválido: nan", "Preço inválido: inf", "Quantidade inválida: -1",
+                                   "Data de validade inválida: 2025-02-30", "Nome é obrigatório."])
+        self.assertTrue(self.lots_match_stock())
+
+    def test_lotes_acertados_em_cada_bloco(self):
+        for k in range(4):
+            app.add_product(f"Produto {k}", 5, 1.0, None)
+        path = self.write_csv([f"{k + 1},Produto {k},{k * 3},1.0,,," for k in range(4)])
+        calls = []
+        old_batch, old_import = app.IMPORT_BATCH, app._import_batch
+
+        def falha_no_segundo(cur, batch, now):
+            calls.append(len(batch))
+            if len(calls) == 2:
+                raise RuntimeError("queda no meio da importação")
+            return old_import(cur, batch, now)
+
+        app.IMPORT_BATCH, app._import_batch = 2, falha_no_segundo
+        try:
+            with self.assertRaises(RuntimeError):
+                app.import_products_csv(path)
+        finally:
+            app.IMPORT_BATCH, app._import_batch = old_batch, old_import
+        self.assertEqual([self.quantity(pid) for pid in range(1, 5)], [0, 3, 5, 5])
+        self.assertTrue(self.lots_match_stock())
+
+
+class TestBusca(BancoTemporario):
+    def names(self, search):
+        return [r["name"] for r in app.get_products(search)]
+
+    def test_prefixo_sem_acento_e_sincronizada(self):
+        if not app.has_search_index():
+            self.skipTest("SQLite sem FTS5")
+        arroz = app.add_product("Arroz Integral", 1, 1.0, None)
+        feijao = app.add_product("Feijão Preto", 1, 1.0, None)
+        app.add_product("Farinha de Mandioca", 1, 1.0, None)
+        self.assertEqual(self.names("feij"), ["Feijão Preto"])
+        self.assertEqual(self.names("FEIJAO"), ["Feijão Preto"])
+        self.assertEqual(self.names("arr int"), ["Arroz Integral"])
+        self.assertEqual(app.count_products("fa"), 1)
+        app.update_product(feijao, "Feijão Carioca", 1, 1.0, None)
+        self.assertEqual(self.names("preto"), [])
+        self.assertEqual(self.names("carioca"), ["Feijão Carioca"])
+        app.delete_product(arroz)
+        self.assertEqual(self.names("arroz"), [])
+
+
+class TestCacheProdutos(BancoTemporario):
+    def in_thread(self, fn, *args):
+        result = []
+        t = threading.Thread(target=lambda: result.append(fn(*args)))
+        t.start()
+        t.join()
+        return result[0]
+
+    def test_escritas_deste_processo_nao_esvaziam_o_cache(self):
+        a = app.add_product("A", 5, 1.0, None)
+        b = app.add_product("B", 5, 1.0, None)
+        app.get_product(a)
+        app.get_product(b)
+        before = app.product_cache.stats()
+        self.in_thread(app.change_stock, b, 2, "out")
+        writer = app.GroupCommitWriter()
+        try:
+            self.assertEqual(writer.queue_movement(b, 4, "in").result(timeout=5), 7)
+        finally:
+            writer.close()
+        self.assertEqual(app.get_product(a).quantity, 5)
+        self.assertEqual(app.get_product(b).quantity, 7)
+        self.assertEqual(self.in_thread(lambda: app.get_product(b).quantity), 7)
+        after = app.product_cache.stats()
+        self.assertEqual(after["invalidations"], before["invalidations"])
+        self.assertEqual(after["hits"] - before["hits"], 3)
+        self.assertEqual(after["misses"], before["misses"])
+
+    def test_escrita_de_outro_processo_invalida(self):
+        pid = app.add_product("A", 5, 1.0, None)
+        self.assertEqual(app.get_product(pid).price, 1.0)
+        other = sqlite3.connect(app.DB_FILE)
+        try:
+            with other:
+                other.execute("UPDATE products SET price = 2.5 WHERE id = ?", (pid,))
+        finally:
+            other.close()
+        self.assertEqual(app.get_product(pid).price, 2.5)
+        self.assertEqual(app.profiler.snapshot()["caches"]["products"]["invalidations"],
+                         app.product_cache.invalidations)
+
+
+class TestServidor(BancoTemporario):
+    async def exchange(self, port, raw):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            writer.write(raw)
+            await writer.drain()
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = int(head.decode("latin-1").lower().split("content-length:")[1].split("\r\n")[0])
+            body = json.loads(await reader.readexactly(length))
+            return int(head.split()[1]), body
+        finally:
+            writer.close()
+
+    async def request(self, port, method, target, data=None):
+        body = json.dumps(data).encode() if data is not None else b""
+        return await self.exchange(port, f"{method} {target} HTTP/1.1\r\nContent-Length: {len(body)}\r\n"
+                                         f"Connection: close\r\n\r\n".encode() + body)
+
+    def test_entradas_invalidas_respondem_400(self):
+        pid = app.add_product("Arroz", 5, 1.0, None)
+        server = app.InventoryServer(writer=app.GroupCommitWriter())
+
+        async def run():
+            srv = await asyncio.start_server(server._handle, "127.0.0.1", 0)
+            port = srv.sockets[0].getsockname()[1]
+            async with srv:
+                results = {}
+                for target in ("/produtos?limite=abc", "/produtos?limite=0", "/produtos?offset=-1",
+                               "/movimentos?product_id=x", "/movimentos?antes_data=ontem",
+                               "/relatorios/movimentos?inicio=2025-13-01", "/validade?dias=-5"):
+                    results[target] = (await self.request(port, "GET", target))[0]
+                results["POST quantity<0"] = (await self.request(port, "POST", "/produtos",
+                                                                 {"name": "Feijão", "quantity": -3}))[0]
+                results["POST price nan"] = (await self.request(port, "POST", "/produtos",
+                                                                {"name": "Feijão", "price": "nan"}))[0]
+                results["POST movimento<0"] = (await self.request(port, "POST", "/movimentos",
+                                                                  {"product_id": pid, "quantity": -1,
+                                                                   "type": "in"}))[0]
+                results["cabeçalho grande"] = (await self.exchange(
+                    port, b"GET /resumo HTTP/1.1\r\nX-Grande: " + b"a" * 70000 + b"\r\n\r\n"))[0]
+                status, rows = await self.request(port, "GET", "/produtos?limite=5000")
+                created = await self.request(port, "POST", "/produtos", {"name": "Feijão", "quantity": 2})
+                return results, status, rows, created
+
+        try:
+            results, status, rows, created = asyncio.run(run())
+        finally:
+            server.close()
+        self.assertEqual(results.pop("cabeçalho grande"), 431)
+        self.assertEqual(results, dict.fromkeys(results, 400))
+        self.assertEqual((status, len(rows)), (200, 1))
+        self.assertEqual((created[0], created[1]["quantity"]), (201, 2))
+        self.assertEqual(self.quantity(pid), 5)
+        self.assertEqual(app.count_products(), 2)
+
+
+class TestEscritaAgrupada(BancoTemporario):
+    def test_falha_afeta_so_quem_pediu(self):
+        a = app.add_product("A", 1, 1.0, None)
+        b = app.add_product("B", 10, 1.0, None)
+        writer = app.GroupCommitWriter(window=0.05)
+        try:
+            futures = [writer.queue_movement(b, 1, "out"), writer.queue_movement(a, 5, "out"),
+                       writer.queue_movement(b, 2, "out"), writer.queue_movement(999, 1, "in")]
+            self.assertEqual(futures[0].result(timeout=5), 9)
+            with self.assertRaisesRegex(ValueError, "Quantidade insuficiente."):
+                futures[1].result(timeout=5)
+            self.assertEqual(futures[2].result(timeout=5), 7)
+            with self.assertRaisesRegex(ValueError, "Produto não encontrado."):
+                futures[3].result(timeout=5)
+        finally:
+            writer.close()
+        self.assertEqual(self.quantity(a), 1)
+        self.assertEqual(self.quantity(b), 7)
+
+    def test_erro_em_listener_nao_derruba_o_escritor(self):
+        pid = app.add_product("A", 0, 1.0, None)
+
+        def falha(kind, ids):
+            raise RuntimeError("listener com erro")
+
+        app.subscribe(falha)
+        writer = app.GroupCommitWriter()
+        try:
+            stderr, sys.stderr = sys.stderr, open(os.devnull, "w")
+            try:
+                self.assertEqual(writer.queue_movement(pid, 1, "in").result(timeout=5), 1)
+            finally:
+                sys.stderr.close()
+                sys.stderr = stderr
+            app.unsubscribe(falha)
+            self.assertEqual(writer.queue_movement(pid, 1, "in").result(timeout=5), 2)
+        finally:
+            app.unsubscribe(falha)
+            writer.close()
+
+    def test_close_connections_nao_derruba_o_escritor(self):
+        pid = app.add_product("A", 0, 1.0, None)
+        writer = app.GroupCommitWriter()
+        try:
+            self.assertEqual(writer.queue_movement(pid, 1, "in").result(timeout=5), 1)
+            app.close_connections()
+            self.assertEqual(writer.queue_movement(pid, 2, "in").result(timeout=5), 3)
+        finally:
+            writer.close()
+        self.conn = app.get_connection()
+        self.assertEqual(self.quantity(pid), 3)
+
+
+class TestInstrumentacao(BancoTemporario):
+    def setUp(self):
+        super().setUp()
+        app.close_connections()
+        self.old_slow = app.profiler.slow_ms
+        app.profiler.reset()
+        app.enable_profiling(slow_ms=0)
+        self.conn = app.get_connection()
+
+    def tearDown(self):
+        app.profiler.enabled = False
+        app.profiler.slow_ms = self.old_slow
+        app.profiler.reset()
+        super().tearDown()
+
+    def test_registra_chamadas_e_consultas_lentas(self):
+        for k in range(3):
+            app.add_product(f"Produto {k}", 1, 1.0, None)
+        self.assertEqual(len(app.get_products(limit=2)), 2)
+        snap = app.profiler.snapshot()
+        self.assertEqual(snap["functions"]["add_product"]["calls"], 3)
+        self.assertEqual(snap["functions"]["get_products"]["rows"], 2)
+        slow = [e for e in snap["slow"] if e["function"] == "get_products"]
+        self.assertTrue(slow)
+        self.assertTrue(slow[-1]["plan"])
+        self.assertEqual(slow[-1]["rows"], 2)
+        path = os.path.join(self.tmp.name, "perfil.json")
+        app.profiler.dump(path)
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["functions"]["get_products"]["calls"], 1)
+
+
+class TestLotes(BancoTemporario):
+    def test_saida_consome_o_lote_que_vence_primeiro(self):
+        today = datetime.date.today()
+        pid = app.add_product("Leite", 0, 2.0, None)
+        app.change_stock(pid, 5, "in", lot="A", expiry_date=(today + datetime.timedelta(days=10)).isoformat())
+        app.change_stock(pid, 5, "in", lot="B", expiry_date=(today + datetime.timedelta(days=5)).isoformat())
+        app.change_stock(pid, 5, "in", lot="C")
+        app.change_stock(pid, 7, "out")
+        lots = {r["code"]: r["qty_remaining"] for r in app.get_lots(pid, open_only=False)}
+        self.assertEqual(lots, {"B": 0, "A": 3, "C": 5})
+        self.assertEqual(app.get_product(pid)["expiry_date"], (today + datetime.timedelta(days=10)).isoformat())
+
+    def test_validade_conta_so_o_saldo_do_lote(self):
+        today = datetime.date.today()
+        pid = app.add_product("Leite", 0, 2.0, None)
+        app.change_stock(pid, 1, "in", lot="L1", expiry_date=(today + datetime.timedelta(days=2)).isoformat())
+        app.change_stock(pid, 999, "in", lot="L2", expiry_date=(today + datetime.timedelta(days=300)).isoformat())
+        rows = app.get_expiring(30)
+        self.assertEqual([(r["lot"], r["quantity"], r["value_at_risk"]) for r in rows], [("L1", 1, 2.0)])
+        self.assertEqual(app.get_expiry_summary(30), (0, 0, 1, 2.0))
+
+    def test_quantidade_nao_positiva_e_recusada(self):
+        pid = app.add_product("Leite", 5, 2.0, None)
+        for amount in (0, -3):
+            with self.assertRaisesRegex(ValueError, "Quantidade deve ser positiva."):
+                app.change_stock(pid, amount, "in")
+        with self.assertRaisesRegex(ValueError, "Tipo deve ser"):
+            app.change_stock(pid, 1, "x")
+        self.assertEqual([r["qty_remaining"] for r in app.get_lots(pid, open_only=False)], [5])
+        self.assertEqual(app.count_transactions(pid), 1)
+
+
+class TestPosicao(BancoTemporario):
+    DAYS = 90
+
+    def populate(self, seed=7):
+        """Histórico com datas passadas, gravado como as escritas do módulo gravariam."""
+        rnd = random.Random(seed)
+        today = datetime.date.today()
+        start = today - datetime.timedelta(days=self.DAYS)
+        created = datetime.datetime.combine(start, datetime.time()).isoformat()
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO products (name,quantity,price,expiry_date,created_at) VALUES (?,0,?,NULL,?)",
+                [(f"Produto {i}", float(i), created) for i in range(1, 11)])
+        ledger = []
+        stock = {pid: 0 for pid in range(1, 11)}
+        for _ in range(600):
+            pid = rnd.randint(1, 10)
+            day = start + datetime.timedelta(days=rnd.randrange(self.DAYS + 1))
+            when = datetime.datetime.combine(day, datetime.time(rnd.randrange(24), rnd.randrange(60)))
+            ttype = "in" if rnd.random() < 0.6 else "out"
+            ledger.append((pid, ttype, rnd.randint(1, 9), when.isoformat()))
+        ledger.sort(key=lambda r: r[3])
+        rows = []
+        for pid, ttype, qty, when in ledger:
+            if ttype == "out" and stock[pid] < qty:
+                continue
+            stock[pid] += qty if ttype == "in" else -qty
+            rows.append((pid, ttype, qty, when))
+        with self.conn:
+            cur = self.conn.cursor()
+            cur.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) VALUES (?,?,?,?,'')",
+                            rows)
+            cur.executemany(app.ROLLUP_UPSERT, [(pid, when[:10], qty if t == "in" else 0, 0 if t == "in" else qty)
+                                                for pid, t, qty, when in rows])
+            cur.executemany("UPDATE products SET quantity=? WHERE id=?", [(q, pid) for pid, q in stock.items()])
+        return rows
+
+    @staticmethod
+    def replay(rows, day):
+        stock = {pid: 0 for pid in range(1, 11)}
+        for pid, ttype, qty, when in rows:
+            if when[:10] <= day:
+                stock[pid] += qty if ttype == "in" else -qty
+        return stock
+
+    def check(self, rows):
+        today = datetime.date.today()
+        for back in range(0, self.DAYS + 1, 7):
+            day = (today - datetime.timedelta(days=back)).isoformat()
+            got = {r["id"]: r["quantity"] for r in app.stock_as_of(day)}
+            self.assertEqual(got, self.replay(rows, day), day)
+
+    def test_posicao_igual_ao_historico_reaplicado(self):
+        rows = self.populate()
+        self.check(rows)
+
+    def test_posicao_a_partir_dos_fechamentos(self):
+        rows = self.populate()
+        self.assertGreater(app.ensure_month_end_snapshots(), 0)
+        self.check(rows)
+
+    def test_importacao_nao_altera_o_passado(self):
+        rows = self.populate()
+        yesterday = (datetime.date.today() - datetime.timedelta(days=1)).isoformat()
+        before = app.stock_as_of_totals(yesterday)
+        path = os.path.join(self.tmp.name, "produtos.csv")
+        app.write_products_csv(path)
+        with open(path, encoding="utf-8-sig") as f:
+            text = f.read()
+        lines = text.splitlines()
+        header = lines[0].split(",")
+        first = lines[1].split(",")
+        first[header.index("quantity")] = "500"
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join([lines[0], ",".join(first)]) + "\n")
+        app.import_products_csv(path)
+        self.assertEqual(self.quantity(int(first[header.index("id")])), 500)
+        self.assertEqual(app.stock_as_of_totals(yesterday), before)
+
+
+class TestArquivamento(BancoTemporario):
+    def setUp(self):
+        super().setUp()
+        old = datetime.datetime.now() - datetime.timedelta(days=400)
+        pid = app.add_product("Café", 0, 1.0, None)
+        for k in range(30):
+            app.change_stock(pid, k + 1, "in")
+        with self.conn:
+            # metade do histórico fica antiga
+            self.conn.execute("UPDATE transactions SET created_at=? WHERE id <= 15", (old.isoformat(),))
+            self.conn.execute("DELETE FROM daily_movements")
+        app.rebuild_daily_movements()
+        self.pid = pid
+        self.cutoff = datetime.date.today() - datetime.timedelta(days=365)
+        self.path = os.path.join(self.tmp.name, "arquivo.db")
+
+    def archived_rows(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("SELECT COUNT(*), TOTAL(quantity) FROM transactions").fetchone()
+        finally:
+            conn.close()
+
+    def test_repetir_apos_interrupcao_nao_duplica(self):
+        rollup = self.conn.execute("SELECT TOTAL(in_qty) FROM daily_movements").fetchone()[0]
+        old_batch, old_upsert = app.ARCHIVE_BATCH, app.ARCHIVE_BALANCE_UPSERT
+        app.ARCHIVE_BATCH = 10
+        # falha depois de o primeiro bloco ter sido copiado para o arquivo
+        app.ARCHIVE_BALANCE_UPSERT = "SELECT * FROM tabela_inexistente"
+        try:
+            with self.assertRaises(sqlite3.OperationalError):
+                app.archive_transactions(self.cutoff, self.path)
+        finally:
+            app.ARCHIVE_BALANCE_UPSERT = old_upsert
+        self.assertEqual(self.archived_rows()[0], 10)
+        self.assertEqual(app.count_transactions(), 30)
+        try:
+            self.assertEqual(app.archive_transactions(self.cutoff, self.path), 15)
+        finally:
+            app.ARCHIVE_BATCH = old_batch
+        self.assertEqual(self.archived_rows(), (15, sum(range(1, 16))))
+        self.assertEqual(app.count_transactions(), 15)
+        balance = self.conn.execute("SELECT in_qty, movements FROM archived_balances WHERE product_id=?",
+                                    (self.pid,)).fetchone()
+        self.assertEqual(tuple(balance), (sum(range(1, 16)), 15))
+        self.assertEqual(app.archive_transactions(self.cutoff, self.path), 0)
+        app.rebuild_daily_movements()
+        self.assertEqual(self.conn.execute("SELECT TOTAL(in_qty) FROM daily_movements").fetchone()[0], rollup)
+        self.assertEqual(app.get_archived_balance(self.pid)["quantity"], sum(range(1, 16)))
+
+    def test_compactar_solta_todas_as_paginas_livres(self):
+        old = (datetime.datetime.now() - datetime.timedelta(days=400)).isoformat()
+        note = "x" * 200
+
+        def archive_history():
+            with self.conn:
+                self.conn.executemany("INSERT INTO transactions (product_id,type,quantity,created_at,note) "
+                                      "VALUES (?,'in',1,?,?)", [(self.pid, old, note)] * 5000)
+            app.archive_transactions(self.cutoff, self.path)
+
+        archive_history()
+        app.compact_database()  # primeira vez: VACUUM e auto_vacuum incremental
+        self.assertEqual(self.conn.execute("PRAGMA auto_vacuum").fetchone()[0], 2)
+        archive_history()
+        self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")  # o arquivo passa a ter as páginas livres
+        self.assertGreater(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 1)
+        file_before = os.path.getsize(app.DB_FILE)
+        before, after = app.compact_database()
+        self.assertEqual(self.conn.execute("PRAGMA freelist_count").fetchone()[0], 0)
+        self.assertLess(after, before)
+        self.assertLess(os.path.getsize(app.DB_FILE), file_before)
+
+
+class TestCacheRelatorios(BancoTemporario):
+    def fresh(self, days, gran):
+        app.report_cache.clear()
+        return app.report_cache.get(days, gran)
+
+    def test_cache_acompanha_escritas_de_outra_conexao(self):
+        a = app.add_product("A", 10, 1.0, None)
+        b = app.add_product("B", 12, 1.0, None)
+        app.change_stock(a, 3, "out")
+        app.change_stock(b, 7, "out")
+        first = app.report_cache.get(30, "day")
+        app.change_stock(a, 2, "in")
+        self.assertEqual(app.report_cache.get(30, "day"), self.fresh(30, "day"))
+        app.report_cache.get(30, "day")
+        self.assertEqual(app.report_cache.stats()["hits"], 1)
+        other = sqlite3.connect(app.DB_FILE)
+        try:
+            # exclusão feita por outro processo: MAX(id) não diminui
+            with other:
+                other.execute("DELETE FROM transactions WHERE product_id=?", (b,))
+                other.execute("DELETE FROM daily_movements WHERE product_id=?", (b,))
+                other.execute("DELETE FROM lots WHERE product_id=?", (b,))
+                other.execute("DELETE FROM products WHERE id=?", (b,))
+            cached = app.report_cache.get(30, "day")
+            self.assertNotEqual(cached, first)
+            self.assertEqual(cached, self.fresh(30, "day"))
+            self.assertEqual((sum(cached[1]), sum(cached[2])), (12, 3))
+            with other:
+                other.execute("UPDATE products SET name='A renomeado' WHERE id=?", (a,))
+            self.assertEqual(app.report_cache.get(30, "day")[3][0]["name"], "A renomeado")
+        finally:
+            other.close()
+        app.rebuild_daily_movements()
+        self.assertEqual(app.report_cache.get(30, "day"), self.fresh(30, "day"))
+
+
+if __name__ == "__main__":
+    unittest.main()